@@ -0,0 +1,87 @@
+"""
+messagebus_benchmark - per-message cost of the messagebus storage engines
+
+For each backlog size, adds that many messages to a topic from a number of
+publisher threads, each waiting for its message to be stored as
+MessageBus.send() does, then takes the pending messages as the sender does
+and acknowledges them.  The time per message should not grow with the
+backlog.
+
+Example::
+  messagebus_benchmark.py --storage memory --backlogs 1000,10000,100000
+  messagebus_benchmark.py --storage sqlite --publishers 16
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import Pyro4
+
+from support.messagebus.messagebus import (Message, MemoryStorage,
+                                           SqliteStorage)
+
+def make_storage(kind):
+  """
+  A storage engine with a topic 'bench' which has a subscriber
+  """
+  if kind == "memory":
+    storage = MemoryStorage()
+  else:
+    storage = SqliteStorage(os.path.join(tempfile.mkdtemp(), "messages.sqlite"))
+  storage.create_topic("bench")
+  # the proxy does not connect until it is used
+  storage.add_subscriber("bench", Pyro4.Proxy("PYRO:bench@localhost:9"))
+  return storage
+
+def publish(storage, messages):
+  """
+  Adds messages one at a time, waiting until each is stored
+  """
+  for message in messages:
+    committed = storage.add_message("bench", message)
+    if committed is not None:
+      committed.result()
+
+def run(kind, backlog, publishers):
+  """
+  Times adding, taking and acknowledging 'backlog' messages
+
+  @return: (add, deliver) seconds per message
+  """
+  storage = make_storage(kind)
+  messages = [Message(uuid.uuid1(), datetime.datetime.now(), {"count": count})
+              for count in range(backlog)]
+  threads = [threading.Thread(target=publish,
+                              args=(storage, messages[index::publishers]))
+             for index in range(publishers)]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  added = time.time()
+  delivered = 0
+  while delivered < backlog:
+    pending = storage.all_pending_messages()
+    delivered += len(list(pending["bench"]))
+    storage.remove_messages(pending)
+  done = time.time()
+  return (added - start)/backlog, (done - added)/backlog
+
+if __name__ == "__main__":
+  p = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawDescriptionHelpFormatter)
+  p.add_argument('--storage', default='memory', choices=['memory', 'sqlite'])
+  p.add_argument('--backlogs', default='1000,10000,100000',
+                 help="comma separated numbers of pending messages")
+  p.add_argument('--publishers', type=int, default=1,
+                 help="number of threads adding messages")
+  args = p.parse_args()
+  print("%10s %14s %14s" % ("backlog", "add (us/msg)", "deliver (us/msg)"))
+  for backlog in [int(size) for size in args.backlogs.split(',')]:
+    add, deliver = run(args.storage, backlog, args.publishers)
+    print("%10d %14.2f %14.2f" % (backlog, 1e6*add, 1e6*deliver))
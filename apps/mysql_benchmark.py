@@ -0,0 +1,229 @@
+"""
+mysql_benchmark - time mysql.BaseDB operations
+
+Two benchmarks are available::
+  async - fetches one day of data from several tables, first one table after
+          the other with mysql.BaseDB and then all at once with
+          mysql.AsyncBaseDB, and reports the latencies.
+  suite - fills a synthetic table with a few days of one-second samples and
+          times the BaseDB read and write paths.  The default backend is
+          'sqlite', so no server is needed.  The best times can be saved as
+          JSON and later compared with, e.g.::
+            python mysql_benchmark.py suite --save baseline.json
+            python mysql_benchmark.py suite --baseline baseline.json
+          The exit status is 1 when an operation is slower than the baseline
+          by more than the tolerance.
+"""
+import argparse
+import asyncio
+import calendar
+import getpass
+import json
+import sys
+import time
+
+import numpy as np
+
+from support.mysql import AsyncBaseDB, BaseDB, backends
+
+def sync_fetch(db, tables, columns, year, doy):
+  """
+  Fetches the tables one after the other
+  """
+  start = time.time()
+  for table in tables:
+    db.get_rows_by_date(table, columns, year, doy)
+  return time.time() - start
+
+async def async_fetch(db, tables, columns, year, doy):
+  """
+  Fetches the tables concurrently
+  """
+  start = time.time()
+  await asyncio.gather(*[db.get_rows_by_date(table, columns, year, doy)
+                         for table in tables])
+  return time.time() - start
+
+def async_benchmark(args):
+  """
+  Compares serial and concurrent fetches of several tables
+  """
+  pw = getpass.getpass("password for %s: " % args.user)
+  tables = args.tables.split(',')
+  columns = args.columns.split(',')
+
+  sync_db = BaseDB(args.host, args.user, pw, args.database)
+  sync_times = [sync_fetch(sync_db, tables, columns, args.year, args.doy)
+                for count in range(args.repeat)]
+  sync_db.close()
+
+  async_db = AsyncBaseDB(args.host, args.user, pw, args.database,
+                         pool_size=len(tables))
+  loop = asyncio.new_event_loop()
+  async_times = [loop.run_until_complete(
+                   async_fetch(async_db, tables, columns, args.year, args.doy))
+                 for count in range(args.repeat)]
+  loop.close()
+  async_db.close()
+
+  print("%d tables, %d repeats" % (len(tables), args.repeat))
+  print("sync:  min %.3f s, mean %.3f s" % (min(sync_times),
+                                            sum(sync_times)/len(sync_times)))
+  print("async: min %.3f s, mean %.3f s" % (min(async_times),
+                                            sum(async_times)/len(async_times)))
+  return 0
+
+table = "bench_weather"
+columns = ["utc", "TAmb", "pressure", "humidity", "wind_speed"]
+first_doy = 100
+
+def create_table(db, backend):
+  """
+  Creates an empty synthetic weather table
+  """
+  if backend == "sqlite":
+    key = "ID INTEGER PRIMARY KEY AUTOINCREMENT"
+  else:
+    key = "ID INT NOT NULL AUTO_INCREMENT PRIMARY KEY"
+  db.get("DROP TABLE IF EXISTS " + table)
+  db.get("CREATE TABLE " + table + " (" + key + ", year INT, doy INT, "
+         "utc DOUBLE, TAmb DOUBLE, pressure DOUBLE, humidity DOUBLE, "
+         "wind_speed DOUBLE)")
+  db.get("CREATE INDEX " + table + "_date ON " + table + " (year, doy, utc)")
+  db.schema.invalidate()
+
+def samples(year, doy, count):
+  """
+  One-second weather samples starting at midnight UTC
+  """
+  day_start = calendar.timegm((year, 1, 1, 0, 0, 0, 0, 0, 0)) + (doy-1)*86400
+  records = []
+  for second in range(count):
+    records.append({"year": year, "doy": doy, "utc": day_start + second,
+                    "TAmb": 20. + 5*np.sin(second/3600.),
+                    "pressure": 900. + second % 7,
+                    "humidity": 40. + second % 11,
+                    "wind_speed": float(second % 13)})
+  return records
+
+def best_time(function, repeat):
+  """
+  Shortest and mean duration of 'repeat' calls
+  """
+  times = []
+  for count in range(repeat):
+    start = time.time()
+    function()
+    times.append(time.time() - start)
+  return min(times), sum(times)/len(times)
+
+def suite_benchmark(args):
+  """
+  Times BaseDB operations on a synthetic table
+  """
+  if backends[args.backend].login:
+    pw = getpass.getpass("password for %s: " % args.user)
+  else:
+    pw = None
+  db = BaseDB(args.host, args.user, pw, args.database, backend=args.backend)
+  create_table(db, args.backend)
+  year = 2020
+  timings = {}
+
+  def load():
+    for doy in range(first_doy, first_doy+args.days):
+      db.insert_records(table, samples(year, doy, args.rows))
+  start = time.time()
+  load()
+  timings["insert_records (load)"] = (time.time() - start,)*2
+
+  day = samples(year, first_doy, args.rows)
+  utcs = [record["utc"] for record in day[::max(1, args.rows//1000)]]
+  operations = [
+    ("get_rows_by_date",
+     lambda: db.get_rows_by_date(table, columns, year, first_doy)),
+    ("get_rows_by_time",
+     lambda: db.get_rows_by_time(table, columns, year, first_doy, utcs)),
+    ("get_rows_by_time (tolerance)",
+     lambda: db.get_rows_by_time(table, columns, year, first_doy,
+                                 [utc + 0.3 for utc in utcs], tolerance=0.5)),
+    ("get_as_dict",
+     lambda: db.get_as_dict("SELECT * FROM " + table
+                            + " WHERE year=%s AND doy=%s", (year, first_doy))),
+    ("iter_query",
+     lambda: [chunk for chunk in db.iter_query(
+                "SELECT * FROM " + table + " WHERE year=%s AND doy=%s",
+                (year, first_doy))]),
+    ("insertRecord x100",
+     lambda: [db.insertRecord(table, record) for record in day[:100]]),
+    ("insert_records x%d" % len(day),
+     lambda: db.insert_records(table, day))]
+  for name, function in operations:
+    timings[name] = best_time(function, args.repeat)
+  db.close()
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  print("%s backend, %d days of %d rows, %d repeats"
+        % (args.backend, args.days, args.rows, args.repeat))
+  print("%-32s %10s %10s %10s" % ("operation", "best (s)", "mean (s)",
+                                  "baseline"))
+  slower = []
+  for name, (best, mean) in timings.items():
+    if name in baseline:
+      ratio = best/baseline[name]
+      compared = "%9.2fx" % ratio
+      if ratio > args.tolerance:
+        slower.append(name)
+    else:
+      compared = "%10s" % "-"
+    print("%-32s %10.4f %10.4f %s" % (name, best, mean, compared))
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(dict([(name, best) for name, (best, mean) in timings.items()]),
+                f, indent=2, sort_keys=True)
+  if slower:
+    print("slower than the baseline by more than %.2fx: %s"
+          % (args.tolerance, ", ".join(slower)))
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  p = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawTextHelpFormatter)
+  p.add_argument('--host', default='localhost', help="database host")
+  p.add_argument('--user', default='ops', help="database user")
+  p.add_argument('--repeat', type=int, default=5,
+                 help="number of times each operation is timed")
+  sub = p.add_subparsers(dest='benchmark')
+  sub.required = True
+
+  a = sub.add_parser('async', help="serial versus concurrent table fetches")
+  a.add_argument('--database', default='dss28_eac', help="database name")
+  a.add_argument('--tables', default='weather,tipper',
+                 help="comma separated table names")
+  a.add_argument('--columns', default='utc',
+                 help="comma separated column names common to the tables")
+  a.add_argument('--year', type=int, required=True)
+  a.add_argument('--doy', type=int, required=True)
+  a.set_defaults(run=async_benchmark)
+
+  s = sub.add_parser('suite', help="BaseDB operations on a synthetic table")
+  s.add_argument('--backend', default='sqlite', choices=sorted(backends),
+                 help="DB-API backend")
+  s.add_argument('--database', default=':memory:',
+                 help="database name, or file for sqlite")
+  s.add_argument('--days', type=int, default=2,
+                 help="number of days of samples loaded")
+  s.add_argument('--rows', type=int, default=20000,
+                 help="number of samples per day")
+  s.add_argument('--save', help="file for the best times as JSON")
+  s.add_argument('--baseline', help="JSON file of best times to compare with")
+  s.add_argument('--tolerance', type=float, default=1.5,
+                 help="allowed ratio of a best time to the baseline")
+  s.set_defaults(run=suite_benchmark)
+
+  args = p.parse_args()
+  sys.exit(args.run(args))
@@ -0,0 +1,66 @@
+"""
+mysql_mirror - mirror days of table data in local files
+
+Fetches the given columns of a table for a range of days into the
+mysql.DayMirror directory so that they can be reduced without the database.
+
+Example::
+  mysql_mirror.py --table weather --columns utc,TAmb,pressure \
+                  --start 2019-120 --end 2019-150 --directory /data/mirror
+"""
+import argparse
+import datetime
+import getpass
+
+from support.mysql import BaseDB, DayMirror, get_backend
+
+def parse_day(text):
+  """
+  Converts 'YYYY-DDD' to a date
+  """
+  return datetime.datetime.strptime(text, "%Y-%j").date()
+
+def main(argv=None):
+  """
+  Mirrors the days given on the command line
+
+  @param argv : command line arguments, default sys.argv[1:]
+  @type  argv : list of str
+
+  @return: number of days mirrored
+  """
+  p = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawDescriptionHelpFormatter)
+  p.add_argument('--host', default='localhost', help="database host")
+  p.add_argument('--user', default='ops', help="database user")
+  p.add_argument('--database', default='dss28_eac', help="database name")
+  p.add_argument('--backend', default='MySQLdb',
+                 help="DB-API backend, see mysql.backends")
+  p.add_argument('--table', required=True, help="table name")
+  p.add_argument('--columns', required=True,
+                 help="comma separated column names")
+  p.add_argument('--start', type=parse_day, required=True,
+                 help="first day as YYYY-DDD")
+  p.add_argument('--end', type=parse_day, required=True,
+                 help="last day as YYYY-DDD")
+  p.add_argument('--directory', required=True, help="mirror directory")
+  p.add_argument('--settle', type=float, default=3600.,
+                 help="seconds after a day ends before it is complete")
+  args = p.parse_args(argv)
+  if get_backend(args.backend).login:
+    pw = getpass.getpass("password for %s: " % args.user)
+  else:
+    pw = None
+
+  db = BaseDB(args.host, args.user, pw, args.database, backend=args.backend)
+  try:
+    mirror = DayMirror(db, args.directory, settle=args.settle)
+    count = mirror.prefetch(args.table, args.columns.split(','),
+                            args.start, args.end)
+  finally:
+    db.close()
+  print("mirrored %d days of %s" % (count, args.table))
+  return count
+
+if __name__ == "__main__":
+  main()
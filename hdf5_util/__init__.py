@@ -1,11 +1,13 @@
 from .inspect import inspect_file_attrs, inspect_file_structure
 from .dump_dict import dump_dict
 from .hdf5_mixin import HDF5Mixin
+from .table_export import TableExporter
 
 
 __all__ = [
             "inspect_file_attrs",
             "inspect_file_structure",
             "dump_dict",
-            "HDF5Mixin"
+            "HDF5Mixin",
+            "TableExporter"
 ]
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+import h5py
+
+module_logger = logging.getLogger(__name__)
+
+__all__ = ["TableExporter"]
+
+
+class TableExporter(object):
+    """
+    Stream the rows of a database table into HDF5 files, one per day.
+
+    The rows are read in primary key order through a server-side cursor
+    (``BaseDB.iter_query``), ``chunk_rows`` at a time, and appended to
+    resizable, chunked and compressed datasets, one per column, in
+
+    .. code-block:: none
+
+        base_dir/<year>/<doy>/<table>.hdf5
+
+    the year and day of year subdirectories being those of
+    ``HDF5Mixin.create_data_directory``. The day of a row is taken from its
+    ``year`` and ``doy`` columns, or else from its ``utc`` column.
+
+    NULL values are stored as the fill values of ``mysql.decode_column``
+    (NaN, NaT, 0 or an empty string) and flagged in a boolean dataset
+    ``mask/<column>`` of the same length, True where the value was NULL.
+    The mask of a column is only created once it has had a NULL.
+
+    Each file has a ``last_id`` attribute, the primary key of the last row
+    it holds, and the last key exported is kept in
+    ``base_dir/<table>.export.json``. An export which is interrupted
+    continues from there when ``export`` is called again, without writing
+    any row twice. Memory use does not depend on the size of the table.
+
+    Examples:
+
+    .. code-block:: python
+
+        from support.mysql import BaseDB
+        from support.hdf5_util import TableExporter
+
+        db = BaseDB(host, user, pw, "dss28_eac", pool_size=2)
+        exporter = TableExporter(db, "weather", "/data/archive")
+        exporter.export()
+
+    Attributes:
+        db (BaseDB): database
+        table (str): table exported
+        base_dir (str): top directory of the files
+        columns (list): columns exported; the primary key is always included
+        key (str): primary key of the table
+    """
+
+    mask_group = "mask"
+
+    def __init__(self, db, table, base_dir, columns=None, chunk_rows=10000,
+                 compression="gzip"):
+        """
+        Args:
+            db (BaseDB): database
+            table (str): table to export
+            base_dir (str): top directory of the files
+            columns (list): columns to export; default all
+            chunk_rows (int): number of rows read at a time
+            compression (str): HDF5 compression filter, or None
+        """
+        self.db = db
+        self.table = table
+        self.base_dir = base_dir
+        self.key = db.primary_key(table)
+        if columns is None:
+            columns = db.schema.column_names(table)
+        self.columns = [self.key] + [col for col in columns if col != self.key]
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.state_path = os.path.join(base_dir, table + ".export.json")
+
+    def last_exported_id(self):
+        """
+        Primary key of the last row exported, 0 if none.
+
+        Returns:
+            int
+        """
+        if not os.path.exists(self.state_path):
+            return 0
+        with open(self.state_path) as f:
+            return json.load(f)["last_id"]
+
+    def _save_state(self, last_id):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"table": self.table, "last_id": int(last_id),
+                       "time": time.time()}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def file_path(self, year, doy):
+        """
+        Path of the file for a day.
+        """
+        return os.path.join(self.base_dir, "{:04d}".format(int(year)),
+                            "{:03d}".format(int(doy)), self.table + ".hdf5")
+
+    def _days(self, chunk):
+        """
+        Year and day of year of each row of a chunk.
+        """
+        if "year" in chunk and "doy" in chunk:
+            return (chunk["year"].astype(np.int64),
+                    chunk["doy"].astype(np.int64))
+        utc = np.asarray(chunk["utc"], dtype=np.float64)
+        days = (utc // 86400).astype("datetime64[D]")
+        years = days.astype("datetime64[Y]")
+        doys = (days - years).astype(np.int64) + 1
+        return years.astype(np.int64) + 1970, doys
+
+    @staticmethod
+    def _storable(values):
+        """
+        Values in a form h5py can store, with attributes describing them.
+        """
+        if values.dtype.kind == "U":
+            return values.astype(object), h5py.string_dtype(), {}
+        if values.dtype.kind == "M":
+            unit = np.datetime_data(values.dtype)[0]
+            return (values.astype(np.int64), np.int64,
+                    {"units": "datetime64[{}]".format(unit)})
+        if values.dtype.kind == "m":
+            unit = np.datetime_data(values.dtype)[0]
+            return (values.astype(np.int64), np.int64,
+                    {"units": "timedelta64[{}]".format(unit)})
+        return values, values.dtype, {}
+
+    def _append_mask(self, f_obj, col, start, mask):
+        """
+        Append to the NULL mask of a column, creating it at the first NULL.
+        """
+        name = self.mask_group + "/" + col
+        if name in f_obj:
+            dataset = f_obj[name]
+            dataset.resize((start + len(mask),))
+            dataset[start:] = mask
+        elif mask.any():
+            dataset = f_obj.create_dataset(
+                name, shape=(start + len(mask),), dtype=bool,
+                maxshape=(None,), chunks=(min(self.chunk_rows, 65536),),
+                compression=self.compression)
+            dataset[start:] = mask
+
+    def _append(self, path, chunk, masks, rows):
+        """
+        Append the selected rows of a chunk to the file of a day, skipping
+        those it already has.
+
+        Returns:
+            int: number of rows written
+        """
+        os.makedirs(os.path.dirname(path), mode=0o775, exist_ok=True)
+        with h5py.File(path, "a") as f_obj:
+            last_id = f_obj.attrs.get("last_id", 0)
+            rows = rows[chunk[self.key][rows] > last_id]
+            if len(rows) == 0:
+                return 0
+            for col in self.columns:
+                values, dtype, attrs = self._storable(chunk[col][rows])
+                if col in f_obj:
+                    dataset = f_obj[col]
+                    start = dataset.shape[0]
+                    dataset.resize((start + len(values),))
+                    dataset[start:] = values
+                else:
+                    start = 0
+                    dataset = f_obj.create_dataset(
+                        col, data=values, dtype=dtype, maxshape=(None,),
+                        chunks=(min(self.chunk_rows, 65536),),
+                        compression=self.compression)
+                    dataset.attrs.update(attrs)
+                self._append_mask(f_obj, col, start, masks[col][rows])
+            f_obj.attrs["table"] = self.table
+            f_obj.attrs["last_id"] = chunk[self.key][rows[-1]]
+        return len(rows)
+
+    def export(self, progress=None):
+        """
+        Export the rows added since the last export.
+
+        Args:
+            progress (callable): called with the number of rows exported so
+                far and the last primary key after each chunk
+        Returns:
+            int: number of rows exported
+        """
+        start_id = self.last_exported_id()
+        query = "SELECT {} FROM {} WHERE {} > %s ORDER BY {}".format(
+            ", ".join(self.columns), self.table, self.key, self.key)
+        module_logger.info("export: {} from {} > {}".format(
+            self.table, self.key, start_id))
+        count = 0
+        for chunk in self.db.iter_query(query, (start_id,),
+                                        chunk_rows=self.chunk_rows,
+                                        asfloat=False, masked=True):
+            masks = dict([(col, np.ma.getmaskarray(chunk[col]))
+                          for col in chunk])
+            chunk = dict([(col, np.ma.getdata(chunk[col])) for col in chunk])
+            years, doys = self._days(chunk)
+            days = years*1000 + doys
+            for day in np.unique(days):
+                rows = np.flatnonzero(days == day)
+                count += self._append(
+                    self.file_path(day // 1000, day % 1000), chunk, masks,
+                    rows)
+            last_id = chunk[self.key][-1]
+            self._save_state(last_id)
+            if progress:
+                progress(count, last_id)
+        module_logger.info("export: {} rows of {} exported".format(
+            count, self.table))
+        return count
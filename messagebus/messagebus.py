@@ -5,14 +5,18 @@ Provides a way of communicating where the sender and receivers are fully decoupl
 Pyro - Python Remote Objects.  Copyright by Irmen de Jong (irmen@razorvine.net).
 """
 from __future__ import print_function
+import os
 import threading
+import concurrent.futures
 import uuid
 import datetime
 import time
 import logging
 import traceback
 import sys
-from collections import defaultdict
+import tempfile
+from collections import defaultdict, deque
+from itertools import islice
 from contextlib import closing
 try:
     import cPickle as pickle
@@ -32,7 +36,7 @@ from Pyro4.util import SerializerBase
 from . import PYRO_MSGBUS_NAME
 
 
-__all__ = ["MessageBus", "Message", "SerializerBase"]
+__all__ = ["MessageBus", "Message", "QueueLimit", "SerializerBase"]
 
 log = logging.getLogger("Pyro4.MessageBus")
 
@@ -73,26 +77,60 @@ class Subscriber(object):
     """
     This class is meant to be subclassed, and the consume_message method reimplemented.
     As messages arrive from the publisher, the consume_message method gets called.
+    When the queue of received messages is full, overflow says what happens to a new one:
+    "block" makes the bus wait, "drop_oldest" and "drop_newest" drop a message. overflow_counts
+    counts how often each happened.
     """
-    def __init__(self, auto_consume=True, max_queue_size=5000, host='localhost', port=9090, **kwargs):
+    overflow_policies = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, auto_consume=True, max_queue_size=5000, host='localhost', port=9090,
+                 overflow="block", **kwargs):
         """
         kwargs:
             - auto_consume (bool): Automatically start subscribing (True)
             - max_queue_size (int): Max number of elements that can be placed in queue.Queue (5000)
             - host (str): The nameserver hostname ('localhost')
             - port (int): The nameserver port (9090)
+            - overflow (str): What to do when the queue is full ("block")
             - **kwargs:
         """
+        if overflow not in self.overflow_policies:
+            raise ValueError("invalid overflow policy: %r" % overflow)
         # self.bus = Pyro4.Proxy("PYRONAME:"+PYRO_MSGBUS_NAME)
         self.bus = Pyro4.Proxy("PYRONAME:{}@{}:{}".format(PYRO_MSGBUS_NAME, host,port))
         self.received_messages = queue.Queue(maxsize=max_queue_size)
+        self.overflow = overflow
+        self.overflow_counts = defaultdict(int)
         if auto_consume:
             self.__bus_consumer_thread = threading.Thread(target=self.__bus_consume_message)
             self.__bus_consumer_thread.daemon = True
             self.__bus_consumer_thread.start()
 
     def incoming_message(self, topic, message):
-        self.received_messages.put((topic, message))
+        try:
+            self.received_messages.put_nowait((topic, message))
+            return
+        except queue.Full:
+            pass
+        if self.overflow == "block":
+            if not self.overflow_counts["blocked"]:
+                log.warning("subscriber queue is full, the messagebus waits for it")
+            self.overflow_counts["blocked"] += 1
+            self.received_messages.put((topic, message))
+        elif self.overflow == "drop_newest":
+            self.overflow_counts["dropped_newest"] += 1
+        else:
+            while True:
+                try:
+                    self.received_messages.get_nowait()
+                    self.overflow_counts["dropped_oldest"] += 1
+                except queue.Empty:
+                    pass
+                try:
+                    self.received_messages.put_nowait((topic, message))
+                    break
+                except queue.Full:
+                    continue
 
     def incoming_messages(self, topic, messages):
         # this is an optimization to receive multiple messages for the topic at the same time
@@ -118,16 +156,450 @@ class Subscriber(object):
         raise NotImplementedError("subclass should implement this")
 
 
+class PendingMessages(object):
+    """
+    Read-only view of the messages of a MessageRing between two sequence numbers.
+    Taking it copies nothing; it stays valid until the messages are acknowledged.
+    """
+    __slots__ = ("buffer", "mask", "start_seq", "end_seq")
+
+    def __init__(self, buffer, mask, start_seq, end_seq):
+        self.buffer = buffer
+        self.mask = mask
+        self.start_seq = start_seq
+        self.end_seq = end_seq
+
+    def __len__(self):
+        return self.end_seq - self.start_seq
+
+    def __iter__(self):
+        for seq in range(self.start_seq, self.end_seq):
+            yield self.buffer[seq & self.mask]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.buffer[(self.start_seq + index) & self.mask]
+
+
+class PendingBatch(list):
+    """
+    List of the pending messages of a topic, with the sequence number of the last one,
+    and of the first one if the messages before it may still be pending.
+    """
+    def __init__(self, messages, last_seq, first_seq=None):
+        list.__init__(self, messages)
+        self.last_seq = last_seq
+        self.first_seq = first_seq
+
+
+class Handover(object):
+    """
+    The pending messages of a topic given to the delivery workers of its subscribers.
+    Each worker calls done() for each message it delivered or dropped; after the last one,
+    on_done is called with the topic and the messages, so that a durable storage only
+    forgets them once they have been delivered.
+    """
+    def __init__(self, topic, messages, count, on_done):
+        self.topic = topic
+        self.messages = messages
+        self.remaining = count
+        self.on_done = on_done
+        self.lock = threading.Lock()
+
+    def done(self, count=1):
+        with self.lock:
+            self.remaining -= count
+            finished = self.remaining == 0
+        if finished:
+            self.on_done(self.topic, self.messages)
+
+
+class MessageRing(object):
+    """
+    Ring buffer of the pending messages of a topic, numbered with sequence numbers.
+    Messages are appended at the tail; acknowledging advances the head to a sequence number.
+    Both are O(1) per message. The buffer doubles in size when it is full.
+    """
+    def __init__(self, capacity=64):
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.buffer = [None] * size
+        self.mask = size - 1
+        self.head = 0   # sequence number of the oldest pending message
+        self.tail = 0   # sequence number of the next message
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, message):
+        if self.tail - self.head > self.mask:
+            self._grow()
+        self.buffer[self.tail & self.mask] = message
+        self.tail += 1
+        return self.tail - 1
+
+    def _grow(self):
+        # a new list, so that views of the old one stay valid
+        buffer = [None] * (2 * len(self.buffer))
+        mask = len(buffer) - 1
+        for seq in range(self.head, self.tail):
+            buffer[seq & mask] = self.buffer[seq & self.mask]
+        self.buffer = buffer
+        self.mask = mask
+
+    def pending(self, count=None):
+        """The pending messages, or the oldest count of them."""
+        end = self.tail if count is None else min(self.tail, self.head + count)
+        return PendingMessages(self.buffer, self.mask, self.head, end)
+
+    def detach(self, count=None):
+        """
+        Take the pending messages, or the oldest count of them, out of the ring. Unless fewer
+        are taken than left, the ring moves the others to a new buffer and the view of the
+        old one is returned, so the messages taken are not copied.
+        """
+        end = self.tail if count is None else min(self.tail, self.head + count)
+        if self.tail - end > end - self.head:
+            taken = list(self.pending(end - self.head))
+            self.acknowledge(end)
+            return taken
+        taken = PendingMessages(self.buffer, self.mask, self.head, end)
+        buffer = [None] * len(self.buffer)
+        for seq in range(end, self.tail):
+            buffer[seq & self.mask] = self.buffer[seq & self.mask]
+        self.buffer = buffer
+        self.head = end
+        return taken
+
+    def acknowledge(self, seq):
+        """Drop the messages before sequence number seq."""
+        seq = min(seq, self.tail)
+        while self.head < seq:
+            self.buffer[self.head & self.mask] = None
+            self.head += 1
+
+
+class QueueLimit(object):
+    """
+    Bounds of a message queue, in messages and in bytes (of the pickled message), and the
+    policy for a message which does not fit:
+
+    - "block": the producer waits until there is room, or timeout seconds after which the
+      message is dropped
+    - "drop_oldest": the oldest queued messages are dropped to make room
+    - "drop_newest": the new message is dropped
+    - "latest": a queued message with the same key as the new one is replaced by it, otherwise
+      the oldest are dropped. key is the name of an item of the message data, or a function
+      of the message data
+    - "spill": the messages which do not fit are written to a file in spill_dir and read back,
+      in order, when there is room again
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    LATEST = "latest"
+    SPILL = "spill"
+    policies = (BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST, SPILL)
+
+    def __init__(self, max_messages=None, max_bytes=None, policy="drop_oldest", key=None,
+                 timeout=None, spill_dir=None):
+        if policy not in self.policies:
+            raise ValueError("invalid overflow policy: %r" % policy)
+        if policy == self.LATEST and key is None:
+            raise ValueError("the latest policy needs a key")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.key = key
+        self.timeout = timeout
+        self.spill_dir = spill_dir
+
+    def __repr__(self):
+        return "<QueueLimit %s messages=%s bytes=%s>" % (self.policy, self.max_messages, self.max_bytes)
+
+    def size(self, message):
+        if self.max_bytes is None:
+            return 0
+        return len(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def key_of(self, message):
+        if self.policy != self.LATEST:
+            return None
+        if callable(self.key):
+            return self.key(message.data)
+        try:
+            return message.data[self.key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def exceeded(self, count, nbytes):
+        return ((self.max_messages is not None and count > self.max_messages) or
+                (self.max_bytes is not None and nbytes > self.max_bytes))
+
+
+class SpillFile(object):
+    """
+    Items pickled to a temporary file and read back first in, first out.
+    The file is emptied whenever everything has been read back.
+    """
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(prefix="messagebus-", dir=directory)
+        self.read_pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.file.seek(0, os.SEEK_END)
+        pickle.dump(item, self.file, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def popleft(self):
+        self.file.seek(self.read_pos)
+        item = pickle.load(self.file)
+        self.count -= 1
+        if self.count:
+            self.read_pos = self.file.tell()
+        else:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_pos = 0
+        return item
+
+    def close(self):
+        self.file.close()
+
+
+class BoundedQueue(object):
+    """
+    Queue of (topic, message) within the bounds of a QueueLimit. Like MessageRing, the messages
+    are numbered with sequence numbers, so MemoryStorage can use either for a topic.
+    Messages taken for delivery count as queued until done() is called.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = deque()      # [seq, topic, message, size, key, time queued]
+        self.keys = {}              # (topic, key) -> entry, for the latest policy
+        self.spill = None           # SpillFile of the messages beyond the bounds
+        self.head = 0               # sequence number of the oldest message
+        self.tail = 0               # sequence number of the next message
+        self.nbytes = 0
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.counters = defaultdict(int)
+        self.on_drop = None         # called with each message dropped or replaced
+
+    def __len__(self):
+        return len(self.entries) + (len(self.spill) if self.spill else 0)
+
+    def _dropped(self, message):
+        if self.on_drop is not None:
+            self.on_drop(message)
+
+    def room(self, size=0):
+        """Whether a message of size bytes fits."""
+        return not self.limit.exceeded(len(self.entries) + self.in_flight + 1,
+                                       self.nbytes + self.in_flight_bytes + size)
+
+    def free(self):
+        """Number of messages which fit, or None if only the bytes are bounded and one fits."""
+        if not self.room():
+            return 0
+        if self.limit.max_messages is None:
+            return None
+        return self.limit.max_messages - len(self.entries) - self.in_flight
+
+    def wait_for_room(self, condition):
+        """
+        For the block policy, wait on condition until there is room or the limit's timeout.
+        return:
+            - bool: False when the timeout expired
+        """
+        if self.limit.policy != QueueLimit.BLOCK or self.room():
+            return True
+        self.counters["blocked"] += 1
+        deadline = None if self.limit.timeout is None else time.time() + self.limit.timeout
+        while not self.room():
+            if deadline is None:
+                condition.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.counters["block_timeouts"] += 1
+                    return False
+                condition.wait(remaining)
+        return True
+
+    def append(self, message):
+        return self.put(None, message)
+
+    def put(self, topic, message, queued=None):
+        """
+        Queue a message according to the policy; with the block policy the caller is expected
+        to have waited for room.
+        return:
+            - bool: False when the message was dropped
+        """
+        limit = self.limit
+        queued = time.time() if queued is None else queued
+        size = limit.size(message)
+        key = limit.key_of(message)
+        if key is not None:
+            entry = self.keys.get((topic, key))
+            if entry is not None:
+                self.nbytes += size - entry[3]
+                self._dropped(entry[2])
+                entry[2] = message
+                entry[3] = size
+                self.counters["replaced"] += 1
+                return True
+        if limit.policy == QueueLimit.SPILL and (self.spill or not self.room(size)):
+            if self.spill is None:
+                self.spill = SpillFile(limit.spill_dir)
+            self.spill.append((self.tail, topic, message, queued))
+            self.tail += 1
+            self.counters["spilled"] += 1
+            return True
+        if limit.policy == QueueLimit.DROP_NEWEST and not self.room(size):
+            self.counters["dropped_newest"] += 1
+            self._dropped(message)
+            return False
+        self._add([self.tail, topic, message, size, key, queued])
+        self.tail += 1
+        if limit.policy in (QueueLimit.DROP_OLDEST, QueueLimit.LATEST):
+            while self.entries and self.limit.exceeded(len(self.entries) + self.in_flight,
+                                                       self.nbytes + self.in_flight_bytes):
+                self._dropped(self._pop()[2])
+                self.counters["dropped_oldest"] += 1
+        return True
+
+    def _add(self, entry):
+        self.entries.append(entry)
+        self.nbytes += entry[3]
+        if entry[4] is not None:
+            self.keys[(entry[1], entry[4])] = entry
+
+    def _pop(self):
+        entry = self.entries.popleft()
+        self.nbytes -= entry[3]
+        if entry[4] is not None:
+            self.keys.pop((entry[1], entry[4]), None)
+        self.head = entry[0] + 1
+        return entry
+
+    def _unspill(self):
+        while self.spill and self.room():
+            seq, topic, message, queued = self.spill.popleft()
+            self._add([seq, topic, message, self.limit.size(message), None, queued])
+            self.counters["unspilled"] += 1
+
+    def pending(self, count=None):
+        """
+        The messages in memory, or the oldest count of them, oldest first;
+        acknowledge(last_seq + 1) removes them.
+        """
+        entries = list(self.entries) if count is None else list(islice(self.entries, count))
+        return PendingBatch([entry[2] for entry in entries],
+                            entries[-1][0] if entries else self.head - 1)
+
+    def acknowledge(self, seq):
+        """Drop the messages before sequence number seq."""
+        while self.entries and self.entries[0][0] < seq:
+            self._pop()
+        self._unspill()
+
+    def take(self):
+        """
+        Take the oldest messages which have the same topic for delivery, at most as many as
+        the limit allows (but at least one).
+        return:
+            - tuple: topic, list of messages, time the first was queued
+        """
+        first = self._pop()
+        topic, messages = first[1], [first[2]]
+        self.in_flight_bytes = first[3]
+        while self.entries and self.entries[0][1] == topic and \
+                not self.limit.exceeded(len(messages) + 1, self.in_flight_bytes + self.entries[0][3]):
+            entry = self._pop()
+            messages.append(entry[2])
+            self.in_flight_bytes += entry[3]
+        self.in_flight = len(messages)
+        return topic, messages, first[5]
+
+    def done(self):
+        """The messages taken have been delivered."""
+        self.in_flight = self.in_flight_bytes = 0
+        self._unspill()
+
+    def set_limit(self, limit):
+        """Change the bounds and policy, applying them to the queued messages."""
+        self.limit = limit
+        entries = list(self.entries)
+        if self.spill:
+            while self.spill:
+                seq, topic, message, queued = self.spill.popleft()
+                entries.append([seq, topic, message, 0, None, queued])
+        on_drop, self.on_drop = self.on_drop, None
+        self.clear()
+        self.on_drop = on_drop
+        for seq, topic, message, size, key, queued in entries:
+            self.tail = seq
+            self.put(topic, message, queued)
+        self.tail = entries[-1][0] + 1 if entries else self.tail
+        self.head = self.entries[0][0] if self.entries else self.tail
+
+    def clear(self):
+        if self.on_drop is not None:
+            for entry in self.entries:
+                self.on_drop(entry[2])
+            while self.spill:
+                self.on_drop(self.spill.popleft()[2])
+        self.entries.clear()
+        self.keys.clear()
+        self.nbytes = 0
+        self.head = self.tail
+        if self.spill:
+            self.spill.close()
+        self.spill = None
+
+    def stats(self):
+        stats = {
+            "queued": len(self),
+            "bytes": self.nbytes,
+            "on_disk": len(self.spill) if self.spill else 0,
+        }
+        for name in ("replaced", "spilled", "unspilled", "dropped_newest", "dropped_oldest",
+                     "blocked", "block_timeouts"):
+            stats[name] = self.counters[name]
+        return stats
+
+
 class MemoryStorage(object):
     """
     Storage implementation that just uses in-memory dicts. It is very fast.
     Stopping the message bus server will make it instantly forget about every topic and pending messages.
+    The pending messages of a topic are kept in a MessageRing, so acknowledging delivered messages
+    costs the same however long the backlog is, or in a BoundedQueue if the topic has a QueueLimit.
+    The messages are forgotten as soon as they are given to the delivery workers.
     """
-    def __init__(self):
-        self.messages = {}      # topic -> list of pending messages
+    durable = False
+    topic_limits = True
+
+    def __init__(self, limit=None):
+        """
+        kwargs:
+            - limit (QueueLimit): Bounds of the pending messages of each new topic (None)
+        """
+        self.messages = {}      # topic -> MessageRing or BoundedQueue of pending messages
         self.subscribers = {}   # topic -> set of subscribers
         self.proxy_cache = {}
         self.total_msg_count = 0
+        self.limit = limit
 
     def topics(self):
         return self.messages.keys()
@@ -135,13 +607,44 @@ class MemoryStorage(object):
     def create_topic(self, topic):
         if topic in self.messages:
             return
-        self.messages[topic] = []
+        self.messages[topic] = MessageRing() if self.limit is None else BoundedQueue(self.limit)
         self.subscribers[topic] = set()
 
+    def set_limit(self, topic, limit):
+        """Bound the pending messages of a topic; a limit of None removes the bounds."""
+        self.create_topic(topic)
+        old = self.messages[topic]
+        if limit is not None and isinstance(old, BoundedQueue):
+            old.set_limit(limit)
+            return
+        new = MessageRing() if limit is None else BoundedQueue(limit)
+        while len(old):
+            pending = old.pending()
+            for message in pending:
+                new.append(message)
+            old.acknowledge(old.head + len(pending))
+        self.messages[topic] = new
+
+    def wait_for_room(self, topic, condition):
+        """
+        Wait on condition until a message fits in the pending messages of a topic with
+        the block policy. Returns False when the wait timed out.
+        """
+        pending = self.messages.get(topic)
+        if isinstance(pending, BoundedQueue):
+            return pending.wait_for_room(condition)
+        return True
+
+    def queue_stats(self):
+        return {topic: pending.stats() for topic, pending in self.messages.items()
+                if isinstance(pending, BoundedQueue)}
+
     def remove_topic(self, topic):
         if topic not in self.messages:
             return
-        del self.messages[topic]
+        pending = self.messages.pop(topic)
+        if isinstance(pending, BoundedQueue):
+            pending.clear()
         for sub in self.subscribers.get(topic, set()):
             if hasattr(sub, "_pyroRelease"):
                 sub._pyroRelease()
@@ -164,6 +667,7 @@ class MemoryStorage(object):
             subscriber = self.proxy_cache.get(subscriber._pyroUri, subscriber)
             self.proxy_cache[subscriber._pyroUri] = subscriber
         self.subscribers[topic].add(subscriber)
+        return subscriber
 
     def remove_subscriber(self, topic, subscriber):
         if subscriber in self.subscribers[topic]:
@@ -179,10 +683,23 @@ class MemoryStorage(object):
             self.subscribers[topic].discard(subscriber)
 
     def all_pending_messages(self):
-        return {topic: list(msgs) for topic, msgs in self.messages.items()}
+        return self.pending_messages(self.messages)
+
+    def pending_messages(self, topics, counts=None):
+        """
+        The pending messages of the topics; counts maps a topic to the max number of
+        messages to return for it.
+        """
+        counts = counts or {}
+        pending = {}
+        for topic in topics:
+            ring = self.messages.get(topic)
+            if ring is not None and len(ring):
+                pending[topic] = ring.pending(counts.get(topic))
+        return pending
 
     def has_pending_messages(self, topic):
-        return topic in self.messages and any(self.messages[topic])
+        return topic in self.messages and len(self.messages[topic]) > 0
 
     def has_subscribers(self, topic):
         return topic in self.subscribers and any(self.subscribers[topic])
@@ -193,15 +710,45 @@ class MemoryStorage(object):
             all_subs[topic] = set(subs)
         return all_subs
 
+    def acknowledge(self, topic, seq):
+        """Drop the pending messages of a topic before sequence number seq."""
+        if topic in self.messages:
+            self.messages[topic].acknowledge(seq)
+
+    def take(self, topics_messages):
+        """
+        The pending messages are given to the delivery workers; they are not kept.
+        return:
+            - dict: topic -> the messages, which the storage no longer changes
+        """
+        taken = {}
+        for topic, messages in topics_messages.items():
+            ring = self.messages.get(topic)
+            if isinstance(messages, PendingMessages) and isinstance(ring, MessageRing):
+                taken[topic] = ring.detach(len(messages))
+            else:
+                self.remove_messages({topic: messages})
+                taken[topic] = messages
+        return taken
+
     def remove_messages(self, topics_messages):
-        for topic in topics_messages:
-            if topic in self.messages:
-                msg_list = self.messages[topic]
-                for message in topics_messages[topic]:
-                    try:
-                        msg_list.remove(message)
-                    except ValueError:
-                        pass
+        for topic, messages in topics_messages.items():
+            if topic not in self.messages:
+                continue
+            ring = self.messages[topic]
+            if isinstance(messages, PendingMessages):
+                ring.acknowledge(messages.end_seq)
+            elif isinstance(messages, PendingBatch):
+                ring.acknowledge(messages.last_seq + 1)
+            else:
+                # a list of messages, which were the oldest pending ones
+                msgids = set(message.msgid for message in messages)
+                count = 0
+                for message in ring.pending():
+                    if message.msgid not in msgids:
+                        break
+                    count += 1
+                ring.acknowledge(ring.head + count)
 
     def stats(self):
         subscribers = pending = 0
@@ -217,25 +764,50 @@ class SqliteStorage(object):
     Storage implementation that uses a sqlite database to store the messages and subscribers.
     It is a lot slower than the in-memory storage, but no data is lost if the messagebus dies.
     If you restart it, it will also reconnect to the subscribers and carry on from where it stopped.
+
+    The database is in WAL mode. Topic ids and whether topics have subscribers are cached.
+    Messages are committed by a writer thread in groups: add_message queues the message and
+    returns a future which is done when the message is committed, so messages sent at about the
+    same time share one commit. Timestamps are stored as integer microseconds and the messages
+    are numbered, so delivered messages are deleted by range.
+
+    The messages given to the delivery workers (take) are not read again, but they are only
+    deleted once every subscriber has had them (remove_messages), so the messages which were
+    not delivered before a restart are delivered after it.
     """
     dbconnections = {}
+    durable = True
+    topic_limits = False
 
-    def __init__(self):
+    def __init__(self, path="messages.sqlite", commit_window=0.0, max_batch=10000, synchronous="NORMAL"):
+        """
+        kwargs:
+            - path (str): The database file ("messages.sqlite")
+            - commit_window (float): Seconds to wait for more messages before a commit (0). Messages
+                which arrive during a commit are committed together by the next one anyway.
+            - max_batch (int): Max number of pending messages read for a topic at a time (10000)
+            - synchronous (str): sqlite synchronous setting; "FULL" also survives power loss ("NORMAL")
+        """
+        self.path = os.path.abspath(path)
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.synchronous = synchronous
         conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
         conn.execute("""
 CREATE TABLE IF NOT EXISTS Topic (
   id  INTEGER PRIMARY KEY,
   topic  NVARCHAR(500) UNIQUE NOT NULL
 ); """)
         conn.execute("""
-CREATE TABLE IF NOT EXISTS Message(
-  id  CHAR(36) PRIMARY KEY,
-  created  DATETIME NOT NULL,
+CREATE TABLE IF NOT EXISTS PendingMessage(
+  seq  INTEGER PRIMARY KEY AUTOINCREMENT,
+  id  CHAR(36) NOT NULL,
+  created  INTEGER NOT NULL,
   topic  INTEGER NOT NULL,
   msgdata  BLOB NOT NULL,
   FOREIGN KEY(topic) REFERENCES Topic(id)
 ); """)
+        conn.execute("CREATE INDEX IF NOT EXISTS PendingMessageTopic ON PendingMessage(topic, seq)")
         conn.execute("""
 CREATE TABLE IF NOT EXISTS Subscription(
   id  INTEGER PRIMARY KEY,
@@ -244,45 +816,130 @@ CREATE TABLE IF NOT EXISTS Subscription(
   FOREIGN KEY(topic) REFERENCES Topic(id)
 ); """)
         conn.commit()
+        self._migrate(conn)
         self.proxy_cache = {}
         self.total_msg_count = 0
+        self.topic_ids = dict(conn.execute("SELECT topic, id FROM Topic").fetchall())
+        self.subscription_counts = defaultdict(int, conn.execute(
+            "SELECT topic, COUNT(*) FROM Subscription GROUP BY topic").fetchall())
+        self.taken = {}     # topic id -> seq of the last message given to the delivery workers
+        self.write_queue = []       # (row, future) waiting to be committed
+        self.writing = False
+        self.write_condition = threading.Condition()
+        # opened here, so that it exists before add_message returns a future
+        self.writer_conn = self.connect(check_same_thread=False)
+        self.writer = threading.Thread(target=self.__writer, name="messagebus.sqlite.writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _migrate(self, conn):
+        # move the pending messages of a database made by the older version of this class
+        if not conn.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type='table' AND name='Message')").fetchone()[0]:
+            return
+        # in the order they were published, which the sequence numbers of PendingMessage keep
+        rows = conn.execute("SELECT id, created, topic, msgdata FROM Message ORDER BY created, rowid").fetchall()
+        conn.executemany("INSERT INTO PendingMessage(id, created, topic, msgdata) VALUES (?,?,?,?)",
+                         [(msgid, self.to_timestamp(self.parse_created(created)), topic, msgdata)
+                          for msgid, created, topic, msgdata in rows])
+        conn.execute("DROP TABLE Message")
+        conn.commit()
+        log.info("moved %d pending message(s) to the PendingMessage table", len(rows))
+
+    @staticmethod
+    def parse_created(created):
+        # str() of a datetime leaves out the microseconds when they are 0
+        try:
+            return datetime.datetime.strptime(created, "%Y-%m-%d %H:%M:%S.%f")
+        except ValueError:
+            return datetime.datetime.strptime(created, "%Y-%m-%d %H:%M:%S")
+
+    @staticmethod
+    def to_timestamp(created):
+        delta = created - datetime.datetime(1970, 1, 1)
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    @staticmethod
+    def from_timestamp(timestamp):
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=timestamp)
 
     def dbconn(self):
         # return the db-connection for the current thread
         thread = threading.current_thread()
         try:
-            return self.dbconnections[thread]
+            return self.dbconnections[(self.path, thread)]
         except KeyError:
-            conn = sqlite3.connect("messages.sqlite", detect_types=sqlite3.PARSE_DECLTYPES)
-            self.dbconnections[thread] = conn
+            conn = self.connect()
+            self.dbconnections[(self.path, thread)] = conn
             return conn
 
+    def connect(self, check_same_thread=True):
+        conn = sqlite3.connect(self.path, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def __writer(self):
+        # this runs in a thread, to commit the queued messages in groups
+        conn = self.writer_conn
+        while True:
+            with self.write_condition:
+                while not self.write_queue:
+                    self.write_condition.wait()
+            if self.commit_window:
+                time.sleep(self.commit_window)
+            with self.write_condition:
+                queued, self.write_queue = self.write_queue, []
+                self.writing = True
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO PendingMessage(id, created, topic, msgdata) VALUES (?,?,?,?)",
+                                     [row for row, future in queued])
+            except Exception as x:
+                log.exception("cannot store %d message(s)", len(queued))
+                for row, future in queued:
+                    future.set_exception(x)
+            else:
+                for row, future in queued:
+                    future.set_result(None)
+            with self.write_condition:
+                self.writing = False
+                self.write_condition.notify_all()
+
+    def flush(self):
+        """Wait until the queued messages are committed."""
+        with self.write_condition:
+            while self.write_queue or self.writing:
+                self.write_condition.notify_all()
+                self.write_condition.wait(0.1)
+
     def topics(self):
-        conn = self.dbconn()
-        with closing(conn.cursor()) as cursor:
-            return [r[0] for r in cursor.execute("SELECT topic FROM Topic").fetchall()]
+        return list(self.topic_ids)
 
     def create_topic(self, topic):
+        if topic in self.topic_ids:
+            return
         conn = self.dbconn()
         with closing(conn.cursor()) as cursor:
-            if not cursor.execute("SELECT EXISTS(SELECT 1 FROM Topic WHERE topic=?)", [topic]).fetchone()[0]:
-                cursor.execute("INSERT INTO Topic(topic) VALUES(?)", [topic])
+            cursor.execute("INSERT INTO Topic(topic) VALUES(?)", [topic])
+            self.topic_ids[topic] = cursor.lastrowid
         conn.commit()
 
     def remove_topic(self, topic):
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            return
+        self.flush()
         conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
         with closing(conn.cursor()) as cursor:
-            topic_id = cursor.execute("SELECT id FROM Topic WHERE topic=?", [topic]).fetchone()
-            if not topic_id:
-                return
-            else:
-                topic_id = topic_id[0]
             sub_uris = [r[0] for r in cursor.execute("SELECT subscriber FROM Subscription WHERE topic=?", [topic_id]).fetchall()]
             cursor.execute("DELETE FROM Subscription WHERE topic=?", [topic_id])
-            cursor.execute("DELETE FROM Message WHERE topic=?", [topic_id])
+            cursor.execute("DELETE FROM PendingMessage WHERE topic=?", [topic_id])
             cursor.execute("DELETE FROM Topic WHERE id=?", [topic_id])
         conn.commit()
+        del self.topic_ids[topic]
+        self.subscription_counts.pop(topic_id, None)
+        self.taken.pop(topic_id, None)
         for uri in sub_uris:
             try:
                 proxy = self.proxy_cache[uri]
@@ -292,45 +949,54 @@ CREATE TABLE IF NOT EXISTS Subscription(
                 pass
 
     def add_message(self, topic, message):
+        """
+        Queue a message to be committed.
+
+        return:
+            - concurrent.futures.Future: Done when the message is committed, or None if the
+                topic has no subscribers and the message was discarded
+        """
+        try:
+            topic_id = self.topic_ids[topic]
+        except KeyError:
+            raise KeyError(topic)
+        self.total_msg_count += 1
+        if not self.subscription_counts[topic_id]:
+            # no subscriber for this topic, just discard the message
+            return None
         msg_data = pickle.dumps(message.data, pickle.HIGHEST_PROTOCOL)
         if sys.version_info < (3, 0):
-            blob_data = buffer(msg_data)
-        else:
-            blob_data = msg_data
-        conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
-        with closing(conn.cursor()) as cursor:
-            res = cursor.execute("SELECT id FROM Topic WHERE topic=?", [topic]).fetchone()
-            if not res:
-                raise KeyError(topic)
-            topic_id = res[0]
-            if cursor.execute("SELECT EXISTS(SELECT 1 FROM Subscription WHERE topic=?)", [topic_id]).fetchone()[0]:
-                # there is at least one subscriber for this topic, insert the message (otherwise just discard it)
-                cursor.execute("INSERT INTO Message(id, created, topic, msgdata) VALUES (?,?,?,?)",
-                               [str(message.msgid), message.created, topic_id, blob_data])
-        conn.commit()
-        self.total_msg_count += 1
+            msg_data = buffer(msg_data)
+        future = concurrent.futures.Future()
+        row = (str(message.msgid), self.to_timestamp(message.created), topic_id, msg_data)
+        with self.write_condition:
+            self.write_queue.append((row, future))
+            self.write_condition.notify_all()
+        return future
 
     def add_subscriber(self, topic, subscriber):
         if not hasattr(subscriber, "_pyroUri"):
             raise ValueError("can only store subscribers that are a Pyro proxy")
         uri = subscriber._pyroUri.asString()
+        topic_id = self.topic_ids[topic]
         conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
         with closing(conn.cursor()) as cursor:
-            topic_id = cursor.execute("SELECT id FROM Topic WHERE topic=?", [topic]).fetchone()[0]
             if not cursor.execute("SELECT EXISTS(SELECT 1 FROM Subscription WHERE topic=? AND subscriber=?)", [topic_id, uri]).fetchone()[0]:
                 cursor.execute("INSERT INTO Subscription(topic, subscriber) VALUES (?,?)", [topic_id, uri])
+                self.subscription_counts[topic_id] += 1
         self.proxy_cache[uri] = subscriber
         conn.commit()
+        return subscriber
 
     def remove_subscriber(self, topic, subscriber):
-        conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
         uri = subscriber._pyroUri.asString()
-        with closing(conn.cursor()) as cursor:
-            cursor.execute("DELETE FROM Subscription WHERE topic=(SELECT id FROM Topic WHERE topic=?) AND subscriber=?", [topic, uri])
-        conn.commit()
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is not None:
+            conn = self.dbconn()
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("DELETE FROM Subscription WHERE topic=? AND subscriber=?", [topic_id, uri])
+                self.subscription_counts[topic_id] -= cursor.rowcount
+            conn.commit()
         try:
             proxy = self.proxy_cache[uri]
             proxy._pyroRelease()
@@ -339,34 +1005,62 @@ CREATE TABLE IF NOT EXISTS Subscription(
             pass
 
     def all_pending_messages(self):
+        return self.pending_messages(list(self.topic_ids))
+
+    def pending_messages(self, topics, counts=None):
+        counts = counts or {}
         conn = self.dbconn()
+        result = {}
         with closing(conn.cursor()) as cursor:
-            msgs = cursor.execute("SELECT t.topic, m.id, m.created, m.msgdata FROM Message AS m, Topic as t WHERE m.topic=t.id").fetchall()
-        result = defaultdict(list)
-        for msg in msgs:
-            if sys.version_info < (3, 0):
-                blob_data = str(msg[3])
-            else:
-                blob_data = msg[3]
-            result[msg[0]].append(Message(uuid.UUID(msg[1]), datetime.datetime.strptime(msg[2], "%Y-%m-%d %H:%M:%S.%f"), pickle.loads(blob_data)))
+            for topic in topics:
+                topic_id = self.topic_ids.get(topic)
+                if topic_id is None:
+                    continue
+                msgs = cursor.execute("SELECT seq, id, created, msgdata FROM PendingMessage WHERE topic=? AND seq > ? "
+                                      "ORDER BY seq LIMIT ?",
+                                      [topic_id, self.taken.get(topic_id, 0),
+                                       min(self.max_batch, counts.get(topic, self.max_batch))]).fetchall()
+                if not msgs:
+                    continue
+                if sys.version_info < (3, 0):
+                    loads = lambda blob_data: pickle.loads(str(blob_data))
+                else:
+                    loads = pickle.loads
+                result[topic] = PendingBatch([Message(uuid.UUID(msgid), self.from_timestamp(created), loads(msgdata))
+                                              for seq, msgid, created, msgdata in msgs],
+                                             msgs[-1][0], msgs[0][0])
         return result
 
+    def take(self, topics_messages):
+        """
+        The pending messages are given to the delivery workers; pending_messages skips them.
+        return:
+            - dict: topic -> the messages, which are already read from the database
+        """
+        for topic, messages in topics_messages.items():
+            topic_id = self.topic_ids.get(topic)
+            if isinstance(messages, PendingBatch) and topic_id is not None:
+                self.taken[topic_id] = max(self.taken.get(topic_id, 0), messages.last_seq)
+        return topics_messages
+
     def has_pending_messages(self, topic):
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            return False
         conn = self.dbconn()
         with closing(conn.cursor()) as cursor:
-            return cursor.execute("SELECT EXISTS(SELECT 1 FROM Message WHERE topic=(SELECT id FROM Topic WHERE topic=?))", [topic]).fetchone()[0]
+            return cursor.execute("SELECT EXISTS(SELECT 1 FROM PendingMessage WHERE topic=?)", [topic_id]).fetchone()[0]
 
     def has_subscribers(self, topic):
-        conn = self.dbconn()
-        with closing(conn.cursor()) as cursor:
-            return cursor.execute("SELECT EXISTS(SELECT 1 FROM Subscription WHERE topic=(SELECT id FROM Topic WHERE topic=?))", [topic]).fetchone()[0]
+        topic_id = self.topic_ids.get(topic)
+        return topic_id is not None and self.subscription_counts[topic_id] > 0
 
     def all_subscribers(self):
         conn = self.dbconn()
         with closing(conn.cursor()) as cursor:
-            result = cursor.execute("SELECT s.id, t.topic, s.subscriber FROM Subscription AS s, Topic AS t WHERE t.id=s.topic").fetchall()
+            result = cursor.execute("SELECT s.id, t.topic, s.topic, s.subscriber FROM Subscription AS s, Topic AS t WHERE t.id=s.topic").fetchall()
             subs = defaultdict(list)
-            for sub_id, topic, uri in result:
+            for sub_id, topic, topic_id, uri in result:
                 if uri in self.proxy_cache:
                     proxy = self.proxy_cache[uri]
                     subs[topic].append(proxy)
@@ -376,6 +1070,7 @@ CREATE TABLE IF NOT EXISTS Subscription(
                     except Exception:
                         log.exception("Cannot create pyro proxy, sub_id=%d, uri=%s", sub_id, uri)
                         cursor.execute("DELETE FROM Subscription WHERE id=?", [sub_id])
+                        self.subscription_counts[topic_id] -= 1
                     else:
                         self.proxy_cache[uri] = proxy
                         subs[topic].append(proxy)
@@ -385,22 +1080,189 @@ CREATE TABLE IF NOT EXISTS Subscription(
     def remove_messages(self, topics_messages):
         if not topics_messages:
             return
-        all_guids = [[str(message.msgid)] for msglist in topics_messages.values() for message in msglist]
+        ranges = []
+        all_guids = []
+        for topic, messages in topics_messages.items():
+            if isinstance(messages, PendingBatch) and topic in self.topic_ids:
+                first_seq = 0 if messages.first_seq is None else messages.first_seq
+                ranges.append([self.topic_ids[topic], first_seq, messages.last_seq])
+            else:
+                all_guids.extend([str(message.msgid)] for message in messages)
         conn = self.dbconn()
-        conn.execute("PRAGMA foreign_keys=ON")
         with closing(conn.cursor()) as cursor:
-            cursor.executemany("DELETE FROM Message WHERE id = ?", all_guids)
+            cursor.executemany("DELETE FROM PendingMessage WHERE topic=? AND seq BETWEEN ? AND ?", ranges)
+            cursor.executemany("DELETE FROM PendingMessage WHERE id = ?", all_guids)
         conn.commit()
 
+    def set_limit(self, topic, limit):
+        raise TypeError("the sqlite storage keeps the pending messages on disk, it has no topic limits")
+
+    def wait_for_room(self, topic, condition):
+        return True
+
+    def queue_stats(self):
+        return {}
+
     def stats(self):
         conn = self.dbconn()
         with closing(conn.cursor()) as cursor:
-            topics = cursor.execute("SELECT COUNT(*) FROM Topic").fetchone()[0]
+            topics = len(self.topic_ids)
             subscribers = cursor.execute("SELECT COUNT(*) FROM Subscription").fetchone()[0]
-            pending = cursor.execute("SELECT COUNT(*) FROM Message").fetchone()[0]
+            pending = cursor.execute("SELECT COUNT(*) FROM PendingMessage").fetchone()[0]
             return topics, subscribers, pending, self.total_msg_count
 
 
+class DeliveryWorker(object):
+    """
+    Delivers the messages for one subscriber from a thread of its own, so that a slow or
+    dead subscriber only delays itself. Messages are delivered in the order they were queued,
+    the consecutive ones of a topic in one call, which keeps the order of the messages of each topic.
+    The queue is a BoundedQueue; by default at most max_in_flight messages wait for delivery
+    and beyond that the oldest are dropped. With the block policy, on_room is called whenever
+    a delivery makes room, for the bus holds back the messages while the queue is full.
+    The messages put with a Handover are reported to it when they are delivered or dropped.
+    """
+    def __init__(self, subscriber, on_error, max_in_flight=10000, limit=None, on_room=None):
+        self.subscriber = subscriber
+        self.on_error = on_error    # called with the subscriber when delivery fails
+        self.on_room = on_room
+        if limit is None:
+            limit = QueueLimit(max_messages=max_in_flight)
+        self.queue = BoundedQueue(limit)
+        self.queue.on_drop = self._finished
+        self.handovers = {}         # msgid -> Handover of the messages queued or in flight
+        self.finished = []          # Handovers to report to, outside the lock
+        self.running = True
+        self.condition = threading.Condition()
+        self.counters = defaultdict(int)
+        self.latency_max = 0.0
+        self.thread = threading.Thread(target=self.__deliver, name="messagebus.delivery")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, topic, messages, handover=None):
+        with self.condition:
+            if not self.running:
+                if handover is not None:
+                    self.finished.append((handover, len(messages)))
+                messages = ()
+            counters = self.queue.counters
+            dropped = -(counters["dropped_oldest"] + counters["dropped_newest"])
+            queued = time.time()
+            for message in messages:
+                if handover is not None:
+                    self.handovers[message.msgid] = handover
+                self.queue.put(topic, message, queued)
+            dropped += counters["dropped_oldest"] + counters["dropped_newest"]
+            if dropped:
+                log.warning("subscriber %s is too slow, dropped %d message(s)", self.subscriber, dropped)
+            self.condition.notify()
+        self._report()
+
+    def _finished(self, message):
+        # a message was delivered or dropped; called with the condition held
+        handover = self.handovers.pop(message.msgid, None)
+        if handover is not None:
+            self.finished.append((handover, 1))
+
+    def _report(self):
+        # tell the Handovers about the finished messages, without holding the condition
+        with self.condition:
+            finished, self.finished = self.finished, []
+        for handover, count in finished:
+            handover.done(count)
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.queue.set_limit(limit)
+        self._report()
+
+    def room(self):
+        """
+        How many messages the bus may hand over: None if there is no bound, which is the case
+        unless the queue has the block policy, see BoundedQueue.free.
+        """
+        with self.condition:
+            if self.queue.limit.policy != QueueLimit.BLOCK:
+                return None
+            return self.queue.free()
+
+    def idle(self):
+        with self.condition:
+            return not len(self.queue) and not self.queue.in_flight
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.queue.clear()
+            self.condition.notify()
+        self._report()
+
+    def __deliver(self):
+        # this runs in a thread, to send the queued messages to the subscriber
+        while True:
+            with self.condition:
+                while self.running and not len(self.queue):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                topic, messages, queued_time = self.queue.take()
+            start = time.time()
+            try:
+                try:
+                    # send the batch of messages pending for this topic in one go
+                    self.subscriber.incoming_messages(topic, messages)
+                except Pyro4.errors.MessageTooLargeError:
+                    # the batch doesn't fit in the configured max msg size, send them one by one instead
+                    for message in messages:
+                        self.subscriber.incoming_message(topic, message)
+            except Exception as x:
+                # can't deliver them, drop the subscription
+                log.warning("error delivering message(s) for topic=%s, subscriber=%s, error=%r" % (topic, self.subscriber, x))
+                log.warning("removing subscription because of that error")
+                self.counters["errors"] += 1
+                self.stop()
+                self.on_error(self.subscriber)
+                return
+            finally:
+                with self.condition:
+                    self.queue.done()
+                    for message in messages:
+                        self._finished(message)
+                    blocking = self.queue.limit.policy == QueueLimit.BLOCK
+                self._report()
+            if blocking and self.on_room:
+                self.on_room()
+            now = time.time()
+            latency = now - queued_time
+            self.counters["calls"] += 1
+            self.counters["delivered"] += len(messages)
+            self.counters["call_time"] += now - start
+            self.counters["latency"] += latency * len(messages)
+            self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        """
+        Delivery counters, and those of the queue (see BoundedQueue.stats);
+        latency is from queueing to the end of the delivery call.
+        """
+        with self.condition:
+            stats = self.queue.stats()
+            stats.update({
+                "in_flight": self.queue.in_flight,
+                "calls": self.counters["calls"],
+                "delivered": self.counters["delivered"],
+                "dropped": stats["dropped_oldest"] + stats["dropped_newest"],
+                "errors": self.counters["errors"],
+                "latency_max": self.latency_max,
+            })
+        if stats["calls"]:
+            stats["call_time_mean"] = self.counters["call_time"] / stats["calls"]
+        if stats["delivered"]:
+            stats["latency_mean"] = self.counters["latency"] / stats["delivered"]
+        return stats
+
+
 def make_messagebus(clazz):
     if make_messagebus.storagetype == "sqlite":
         return clazz(storage=SqliteStorage())
@@ -416,19 +1278,54 @@ class MessageBus(object):
     """
     The MessageBus is the mechanism that allows for asynchronous relay of messages between
     Publisher and Subscriber. There can be many Subscribers for a single Publisher.
+
+    send() marks its topic as dirty and the sender thread only looks at the dirty topics.
+    The subscribers of each topic are kept in memory, updated by subscribe and unsubscribe,
+    so topics without new messages cost nothing.
+
+    The pending messages of a topic and the messages waiting for delivery to a subscriber can be
+    bounded with a QueueLimit, see set_topic_limit and set_subscriber_limit. With the block policy
+    send() waits for room in the topic, and the messages of a topic are held back while one of its
+    subscribers with the block policy is full, so a slow subscriber slows down the publishers.
+    Such a subscriber is only given as many messages as fit in its queue; the rest stay pending
+    in the topic. When it fails or unsubscribes, the topics held back for it are released.
+    Topic limits need a storage which supports them (MemoryStorage); set_topic_limit raises
+    TypeError otherwise.
+
+    With a durable storage (SqliteStorage) the messages stay in the storage until every subscriber
+    has had them, and the default limit of the subscribers has the block policy, so that messages
+    are held back in the storage rather than dropped.
     """
-    def __init__(self, storage=None):
+    def __init__(self, storage=None, max_in_flight=10000, subscriber_limit=None):
         """
         kwargs:
             - storange (storage object): The type of storage to use. If None is provided
                 then defaults to MemoryStorage.
+            - max_in_flight (int): Max number of messages waiting for delivery to one
+                subscriber (10000); beyond that the oldest are dropped, or held back in a
+                durable storage
+            - subscriber_limit (QueueLimit): Bounds of the messages waiting for delivery to
+                each subscriber, instead of max_in_flight (None)
         """
         if storage is None:
             storage = MemoryStorage()
         self.storage = storage     # topic -> list of pending messages
         log.info("using storage: %s", self.storage.__class__.__name__)
+        self.max_in_flight = max_in_flight
+        self.subscriber_limit = subscriber_limit
+        self.subscriber_limits = {}    # subscriber -> QueueLimit
+        self.workers = {}          # subscriber -> DeliveryWorker
+        self.workers_lock = threading.Lock()
         self.msg_lock = threading.Lock()
+        self.room = threading.Condition(self.msg_lock)   # notified when pending messages are removed
         self.msg_added = threading.Event()
+        # topic -> set of subscribers, and the topics with new messages, both under msg_lock
+        self.subscriptions = defaultdict(set)
+        for topic, subscribers in self.storage.all_subscribers().items():
+            self.subscriptions[topic].update(subscribers)
+        self.dirty_topics = set(self.storage.topics())   # there may be messages from before a restart
+        self.held_topics = set()   # topics with a subscriber whose queue is full, with the block policy
+        self.delivered = []        # (topic, messages) delivered to every subscriber, to remove from storage
         self.sender = threading.Thread(target=self.__sender, name="messagebus.sender")
         self.sender.daemon = True
         self.sender.start()
@@ -457,6 +1354,10 @@ class MessageBus(object):
         else:
             with self.msg_lock:
                 self.storage.remove_topic(topic)
+                self.subscriptions.pop(topic, None)
+                self.dirty_topics.discard(topic)
+                self.held_topics.discard(topic)
+                self.room.notify_all()
 
     def topics(self):
         """
@@ -468,15 +1369,81 @@ class MessageBus(object):
 
     def send(self, topic, message):
         message = Message(uuid.uuid1(), datetime.datetime.now(), message)
+        with self.room:
+            if not self.storage.wait_for_room(topic, self.room):
+                log.warning("topic %s is full, dropped a message", topic)
+                return
+            committed = self.storage.add_message(topic, message)
+        if committed is not None:
+            # wait outside the lock, so that messages sent meanwhile are committed together
+            committed.result()
         with self.msg_lock:
-            self.storage.add_message(topic, message)
+            self.dirty_topics.add(topic)
         self.msg_added.set()   # signal that a new message has arrived
-        self.msg_added.clear()
 
     @Pyro4.oneway
     def send_no_ack(self, topic, message):
         self.send(topic, message)
 
+    def set_topic_limit(self, topic, max_messages=None, max_bytes=None, policy="drop_oldest",
+                        key=None, timeout=None):
+        """
+        Bound the pending messages of a topic, see QueueLimit. Without max_messages and
+        max_bytes the topic is unbounded.
+        """
+        if not self.storage.topic_limits:
+            raise TypeError("%s does not support topic limits" % self.storage.__class__.__name__)
+        limit = None
+        if max_messages is not None or max_bytes is not None:
+            limit = QueueLimit(max_messages, max_bytes, policy, key, timeout)
+        self.add_topic(topic)
+        with self.room:
+            self.storage.set_limit(topic, limit)
+            self.room.notify_all()
+
+    def set_subscriber_limit(self, subscriber, max_messages=None, max_bytes=None,
+                             policy="drop_oldest", key=None, timeout=None, spill_dir=None):
+        """
+        Bound the messages waiting for delivery to a subscriber, see QueueLimit. Without
+        max_messages and max_bytes the bus default applies again.
+        """
+        limit = None
+        if max_messages is not None or max_bytes is not None:
+            limit = QueueLimit(max_messages, max_bytes, policy, key, timeout, spill_dir)
+        with self.workers_lock:
+            if limit is None:
+                self.subscriber_limits.pop(subscriber, None)
+            else:
+                self.subscriber_limits[subscriber] = limit
+            worker = self.workers.get(subscriber)
+            limit = self._subscriber_limit(subscriber)
+        if worker is not None:
+            # outside workers_lock: dropped messages are reported to their Handovers, which take msg_lock
+            worker.set_limit(limit)
+        self._room_available()
+
+    def _subscriber_limit(self, subscriber):
+        limit = self.subscriber_limits.get(subscriber, self.subscriber_limit)
+        if limit is None:
+            policy = QueueLimit.BLOCK if self.storage.durable else QueueLimit.DROP_OLDEST
+            limit = QueueLimit(max_messages=self.max_in_flight, policy=policy)
+        return limit
+
+    def queue_stats(self):
+        """
+        return:
+            - dict: "topics" and "subscribers", the counters of each bounded queue, see BoundedQueue.stats
+        """
+        with self.msg_lock:
+            topics = self.storage.queue_stats()
+        with self.workers_lock:
+            workers = list(self.workers.items())
+        subscribers = {}
+        for subscriber, worker in workers:
+            with worker.condition:
+                subscribers[str(subscriber)] = worker.queue.stats()
+        return {"topics": topics, "subscribers": subscribers}
+
     def subscribe(self, topic, subscriber):
         """Add a subscription to a topic."""
         meth = getattr(subscriber, "incoming_message", None)
@@ -484,62 +1451,141 @@ class MessageBus(object):
             raise TypeError("subscriber must have incoming_message() method")
         self.add_topic(topic)   # make sure the topic exists
         with self.msg_lock:
-            self.storage.add_subscriber(topic, subscriber)
+            stored = self.storage.add_subscriber(topic, subscriber)
+            self.subscriptions[topic].add(subscriber if stored is None else stored)
             log.debug("subscribed: %s -> %s" % (topic, subscriber))
 
     def unsubscribe(self, topic, subscriber):
         """Remove a subscription to a topic."""
         with self.msg_lock:
             self.storage.remove_subscriber(topic, subscriber)
+            self.subscriptions[topic].discard(subscriber)
             log.debug("unsubscribed %s from topic %s" % (subscriber, topic))
+        # the topic may have been held back for this subscriber
+        self._room_available()
 
     def _unsubscribe_many(self, subscribers):
         if subscribers:
-            topics = self.storage.topics()
             with self.msg_lock:
-                for topic in topics:
+                for topic, subscribed in self.subscriptions.items():
                     for subscriber in subscribers:
-                        self.storage.remove_subscriber(topic, subscriber)
+                        if subscriber in subscribed:
+                            self.storage.remove_subscriber(topic, subscriber)
+                            subscribed.discard(subscriber)
             log.debug("unsubscribed from all topics: %s" % subscribers)
 
+    def _delivery_failed(self, subscriber):
+        # called by the worker of a subscriber it could not deliver to
+        with self.workers_lock:
+            self.workers.pop(subscriber, None)
+        self._unsubscribe_many([subscriber])
+        # release the topics held back while its queue was full
+        self._room_available()
+
+    def _worker(self, subscriber):
+        with self.workers_lock:
+            worker = self.workers.get(subscriber)
+            if worker is None:
+                worker = DeliveryWorker(subscriber, self._delivery_failed,
+                                        limit=self._subscriber_limit(subscriber),
+                                        on_room=self._room_available)
+                self.workers[subscriber] = worker
+            return worker
+
+    def _room(self, subscribers):
+        # how many messages may be handed to all of the subscribers, None for no bound
+        room = None
+        for subscriber in subscribers:
+            free = self._worker(subscriber).room()
+            if free is not None and (room is None or free < room):
+                room = free
+        return room
+
+    def _room_available(self):
+        # called by the workers with the block policy after a delivery, and when subscribers go
+        with self.msg_lock:
+            if not self.held_topics:
+                return
+            self.dirty_topics.update(self.held_topics)
+            self.held_topics.clear()
+        self.msg_added.set()
+
+    def _stop_idle_workers(self, subscribers):
+        # stop the workers of subscribers which are no longer subscribed to anything
+        with self.workers_lock:
+            idle = [self.workers.pop(subscriber) for subscriber in list(self.workers)
+                    if subscriber not in subscribers and self.workers[subscriber].idle()]
+        for worker in idle:
+            worker.stop()
+
+    def _delivered(self, topic, messages):
+        # called by the Handover of messages of a durable storage when all the workers are done
+        with self.msg_lock:
+            self.delivered.append((topic, messages))
+        self.msg_added.set()
+
+    def delivery_stats(self):
+        """
+        return:
+            - dict: Delivery counters and latencies for each subscriber, see DeliveryWorker.stats
+        """
+        with self.workers_lock:
+            workers = list(self.workers.items())
+        return {str(subscriber): worker.stats() for subscriber, worker in workers}
+
     def __sender(self):
         # this runs in a thread, to pick up and forward incoming messages
         prev_print_stats = 0
         while True:
-            self.msg_added.wait(timeout=2.01)
+            self.msg_added.wait(timeout=max(0, prev_print_stats + 10 - time.time()))
             if time.time() - prev_print_stats >= 10:
                 prev_print_stats = time.time()
                 self._print_stats()
             with self.msg_lock:
-                msgs_per_topic = self.storage.all_pending_messages()
-                subs_per_topic = self.storage.all_subscribers()
-            subs_to_remove = set()
-            for topic, messages in msgs_per_topic.items():
-                if topic not in subs_per_topic or not messages:
+                self.msg_added.clear()
+                delivered, self.delivered = self.delivered, []
+                for topic, messages in delivered:
+                    self.storage.remove_messages({topic: messages})
+                topics, self.dirty_topics = self.dirty_topics, set()
+                if not topics:
                     continue
-                for subscriber in subs_per_topic[topic]:
-                    if subscriber in subs_to_remove:
-                        # skipping because subscriber is scheduled for removal
+                ready = []
+                counts = {}     # topic -> number of messages which fit for all its subscribers
+                for topic in topics:
+                    room = self._room(self.subscriptions.get(topic, ()))
+                    if room == 0:
+                        self.held_topics.add(topic)
                         continue
-                    try:
-                        try:
-                            # send the batch of messages pending for this topic in one go
-                            subscriber.incoming_messages(topic, messages)
-                        except Pyro4.errors.MessageTooLargeError:
-                            # the batch doesn't fit in the configured max msg size, send them one by one instead
-                            for message in messages:
-                                subscriber.incoming_message(topic, message)
-                    except Exception as x:
-                        # can't deliver them, drop the subscription
-                        log.warning("error delivering message(s) for topic=%s, subscriber=%s, error=%r" % (topic, subscriber, x))
-                        log.warning("removing subscription because of that error")
-                        subs_to_remove.add(subscriber)
-            # remove processed messages
-            if msgs_per_topic:
-                with self.msg_lock:
-                    self.storage.remove_messages(msgs_per_topic)
-            # remove broken subscribers
-            self._unsubscribe_many(subs_to_remove)
+                    ready.append(topic)
+                    if room is not None:
+                        counts[topic] = room
+                msgs_per_topic = self.storage.pending_messages(ready, counts)
+                # take the messages out of the storage at once, as policies may change the pending
+                # ones; a durable storage keeps them until they are delivered
+                batches = self.storage.take(msgs_per_topic) if msgs_per_topic else {}
+                subs_per_topic = {topic: list(self.subscriptions.get(topic, ())) for topic in batches}
+                for topic in batches:
+                    # more than the storage gives at once, or than there is room for
+                    if self.storage.has_pending_messages(topic):
+                        self.dirty_topics.add(topic)
+                        self.msg_added.set()
+                if batches:
+                    self.room.notify_all()
+                subscribed = set(sub for subs in self.subscriptions.values() for sub in subs)
+            # hand the messages to the delivery worker of each subscriber
+            for topic, batch in batches.items():
+                if not batch:
+                    continue
+                subscribers = subs_per_topic[topic]
+                handover = None
+                if self.storage.durable:
+                    if not subscribers:
+                        self._delivered(topic, batch)
+                        continue
+                    handover = Handover(topic, batch, len(subscribers) * len(batch), self._delivered)
+                for subscriber in subscribers:
+                    self._worker(subscriber).put(topic, batch, handover)
+            self._stop_idle_workers(subscribed)
 
     def _print_stats(self):
         topics, subscribers, pending, messages = self.storage.stats()
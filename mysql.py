@@ -5,11 +5,28 @@ Classes for GAVRT data using MySQL tables
 This module defines the classes BaseDB and MysqlException.  It also provides
 subclasses for reducing data stored in the DSS-28 database.
 """
+import asyncio
+import bisect
+import calendar
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import MySQLdb
+import MySQLdb.cursors
 import numpy as np
 import os
 import pickle
+import re
+import sys
+import threading
+import time
+import weakref
+
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from MySQLdb.constants import FIELD_TYPE
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +72,38 @@ reserved = ['ADD', 'ALL', 'ALTER', 'ANALYZE', 'AND', 'AS', 'ASC',
             'VARCHARACTER', 'VARYING', 'WHEN', 'WHERE', 'WHILE', 'WITH',
             'WRITE', 'XOR', 'YEAR_MONTH', 'ZEROFILL']
 
+# numpy kind of a column for each MySQL field type
+field_kinds = {FIELD_TYPE.DECIMAL:     'float',
+               FIELD_TYPE.NEWDECIMAL:  'float',
+               FIELD_TYPE.FLOAT:       'float',
+               FIELD_TYPE.DOUBLE:      'float',
+               FIELD_TYPE.TINY:        'int',
+               FIELD_TYPE.SHORT:       'int',
+               FIELD_TYPE.LONG:        'int',
+               FIELD_TYPE.LONGLONG:    'int',
+               FIELD_TYPE.INT24:       'int',
+               FIELD_TYPE.YEAR:        'int',
+               FIELD_TYPE.DATE:        'date',
+               FIELD_TYPE.NEWDATE:     'date',
+               FIELD_TYPE.DATETIME:    'datetime',
+               FIELD_TYPE.TIMESTAMP:   'datetime',
+               FIELD_TYPE.TIME:        'timedelta',
+               FIELD_TYPE.VARCHAR:     'str',
+               FIELD_TYPE.VAR_STRING:  'str',
+               FIELD_TYPE.STRING:      'str',
+               FIELD_TYPE.ENUM:        'str',
+               FIELD_TYPE.SET:         'str'}
+
+# numpy dtype and the value which replaces NULL for each kind
+kind_dtypes = {'float':     ('float64',         np.nan),
+               'int':       ('int64',           0),
+               'date':      ('datetime64[D]',   None),
+               'datetime':  ('datetime64[us]',  None),
+               'timedelta': ('timedelta64[us]', None),
+               'str':       ('U',               ''),
+               'bytes':     ('S',               b''),
+               'object':    (object,            None)}
+
 ############################## Classes #############################
 
 class MysqlException(Exception):
@@ -67,375 +116,3661 @@ class MysqlException(Exception):
   def __str__(self):
     return (self.message % self.args)
 
-class BaseDB():
+class QueryTimeout(MysqlException):
   """
-  This is a database superclass.
-  
+  A query was cancelled because it ran longer than its time limit
+  """
+  pass
+
+class Backend(object):
+  """
+  Connects BaseDB to a database with a DB-API driver
+
+  Subclasses take care of the differences between the drivers.  The driver
+  module is only imported when a backend is created.
+
   Public attributes::
-    db -   the database connection object
-    c  -   the database cursor
-    host - database host
-    port - port used to connect to the database
-    pw -   user's password
-    user - authorized db user
+    name             - key of the backend in 'backends'
+    login            - are host, user and password needed?
+    module           - the driver module
+    Error            - the driver's base exception
+    OperationalError - the driver's exception for a lost connection
+    max_packet_query - query for the largest packet the server accepts
+    autoinc_query    - query for auto_increment_increment and the InnoDB
+                       auto-increment lock mode; None if the IDs of a
+                       multi-row INSERT are always consecutive
+    tables_query     - query for the database, name and estimated number of
+                       rows of every table
+    floor            - SQL template for the floor of a non-negative number
   Methods::
-    connect - returns a connection to a database.
-    check_db - reconnects to the database if a connection has been lost
-    cursor   - 
+    connect       - open a connection
+    autocommit    - put a connection in autocommit mode
+    ping          - check that a connection is alive
+    server_cursor - cursor which leaves the result on the server
+    schema_cache  - SchemaCache for a database
+    thread_id     - server thread of a connection
+    cancel        - stop the statement running on a connection
   """
-  def __init__(self, host=None, user=None , pw=None, name=None, port=3306):
+  name = None
+  login = True
+  max_packet_query = "SELECT @@max_allowed_packet;"
+  autoinc_query = "SELECT @@auto_increment_increment, " \
+                  "@@innodb_autoinc_lock_mode;"
+  tables_query = "SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_ROWS " \
+                 "FROM information_schema.TABLES " \
+                 "WHERE TABLE_TYPE = 'BASE TABLE' " \
+                 "ORDER BY TABLE_SCHEMA, TABLE_NAME;"
+  floor = "FLOOR(%s)"
+
+  def __init__(self):
+    self.module = self.load()
+    self.Error = self.module.Error
+    self.OperationalError = self.module.OperationalError
+
+  def load(self):
     """
-    Initializes a BaseDB instance by connecting to the database
-    
-    This defaults to the GAVRT DSS-28 EAC database on 'kracken'.  However, use
-    of sub-class DSS28db is recommended to avoid writing acciden
-    
-    @param host : the IP address as a string, or fully qualified host name
-    @type  host : str
-    
-    @param user : a valid user on the mysql server at host
-    
-    @param pw : user's password or "" if not required
-    
-    @param db : database name (string)
-    
-    Generates a cursor object BaseDB.c.
+    Imports and returns the driver module
     """
-    self.logger = logging.getLogger(logger.name+".BaseDB")
-    if name and host and user and pw:
-      self.name= name
-      self.host = host
-      self.port = port
-      self.user = user
-      self.pw = pw
-      self.connect()
-      self.logger.debug("__init__: database connected.")
-    else:
-      self.logger.error("__init__: host, user, pw and DB name required")
-      raise MysqlException("Missing arguments host=%s, user=%s, name=%s or missing pw?",
-                           host, user, name)
+    raise NotImplementedError
 
-  def connect(self):
+  def connect(self, host, port, user, passwd, db):
     """
-    Make a connection to the database. Creates a cursor object.
-    
-    Automatically invoked when an instance is created; can be called
-    again if the connection is closed but the database object persists.
+    Opens a connection
+
+    @return: connection object
     """
-    self.db = MySQLdb.connect(host = self.host,
-                              port=self.port,
-                              user=self.user,
-                              passwd=self.pw,
-                              db=self.name,
-                              compress=True)
-    self.c = self.db.cursor()
+    raise NotImplementedError
 
-  def close(self):
+  def autocommit(self, conn):
     """
-    Close a connection
+    Puts a connection in autocommit mode
     """
-    self.c.close()
-    
-  def checkDB(self):
+    conn.autocommit(True)
+
+  def ping(self, conn):
     """
-    Reconnects to the database if the connection has been lost.
+    Raises an exception if a connection is not alive
     """
-    try:
-      self.db.commit()
-    except:
-      self.connect()
-    self.db.commit()
+    conn.ping()
 
-  def cursor(self):
+  def server_cursor(self, conn):
     """
-    Creates a database cursor object; same as BaseDB.c but this
-    is better because it handles disconnected a database
+    Cursor which leaves the result on the server until it is fetched
     """
-    self.checkDB()
-    return self.db.cursor()
+    return conn.cursor()
 
-  def send_query(self,query):
+  def schema_cache(self, execute, database, ttl):
     """
-    Send a MySQL query
+    SchemaCache for a database
+    """
+    return SchemaCache(execute, database=database, ttl=ttl)
 
-    @param crsr : cursor object for a database
+  def thread_id(self, conn):
+    """
+    Server thread (connection) ID of a connection
+    """
+    return conn.thread_id()
 
-    @param query : MySQL query
-    @type  query : str
+  def cancel(self, conn, side):
+    """
+    Stops the statement running on a connection
 
-    @return: str with query response
+    This sends KILL QUERY on another connection, which is left open.
+
+    @param conn : connection running the statement
+
+    @param side : function which returns the connection for the KILL
+    @type  side : callable
     """
-    query += ";"
-    self.c.execute(query)
-    response = self.c.fetchall()
-    return response
+    c = side().cursor()
+    try:
+      c.execute("KILL QUERY %d" % self.thread_id(conn))
+    finally:
+      c.close()
 
-  def commit(self):
+class MySQLdbBackend(Backend):
+  """
+  The mysqlclient driver, MySQLdb
+  """
+  name = "MySQLdb"
+
+  def load(self):
+    return MySQLdb
+
+  def connect(self, host, port, user, passwd, db):
+    return MySQLdb.connect(host=host, port=port, user=user, passwd=passwd,
+                           db=db, compress=True)
+
+  def server_cursor(self, conn):
+    return conn.cursor(MySQLdb.cursors.SSCursor)
+
+class PyMySQLBackend(Backend):
+  """
+  The pure Python driver PyMySQL
+  """
+  name = "pymysql"
+
+  def load(self):
+    import pymysql
+    import pymysql.cursors
+    return pymysql
+
+  def connect(self, host, port, user, passwd, db):
+    return self.module.connect(host=host, port=port, user=user,
+                               password=passwd, database=db)
+
+  def ping(self, conn):
+    conn.ping(reconnect=False)
+
+  def server_cursor(self, conn):
+    return conn.cursor(self.module.cursors.SSCursor)
+
+class MySQLConnectorBackend(Backend):
+  """
+  Oracle's driver, mysql.connector
+  """
+  name = "mysql.connector"
+
+  def load(self):
+    import mysql.connector
+    return mysql.connector
+
+  def connect(self, host, port, user, passwd, db):
+    return self.module.connect(host=host, port=port, user=user,
+                               password=passwd, database=db, compress=True)
+
+  def autocommit(self, conn):
+    conn.autocommit = True
+
+  def ping(self, conn):
+    conn.ping(reconnect=False)
+
+  def server_cursor(self, conn):
+    return conn.cursor(buffered=False)
+
+  def thread_id(self, conn):
+    return conn.connection_id
+
+class SQLiteCursor(object):
+  """
+  sqlite3 cursor which takes MySQLdb style queries
+
+  Parameters are given as %s or %(name)s.  As with MySQL, the 'lastrowid' of
+  a multi-row INSERT is the ID of its first row.
+  """
+  param_pattern = re.compile(r"%\((\w+)\)s")
+  insert_pattern = re.compile(r"\s*(INSERT|REPLACE)\b", re.IGNORECASE)
+
+  def __init__(self, cursor):
+    self._cursor = cursor
+    self._rows_inserted = 0
+
+  @classmethod
+  def translate(cls, query, params=None):
     """
-    Commits the most recent database transaction
+    Converts the parameter markers outside of quoted strings
     """
-    return self.db.commit()
-        
-  def insertRecord(self, table, rec):
+    if params is None:
+      return query
+    parts = query.split("'")
+    for index in range(0, len(parts), 2):
+      part = parts[index].replace("%%", "\0").replace("%s", "?")
+      part = cls.param_pattern.sub(r":\1", part)
+      parts[index] = part.replace("\0", "%")
+    return "'".join(parts)
+
+  def execute(self, query, params=None):
+    if params is None:
+      self._cursor.execute(query)
+    else:
+      if not isinstance(params, dict):
+        params = tuple(params)
+      self._cursor.execute(self.translate(query, params), params)
+    if self.insert_pattern.match(query):
+      self._rows_inserted = self._cursor.rowcount
+    else:
+      self._rows_inserted = 0
+    return self._cursor.rowcount
+
+  def executemany(self, query, seq_of_params):
+    seq_of_params = [params if isinstance(params, dict) else tuple(params)
+                     for params in seq_of_params]
+    self._cursor.executemany(self.translate(query, ()), seq_of_params)
+    self._rows_inserted = 1 if self.insert_pattern.match(query) else 0
+    return self._cursor.rowcount
+
+  def fetchone(self):
+    return self._cursor.fetchone()
+
+  def fetchmany(self, size):
+    return tuple(self._cursor.fetchmany(size))
+
+  def fetchall(self):
+    return tuple(self._cursor.fetchall())
+
+  @property
+  def description(self):
+    return self._cursor.description
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  @property
+  def lastrowid(self):
+    lastrowid = self._cursor.lastrowid
+    if lastrowid and self._rows_inserted > 1:
+      return lastrowid - self._rows_inserted + 1
+    return lastrowid
+
+  def close(self):
+    self._cursor.close()
+
+class SQLiteConnection(object):
+  """
+  sqlite3 connection with the MySQLdb methods that BaseDB uses
+  """
+  def __init__(self, conn):
+    self._conn = conn
+
+  def cursor(self, *args, **kwargs):
+    return SQLiteCursor(self._conn.cursor())
+
+  def commit(self):
+    self._conn.commit()
+
+  def rollback(self):
+    self._conn.rollback()
+
+  def autocommit(self, flag):
+    self._conn.isolation_level = None if flag else ""
+
+  def ping(self):
+    self._conn.execute("SELECT 1")
+
+  def interrupt(self):
+    self._conn.interrupt()
+
+  def close(self):
+    self._conn.close()
+
+class SQLiteBackend(Backend):
+  """
+  sqlite3 stand-in for a MySQL server, for tests and benchmarks
+
+  The database name is a file path, or ':memory:' for an in-memory database
+  which all the connections of the backend share.  Host, user and password
+  are not needed.  Only SQL which SQLite also understands can be used.
+  """
+  name = "sqlite"
+  login = False
+  max_packet_query = None
+  autoinc_query = None
+  tables_query = "SELECT 'main', name, NULL FROM sqlite_master " \
+                 "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' " \
+                 "ORDER BY name;"
+  floor = "CAST(%s AS INTEGER)"
+  schema_query = "SELECT m.name, p.name, p.type, " \
+     "CASE p.\"notnull\" WHEN 0 THEN 'YES' ELSE 'NO' END, " \
+     "CASE p.pk WHEN 0 THEN '' ELSE 'PRI' END, p.dflt_value, " \
+     "CASE WHEN p.pk = 1 AND upper(p.type) = 'INTEGER' " \
+     "THEN 'auto_increment' ELSE '' END " \
+     "FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p " \
+     "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' " \
+     "ORDER BY m.name, p.cid;"
+
+  def load(self):
+    import sqlite3
+    return sqlite3
+
+  def connect(self, host, port, user, passwd, db):
+    if db == ":memory:":
+      uri = "file:support_mysql_%d?mode=memory&cache=shared" % id(self)
+      conn = self.module.connect(uri, uri=True, check_same_thread=False)
+    else:
+      conn = self.module.connect(db, check_same_thread=False)
+    return SQLiteConnection(conn)
+
+  def schema_cache(self, execute, database, ttl):
+    return SchemaCache(execute, ttl=ttl, query=self.schema_query)
+
+  def cancel(self, conn, side):
+    conn.interrupt()
+
+backends = {MySQLdbBackend.name:        MySQLdbBackend,
+            PyMySQLBackend.name:        PyMySQLBackend,
+            MySQLConnectorBackend.name: MySQLConnectorBackend,
+            SQLiteBackend.name:         SQLiteBackend}
+
+def get_backend(backend):
+  """
+  Backend for a name in 'backends', or the backend itself
+
+  @param backend : backend name or Backend
+  @type  backend : str
+
+  @return: Backend
+  """
+  if isinstance(backend, Backend):
+    return backend
+  try:
+    return backends[backend]()
+  except KeyError:
+    raise MysqlException("unknown backend %s; known backends are %s",
+                         backend, sorted(backends.keys()))
+
+class ConnectionPool(object):
+  """
+  A bounded, thread-safe pool of database connections
+
+  Connections are created on demand, up to 'size' of them.  A connection
+  which has been idle for longer than 'idle_check' seconds is pinged when it
+  is checked out; a dead connection is discarded and a replacement is opened
+  in a background thread so that the caller does not wait for it.
+
+  Public attributes::
+    size       - maximum number of connections
+    idle_check - idle time (s) after which a connection is pinged
+    timeout    - default time (s) to wait for a free connection
+  Methods::
+    checkout   - get a connection from the pool
+    checkin    - return a connection to the pool
+    connection - context manager for checkout/checkin
+    stats      - pool statistics
+    close      - close all idle connections
+  """
+  def __init__(self, connect, size=4, idle_check=30., timeout=None,
+               ping=None, errors=MySQLdb.OperationalError):
     """
-    Inserts a record into the database; handles a disconnected database
+    @param connect : function which returns a new connection
+    @type  connect : callable
 
-    @param table : table name
-    @type  table : str
+    @param size : maximum number of connections
+    @type  size : int
 
-    @param rec : a dictionary with column names as keys.
+    @param idle_check : idle time after which liveness is checked
+    @type  idle_check : float
 
-    @return: record ID (int)
+    @param timeout : default wait for a free connection; None waits forever
+    @type  timeout : float
+
+    @param ping : function which raises an exception if a connection is not
+                  alive; default the connection's ping() method
+    @type  ping : callable
+
+    @param errors : exception class(es) after which a connection is not
+                    re-used
     """
-    self.checkDB()
-    return insert_record(self.db, table, rec)
+    self.logger = logging.getLogger(logger.name+".ConnectionPool")
+    self.connect = connect
+    self.ping = ping
+    self.errors = errors
+    self.size = size
+    self.idle_check = idle_check
+    self.timeout = timeout
+    self._idle = collections.deque()    # (connection, time last used)
+    self._count = 0                     # connections open or being opened
+    self._closed = False
+    self._cond = threading.Condition()
+    self._stats = collections.Counter()
 
-  def getLastId(self, table):
+  def _open(self):
     """
-    ID of the last record
-    
-    @param table : the name of the table
-    @type  table : str
+    Opens a connection; the caller must already have reserved a slot
+    """
+    try:
+      conn = self.connect()
+    except:
+      with self._cond:
+        self._count -= 1
+        self._cond.notify()
+      raise
+    with self._cond:
+      self._stats['created'] += 1
+    return conn
 
-    @return: ID (int)
+  def _replenish(self):
     """
-    self.checkDB()
-    #return get_last_id(self.db,table)
-    c = self.cursor()
-    ID = table+"_id"
-    c.execute("SELECT "+ID+" FROM " + table + " ORDER BY "+ID+" DESC LIMIT 1;")
-    return int(c.fetchone()[0])
+    Opens a connection in the background to replace a discarded one
+    """
+    try:
+      conn = self._open()
+    except Exception as details:
+      self.logger.warning("_replenish: reconnect failed: %s", details)
+      return
+    with self._cond:
+      self._stats['background_reconnects'] += 1
+    self.checkin(conn)
 
-  
-  def getLastRecord(self,table):
+  def _discard(self, conn):
     """
-    Returns the last record as a dictionary
-    
-    @param table : name of the table (string)
+    Closes a broken connection and starts opening a replacement
 
-    @return: dict
+    The caller must hold the pool lock.
     """
-    self.checkDB()
-    self.c.execute("SELECT * FROM " + table + " ORDER BY ID DESC LIMIT 1;")
-    res = self.c.fetchone()
-    # This returns the column names
-    descr = [x[0] for x in self.c.description]
-    # This returns the row as a dictionary
-    return dict(list(zip(descr,res)))
-  
-  def getRecordById(self,table,rec_id):
+    try:
+      conn.close()
+    except Exception:
+      pass
+    self._stats['discarded'] += 1
+    if self._closed:
+      self._count -= 1
+      return
+    # the slot stays reserved for the replacement
+    thread = threading.Thread(target=self._replenish,
+                              name="ConnectionPool.replenish")
+    thread.daemon = True
+    thread.start()
+
+  def _alive(self, conn):
     """
-    Get the record with the given ID
-    
-    @param table : table name
-    @type  table : str
-    
-    @param id : row ID
-    @type  id : int
+    Pings a connection
 
-    @return: dict
+    The caller must not hold the pool lock.
     """
-    self.checkDB()
-    self.c.execute("SELECT * FROM " + table + " WHERE ID = %s;",(rec_id,))
-    res = self.c.fetchone()
-    descr = [x[0] for x in self.c.description]
-    return dict(list(zip(descr,res)))
-    
-  def get(self,*args):
+    try:
+      if self.ping:
+        self.ping(conn)
+      else:
+        conn.ping()
+    except Exception:
+      return False
+    return True
+
+  def checkout(self, timeout=None):
     """
-    Executes a query of the database
-    
-    @param args : query to be executed
-    
-    @return: record (dict)
+    Gets a live connection from the pool
+
+    @param timeout : seconds to wait for a free connection
+    @type  timeout : float
+
+    @return: connection object
     """
-    self.checkDB()
-    self.c.execute(*args)
-    result = np.array(self.c.fetchall())
-    return result
-    
-  def get_as_dict(self, *args, **kwargs):
+    if timeout is None:
+      timeout = self.timeout
+    deadline = None if timeout is None else time.time() + timeout
+    waited = False
+    while True:
+      with self._cond:
+        while True:
+          if self._closed:
+            raise MysqlException("checkout: connection pool is closed")
+          if self._idle:
+            conn, last_used = self._idle.pop()
+            if time.time() - last_used < self.idle_check:
+              self._stats['checkouts'] += 1
+              return conn
+            self._stats['pings'] += 1
+            break
+          if self._count < self.size:
+            self._count += 1
+            conn = None
+            break
+          if not waited:
+            self._stats['waits'] += 1
+            waited = True
+          if deadline is None:
+            self._cond.wait()
+          else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              self._stats['timeouts'] += 1
+              raise MysqlException("checkout: no connection free after %s s",
+                                   timeout)
+            self._cond.wait(remaining)
+      if conn is None:
+        break
+      # ping outside the lock; the connection is checked out meanwhile
+      alive = self._alive(conn)
+      with self._cond:
+        if alive:
+          self._stats['checkouts'] += 1
+          return conn
+        self._stats['ping_failures'] += 1
+        self._discard(conn)
+    # open a new connection outside the lock
+    conn = self._open()
+    with self._cond:
+      self._stats['checkouts'] += 1
+    return conn
+
+  def checkin(self, conn, broken=False):
     """
-    Executes a query of the database and returns the result as a dict
-  
-    At present, only keyword {'asfloat': True} is recognized and is the default
-    if not given.  It will convert to float any values for which it is possible.
-  
-    If the query returns multiple rows, each value associated with a keyword will
-    be a list. If nothing was found, an empty dictionary is returned.
-    
-    @param db : database connection object
-    
-    @param args: query to be executed
-    
-    @param kwargs : a dictionary with keyword arguments.
-    
-    @eturn: the record as a dictionary.
+    Returns a connection to the pool
+
+    @param conn : connection obtained from checkout()
+
+    @param broken : True if the connection should not be re-used
+    @type  broken : bool
     """
-    try:
-      asfloat = kwargs['asfloat']
-    except:
-      asfloat = True
-    res = self.get(*args)
-    # an empty result will have a shape of (1,)
-    if len(res.shape) > 1:
-      descr = [x[0] for x in self.c.description]
-      if asfloat:
-        rd = {}
-        for x in range(res.shape[1]):
-          try:
-            r = res[:,x].astype('float')
-          except:
-            r = res[:,x]
-          rd[descr[x]] = r
+    with self._cond:
+      if broken:
+        self._discard(conn)
+      elif self._closed:
+        self._count -= 1
+        try:
+          conn.close()
+        except Exception:
+          pass
       else:
-        rd = dict([(descr[x],res[:,x]) for x in range(res.shape[1])])
-    else:
-      rd = {}
-    return rd
-        
-  def updateValues(self, vald, table):
+        self._idle.append((conn, time.time()))
+        self._stats['checkins'] += 1
+      self._cond.notify()
+
+  @contextlib.contextmanager
+  def connection(self, timeout=None):
+    """
+    Checks out a connection for the duration of a 'with' block
+
+    A connection which raised one of ConnectionPool.errors is not re-used.
+    """
+    conn = self.checkout(timeout)
+    broken = False
+    try:
+      yield conn
+    except self.errors:
+      broken = True
+      raise
+    finally:
+      self.checkin(conn, broken=broken)
+
+  def stats(self):
+    """
+    Pool statistics
+
+    @return: dict
+    """
+    with self._cond:
+      stats = dict(self._stats)
+      stats['size'] = self.size
+      stats['open'] = self._count
+      stats['idle'] = len(self._idle)
+      stats['in_use'] = self._count - len(self._idle)
+    return stats
+
+  def close(self):
+    """
+    Closes the idle connections; busy ones are closed when checked in
+    """
+    with self._cond:
+      self._closed = True
+      while self._idle:
+        conn, last_used = self._idle.pop()
+        self._count -= 1
+        try:
+          conn.close()
+        except Exception:
+          pass
+      self._cond.notify_all()
+
+class SchemaCache(object):
+  """
+  Cached column information for the tables of a database
+
+  The information for all the tables is obtained with one query of
+  information_schema.COLUMNS.  It is obtained again when it is older than
+  'ttl' seconds or after invalidate() has been called.  The column information
+  is in the format of 'SHOW COLUMNS', namely tuples of::
+    Field, Type, Null, Key, Default, Extra
+
+  Public attributes::
+    database - database name, or None for the connection's current database
+    ttl      - seconds for which the information is used; None for ever
+  Methods::
+    invalidate   - forget the information
+    tables       - names of the tables
+    has_table    - does the table exist?
+    columns      - information about the columns of a table
+    column_names - names of the columns of a table
+    column       - information about a column
+  """
+  query = "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, " \
+          "COLUMN_KEY, COLUMN_DEFAULT, EXTRA FROM information_schema.COLUMNS " \
+          "WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, ORDINAL_POSITION;"
+
+  def __init__(self, execute, database=None, ttl=300., query=None):
+    """
+    @param execute : function which executes a query with parameters and
+                     returns the rows and cursor description
+    @type  execute : callable
+
+    @param database : database name
+    @type  database : str
+
+    @param ttl : seconds for which the information is used
+    @type  ttl : float
+
+    @param query : query returning rows of table name and 'SHOW COLUMNS'
+                   information, instead of SchemaCache.query
+    @type  query : str
+    """
+    self.execute = execute
+    if query:
+      self.query = query
+    self.database = database
+    self.ttl = ttl
+    self._tables = None
+    self._loaded = 0
+    self._lock = threading.Lock()
+
+  def invalidate(self):
+    """
+    Forgets the column information so it is obtained again when needed
+    """
+    with self._lock:
+      self._tables = None
+
+  def _load(self):
+    """
+    Returns the column information keyed on table name, updated if necessary
+    """
+    with self._lock:
+      if self._tables is None or \
+         (self.ttl is not None and time.time() - self._loaded > self.ttl):
+        if self.database is None:
+          rows, descr = self.execute(
+                             self.query.replace("%s", "DATABASE()"))
+        else:
+          rows, descr = self.execute(self.query, (self.database,))
+        tables = collections.OrderedDict()
+        for row in rows:
+          tables.setdefault(row[0], []).append(tuple(row[1:]))
+        self._tables = dict([(table, tuple(columns))
+                             for table, columns in tables.items()])
+        self._loaded = time.time()
+      return self._tables
+
+  def tables(self):
+    """
+    Names of the tables
+
+    @return: list of str
+    """
+    return sorted(self._load().keys())
+
+  def has_table(self, table):
+    """
+    Does the table exist?
+
+    @return: bool
+    """
+    return table in self._load()
+
+  def columns(self, table):
+    """
+    Information about the columns of a table
+
+    @param table : table name
+    @type  table : str
+
+    @return: tuple of (Field, Type, Null, Key, Default, Extra)
+    """
+    try:
+      return self._load()[table]
+    except KeyError:
+      raise MysqlException("table %s not found", table)
+
+  def column_names(self, table):
+    """
+    Names of the columns of a table
+
+    @return: list of str
+    """
+    return [column[0] for column in self.columns(table)]
+
+  def column(self, table, column):
+    """
+    Information about a column
+
+    @return: (Field, Type, Null, Key, Default, Extra)
+    """
+    for info in self.columns(table):
+      if info[0] == column:
+        return info
+    raise MysqlException("column %s not found in table %s", column, table)
+
+class QueryCache(object):
+  """
+  Least recently used cache of query results
+
+  Results are keyed on the query, with whitespace normalized, and its
+  parameters.  An entry is dropped when it is older than 'ttl' seconds, when
+  one of the tables it was selected from is invalidated, or when the least
+  recently used entries are evicted to keep the total size under 'max_bytes'.
+  The size of a result is estimated from its first row.
+
+  Public attributes::
+    max_bytes - maximum total size of the cached results
+    ttl       - seconds for which a result is used
+  Methods::
+    key        - cache key of a query, or None if it is not a SELECT
+    get        - cached result of a query
+    put        - add a result to the cache
+    invalidate - drop the results selected from a table
+    clear      - drop all the results
+    stats      - counters and sizes
+  """
+  table_pattern = re.compile(
+     r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+(?:`?\w+`?\.)?`?(\w+)`?", re.I)
+  # a FROM clause ends at one of these outside parentheses
+  from_token_pattern = re.compile(
+     r"[(),;]|\b(?:FROM|WHERE|GROUP|HAVING|ORDER|LIMIT|UNION|WINDOW|FOR|LOCK|"
+     r"INTO)\b", re.I)
+  list_item_pattern = re.compile(r"\s*(?:`?\w+`?\.)?`?(\w+)`?")
+
+  def __init__(self, max_bytes=16*1024*1024, ttl=60.):
+    """
+    @param max_bytes : maximum total size of the cached results
+    @type  max_bytes : int
+
+    @param ttl : seconds for which a result is used
+    @type  ttl : float
+    """
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._entries = collections.OrderedDict() # key -> (result, tables,
+                                              #         expiry time, size)
+    self._bytes = 0
+    self._generation = 0
+    self._lock = threading.Lock()
+    self._stats = collections.Counter()
+
+  @staticmethod
+  def normalize(query):
+    """
+    Query with whitespace collapsed and no final semicolon
+    """
+    return " ".join(query.split()).rstrip(";").strip()
+
+  @classmethod
+  def tables(cls, query):
+    """
+    Names of the tables in a query, including all those of a FROM list
+
+    @return: set of str
+    """
+    tables = set(cls.table_pattern.findall(query))
+    # the tables after the commas of each FROM clause, at its own depth
+    depths = []       # parenthesis depth of the FROM clauses being read
+    depth = 0
+    for token in cls.from_token_pattern.finditer(query):
+      word = token.group().upper()
+      if word == "(":
+        depth += 1
+      elif word == ")":
+        depth -= 1
+        while depths and depths[-1] > depth:
+          depths.pop()
+      elif word == "FROM":
+        depths.append(depth)
+      elif depths and depths[-1] == depth:
+        if word == ",":
+          match = cls.list_item_pattern.match(query, token.end())
+          if match:
+            tables.add(match.group(1))
+        else:
+          depths.pop()
+    return tables
+
+  @classmethod
+  def key(cls, query, params=None):
+    """
+    Cache key of a query
+
+    @return: hashable key, or None if the query is not a SELECT
+    """
+    query = cls.normalize(query)
+    if not query[:6].upper() == "SELECT":
+      return None
+    if isinstance(params, dict):
+      params = tuple(sorted(params.items()))
+    elif isinstance(params, list):
+      params = tuple(params)
+    return (query, params)
+
+  @property
+  def generation(self):
+    """
+    Count of invalidations, to detect one during a query
+    """
+    return self._generation
+
+  def get(self, key):
+    """
+    Cached result of a query
+
+    @param key : key from QueryCache.key()
+
+    @return: (rows, cursor description); raises KeyError if not cached
+    """
+    with self._lock:
+      try:
+        result, tables, expiry, size = self._entries[key]
+      except KeyError:
+        self._stats['misses'] += 1
+        raise
+      if time.time() > expiry:
+        self._drop(key)
+        self._stats['expirations'] += 1
+        self._stats['misses'] += 1
+        raise KeyError(key)
+      self._entries.move_to_end(key)
+      self._stats['hits'] += 1
+      return result
+
+  def put(self, key, result, generation=None):
+    """
+    Adds a result to the cache
+
+    @param key : key from QueryCache.key()
+
+    @param result : (rows, cursor description)
+
+    @param generation : QueryCache.generation when the query was sent; the
+                        result is not cached if there was an invalidation since
+    """
+    size = result_size(result[0])
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      if key in self._entries:
+        self._drop(key)
+      self._entries[key] = (result, self.tables(key[0]),
+                            time.time() + self.ttl, size)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        self._drop(next(iter(self._entries)))
+        self._stats['evictions'] += 1
+
+  def _drop(self, key):
+    """
+    Removes an entry; the caller must hold the lock
+    """
+    result, tables, expiry, size = self._entries.pop(key)
+    self._bytes -= size
+
+  def invalidate(self, table):
+    """
+    Drops the results selected from a table
+
+    @param table : table name
+    @type  table : str
+    """
+    with self._lock:
+      self._generation += 1
+      for key in [key for key, entry in self._entries.items()
+                      if table in entry[1]]:
+        self._drop(key)
+        self._stats['invalidations'] += 1
+
+  def clear(self):
+    """
+    Drops all the results
+    """
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    """
+    Cache counters and sizes
+
+    @return: dict
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats['entries'] = len(self._entries)
+      stats['bytes'] = self._bytes
+      stats['max_bytes'] = self.max_bytes
+    return stats
+
+class SingleFlight(object):
+  """
+  Shares one execution among identical concurrent calls
+
+  A call made while another with the same key is running waits for it and
+  gets its result, or its exception, instead of running the function again.
+  After invalidate() calls already running are not joined by new ones, so
+  a caller never gets a result obtained before a write it knows about.
+
+  Methods::
+    do         - run a function unless the same call is running
+    invalidate - stop new calls joining those already running
+    stats      - counters
+  """
+  def __init__(self):
+    self._flights = {} # (generation, key) -> dict with Event 'done' and
+                       #                      'result' or 'error'
+    self._generation = 0
+    self._lock = threading.Lock()
+    self._stats = collections.Counter()
+
+  def do(self, key, function):
+    """
+    Result of a function, shared with identical concurrent calls
+
+    @param key : hashable identifier of the call
+    @param function : function without arguments
+    @type  function : callable
+
+    @return: what the function returns
+    """
+    with self._lock:
+      key = (self._generation, key)
+      self._stats['calls'] += 1
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = {'done': threading.Event()}
+      else:
+        self._stats['deduplicated'] += 1
+    if not leader:
+      flight['done'].wait()
+      if 'error' in flight:
+        raise flight['error']
+      return flight['result']
+    try:
+      flight['result'] = function()
+      return flight['result']
+    except Exception as error:
+      flight['error'] = error
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight['done'].set()
+
+  def invalidate(self):
+    """
+    Stops new calls from joining the calls already running
+    """
+    with self._lock:
+      self._generation += 1
+
+  def stats(self):
+    """
+    Numbers of calls, of calls deduplicated and of calls running
+
+    @return: dict
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats.setdefault('calls', 0)
+      stats.setdefault('deduplicated', 0)
+      stats['executions'] = stats['calls'] - stats['deduplicated']
+      stats['in_flight'] = len(self._flights)
+    return stats
+
+class QueryStats(object):
+  """
+  Latency statistics of queries, by statement template
+
+  The template of a statement is its text with whitespace normalized, literal
+  numbers and strings replaced by '?' and IN-lists shortened to '(...)'.  For
+  each template it keeps the number of calls and errors, the total and
+  maximum latency, a latency histogram and the rows and estimated bytes
+  returned.  Statements slower than 'slow_query' seconds are logged with their
+  parameters.
+
+  Public attributes::
+    slow_query - latency (s) above which a statement is logged, or None
+    bounds     - upper bounds (s) of the histogram bins; the last bin has none
+  Methods::
+    template - template of a statement
+    record   - add a statement's latency
+    count    - add to a counter, e.g. of reconnects
+    stats    - statistics by template and counters
+    reset    - forget the statistics
+  """
+  bounds = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5.,
+            10.]
+  literal_pattern = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+  list_pattern = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+  def __init__(self, slow_query=None):
+    """
+    @param slow_query : latency (s) above which a statement is logged
+    @type  slow_query : float
+    """
+    self.logger = logging.getLogger(logger.name+".QueryStats")
+    self.slow_query = slow_query
+    self._lock = threading.Lock()
+    self._templates = {}
+    self._counters = collections.Counter()
+    self._template_cache = {}
+
+  def template(self, query):
+    """
+    Template of a statement
+    """
+    try:
+      return self._template_cache[query]
+    except KeyError:
+      pass
+    template = " ".join(query.split()).rstrip(";").strip()
+    template = self.literal_pattern.sub("?", template.replace("%s", "?"))
+    template = self.list_pattern.sub("(...)", template)
+    if len(self._template_cache) < 10000:
+      self._template_cache[query] = template
+    return template
+
+  def record(self, query, params, elapsed, rows=0, nbytes=0, error=False):
+    """
+    Adds the latency of a statement
+
+    @param query : statement
+    @type  query : str
+
+    @param params : parameters of the statement
+
+    @param elapsed : latency (s)
+    @type  elapsed : float
+
+    @param rows : number of rows returned or written
+    @type  rows : int
+
+    @param nbytes : estimated size of the rows
+    @type  nbytes : int
+
+    @param error : did the statement fail?
+    @type  error : bool
+    """
+    template = self.template(query)
+    with self._lock:
+      try:
+        entry = self._templates[template]
+      except KeyError:
+        entry = {'calls': 0, 'errors': 0, 'total_time': 0., 'max_time': 0.,
+                 'rows': 0, 'bytes': 0,
+                 'histogram': [0]*(len(self.bounds) + 1)}
+        self._templates[template] = entry
+      entry['calls'] += 1
+      entry['errors'] += bool(error)
+      entry['total_time'] += elapsed
+      entry['max_time'] = max(entry['max_time'], elapsed)
+      entry['rows'] += rows
+      entry['bytes'] += nbytes
+      entry['histogram'][bisect.bisect_left(self.bounds, elapsed)] += 1
+    if self.slow_query is not None and elapsed > self.slow_query:
+      self.logger.warning("slow query (%.3f s): %s; parameters: %s",
+                          elapsed, template, params)
+
+  def count(self, counter, increment=1):
+    """
+    Adds to a counter
+
+    @param counter : counter name, e.g. 'reconnects'
+    @type  counter : str
+    """
+    with self._lock:
+      self._counters[counter] += increment
+
+  def stats(self):
+    """
+    Statistics by template and counters
+
+    @return: dict with keys 'templates', keyed on template, and 'counters'
+    """
+    with self._lock:
+      templates = {}
+      for template, entry in self._templates.items():
+        templates[template] = dict(entry)
+        templates[template]['histogram'] = list(entry['histogram'])
+        templates[template]['mean_time'] = entry['total_time']/entry['calls']
+      return {'templates': templates, 'counters': dict(self._counters),
+              'bounds': list(self.bounds)}
+
+  def reset(self):
+    """
+    Forgets the statistics
+    """
+    with self._lock:
+      self._templates.clear()
+      self._counters.clear()
+
+class BaseDB():
+  """
+  This is a database superclass.
+  
+  Public attributes::
+    db -   the database connection object
+    c  -   the database cursor
+    host - database host
+    port - port used to connect to the database
+    pw -   user's password
+    user - authorized db user
+    pool - ConnectionPool in pooled mode, otherwise None
+    schema - SchemaCache with the column information of the tables
+    cache - QueryCache of SELECT results if enabled, otherwise None
+    writer - LogWriter used by updateValues if enabled, otherwise None
+    statistics - QueryStats if instrumented, otherwise None
+    flights - SingleFlight of SELECT queries if coalescing, otherwise None
+    timeout - default time limit (s) of a query, None for no limit
+    backend - Backend for the DB-API driver
+  Methods::
+    connect - returns a connection to a database.
+    check_db - reconnects to the database if a connection has been lost
+    cursor   - 
+    connection - context manager providing a live connection
+    invalidate - drops the cached query results for a table
+    pool_stats - connection pool statistics
+    cache_stats - query cache statistics
+    query_stats - query latency statistics
+    coalesce_stats - counts of coalesced queries
+    time_limit - context manager setting the time limit of queries
+    in_flight - the queries running now
+    downsample - statistics of columns in equal time intervals
+    primary_key - name of the primary key column of a table
+    follow - yields the rows added to a table as they arrive
+    subscribe - calls a function with the rows added to a table
+
+  In pooled mode (pool_size given) each query runs on a connection checked
+  out of a bounded pool, so several threads can query concurrently.  Pooled
+  connections are in autocommit mode and are only pinged after being idle,
+  which avoids the COMMIT round trip that checkDB() makes before every query.
+
+  With cache_bytes given, the results of SELECT queries are kept in a
+  QueryCache.  Writing to a table through insertRecord, insert_records,
+  updateValues, updateRecord or a query drops the cached results for it.
+
+  With instrument=True the latency of each statement sent to the server is
+  recorded in a QueryStats, by statement template.
+
+  With coalesce=True a SELECT which is identical to one already running, in
+  another thread, waits for that one's result instead of being sent again.
+  This works with the pool and with the cache.
+
+  A query which runs longer than its time limit, BaseDB.timeout or the one
+  set by time_limit(), is stopped with KILL QUERY from another connection,
+  opened once and kept, and QueryTimeout is raised.  The connection which
+  ran the query is only released when the KILL is done, so that it cannot
+  stop the next statement, e.g.::
+    with db.time_limit(10):
+      data = db.get_rows_by_date('weather', ['utc', 'TAmb'], 2020, 97)
+  This applies to the queries of get(), get_as_dict() and the methods which
+  use them.
+
+  The DB-API driver is MySQLdb unless another backend is given; see
+  'backends'.  The 'sqlite' backend needs no server, e.g.::
+    db = BaseDB(name=":memory:", backend="sqlite")
+  """
+  def __init__(self, host=None, user=None , pw=None, name=None, port=3306,
+               pool_size=None, idle_check=30., schema_ttl=300.,
+               cache_bytes=None, cache_ttl=60., instrument=False,
+               slow_query=None, backend="MySQLdb", coalesce=False,
+               timeout=None):
+    """
+    Initializes a BaseDB instance by connecting to the database
+    
+    This defaults to the GAVRT DSS-28 EAC database on 'kracken'.  However, use
+    of sub-class DSS28db is recommended to avoid writing acciden
+    
+    @param host : the IP address as a string, or fully qualified host name
+    @type  host : str
+    
+    @param user : a valid user on the mysql server at host
+    
+    @param pw : user's password or "" if not required
+    
+    @param db : database name (string)
+
+    @param pool_size : maximum number of pooled connections; None for the
+                       original single connection mode
+    @type  pool_size : int
+
+    @param idle_check : seconds a pooled connection may be idle before it is
+                        pinged on checkout
+    @type  idle_check : float
+
+    @param schema_ttl : seconds for which the cached column information of
+                        the tables is used
+    @type  schema_ttl : float
+
+    @param cache_bytes : maximum size of cached query results; None for no
+                         caching
+    @type  cache_bytes : int
+
+    @param cache_ttl : seconds for which a cached query result is used
+    @type  cache_ttl : float
+
+    @param instrument : record query latency statistics
+    @type  instrument : bool
+
+    @param slow_query : latency (s) above which a statement is logged; this
+                        also turns on the statistics
+    @type  slow_query : float
+
+    @param backend : name of a backend in 'backends', or a Backend
+    @type  backend : str
+
+    @param coalesce : share the result of identical concurrent SELECTs
+    @type  coalesce : bool
+
+    @param timeout : default time limit (s) of a query; None for no limit
+    @type  timeout : float
+    
+    Generates a cursor object BaseDB.c.  In pooled mode the connection and
+    cursor are only opened when cursor() or checkDB() is called.
+    """
+    self.logger = logging.getLogger(logger.name+".BaseDB")
+    self.backend = get_backend(backend)
+    if name and (not self.backend.login or (host and user and pw)):
+      self.name= name
+      self.host = host
+      self.port = port
+      self.user = user
+      self.pw = pw
+      self._max_packet = None
+      self._id_step_value = None
+      if instrument or slow_query is not None:
+        self.statistics = QueryStats(slow_query)
+      else:
+        self.statistics = None
+      self.schema = self.backend.schema_cache(self._execute_query, name,
+                                              schema_ttl)
+      if cache_bytes:
+        self.cache = QueryCache(max_bytes=cache_bytes, ttl=cache_ttl)
+      else:
+        self.cache = None
+      if coalesce:
+        self.flights = SingleFlight()
+      else:
+        self.flights = None
+      self.timeout = timeout
+      self._local = threading.local()
+      self._running = {} # id -> dict describing a query being executed
+      self._running_lock = threading.Lock()
+      self._cancelling = {} # id -> event set when the cancel is done
+      self._side = None     # connection on which queries are cancelled
+      self._side_lock = threading.Lock()
+      self.writer = None
+      if pool_size:
+        self.db = None
+        self.c = None
+        self.pool = ConnectionPool(self._pooled_connection, size=pool_size,
+                                   idle_check=idle_check,
+                                   ping=self.backend.ping,
+                                   errors=self.backend.OperationalError)
+        self.logger.debug("__init__: pool of %d connections created.",
+                          pool_size)
+      else:
+        self.pool = None
+        self.connect()
+        self.logger.debug("__init__: database connected.")
+    else:
+      self.logger.error("__init__: host, user, pw and DB name required")
+      raise MysqlException("Missing arguments host=%s, user=%s, name=%s or missing pw?",
+                           host, user, name)
+
+  def connect(self):
+    """
+    Make a connection to the database. Creates a cursor object.
+    
+    Automatically invoked when an instance is created; can be called
+    again if the connection is closed but the database object persists.
+    """
+    self.db = self._open_connection()
+    self.c = self.db.cursor()
+
+  def _open_connection(self):
+    """
+    Opens a new connection to the database
+    """
+    return self.backend.connect(self.host, self.port, self.user, self.pw,
+                                self.name)
+
+  def _pooled_connection(self):
+    """
+    Opens a connection for the pool
+
+    Autocommit makes each query see current data without a COMMIT.
+    """
+    conn = self._open_connection()
+    self.backend.autocommit(conn)
+    return conn
+
+  def close(self, timeout=10.):
+    """
+    Close a connection
+
+    Records still held by the LogWriter are written first, for at most
+    'timeout' seconds; those left are in its spool file, if it has one.
+
+    @param timeout : maximum wait (s) for the LogWriter
+    @type  timeout : float
+    """
+    if self.writer:
+      self.writer.close(timeout)
+    with self._side_lock:
+      if self._side:
+        self._side.close()
+        self._side = None
+    if self.c:
+      self.c.close()
+    if self.pool:
+      self.pool.close()
+
+  @contextlib.contextmanager
+  def connection(self):
+    """
+    Provides a live connection for the duration of a 'with' block
+
+    In pooled mode the connection is checked out of the pool and returned
+    afterwards.  Otherwise it is BaseDB.db, reconnected if necessary.
+    """
+    if self.pool:
+      with self.pool.connection() as conn:
+        yield conn
+    else:
+      self.checkDB()
+      yield self.db
+
+  def pool_stats(self):
+    """
+    Connection pool statistics
+
+    @return: dict, empty if not in pooled mode
+    """
+    if self.pool:
+      return self.pool.stats()
+    return {}
+
+  def cache_stats(self):
+    """
+    Query cache statistics
+
+    @return: dict, empty if there is no cache
+    """
+    if self.cache:
+      return self.cache.stats()
+    return {}
+
+  def coalesce_stats(self):
+    """
+    Numbers of SELECTs asked for, sent and deduplicated
+
+    @return: dict, see SingleFlight.stats(); empty if not coalescing
+    """
+    if self.flights:
+      return self.flights.stats()
+    return {}
+
+  def invalidate(self, table):
+    """
+    Drops the cached query results for a table
+
+    This is needed after writing to the table on a connection from
+    connection(), which does not go through the cache.
+    """
+    if self.cache:
+      self.cache.invalidate(table)
+    if self.flights:
+      self.flights.invalidate()
+
+  def _execute(self, *args):
+    """
+    Executes a query and fetches all the rows
+
+    The result of a SELECT is taken from or added to BaseDB.cache if there is
+    one; any other query drops the cached results for its tables.  When
+    coalescing, a SELECT which is not cached shares the execution of an
+    identical one already running.
+
+    @param args : query and optional parameters
+
+    @return: (rows, cursor description)
+    """
+    if self.cache is None and self.flights is None:
+      return self._execute_query(*args)
+    key = QueryCache.key(*args)
+    if key is None:
+      try:
+        return self._execute_query(*args)
+      finally:
+        for table in QueryCache.tables(args[0]):
+          self.invalidate(table)
+    if self.cache:
+      try:
+        return self.cache.get(key)
+      except KeyError:
+        pass
+    if self.flights:
+      return self.flights.do(key, lambda: self._fetch(key, *args))
+    return self._fetch(key, *args)
+
+  def _fetch(self, key, *args):
+    """
+    Executes a SELECT and adds the result to the cache if there is one
+    """
+    if self.cache is None:
+      return self._execute_query(*args)
+    generation = self.cache.generation
+    result = self._execute_query(*args)
+    self.cache.put(key, result, generation)
+    return result
+
+  def query_stats(self):
+    """
+    Query latency statistics
+
+    The connection pool statistics are included in pooled mode.
+
+    @return: dict, see QueryStats.stats(); empty if not instrumented
+    """
+    if self.statistics is None:
+      return {}
+    stats = self.statistics.stats()
+    if self.pool:
+      stats['pool'] = self.pool.stats()
+    return stats
+
+  @contextlib.contextmanager
+  def _timed(self, query, params=None):
+    """
+    Records the latency of the statement(s) in a 'with' block
+
+    The block may set 'rows' and 'bytes' in the dict it is given.
+    """
+    result = {'rows': 0, 'bytes': 0}
+    if self.statistics is None:
+      yield result
+      return
+    start = time.time()
+    try:
+      yield result
+    except Exception:
+      self.statistics.record(query, params, time.time() - start, error=True)
+      raise
+    self.statistics.record(query, params, time.time() - start,
+                           result['rows'], result['bytes'])
+
+  def _execute_query(self, *args):
+    """
+    Executes a query on the server and fetches all the rows
+
+    @param args : query and optional parameters
+
+    @return: (rows, cursor description)
+    """
+    if self.statistics is None:
+      return self._send(*args)
+    with self._timed(*args) as timing:
+      rows, descr = self._send(*args)
+      timing['rows'] = len(rows)
+      timing['bytes'] = result_size(rows)
+    return rows, descr
+
+  def _send(self, *args):
+    """
+    Sends a query to the server and fetches all the rows
+
+    In single connection mode this uses BaseDB.c, as before.
+
+    @param args : query and optional parameters
+
+    @return: (rows, cursor description)
+    """
+    with self.connection() as conn:
+      if self.pool:
+        c = conn.cursor()
+        try:
+          with self._watch(conn, *args):
+            c.execute(*args)
+            return c.fetchall(), c.description
+        finally:
+          c.close()
+      else:
+        with self._watch(conn, *args):
+          self.c.execute(*args)
+          return self.c.fetchall(), self.c.description
+
+  @contextlib.contextmanager
+  def time_limit(self, timeout):
+    """
+    Sets the time limit of the queries made by this thread in a 'with' block
+
+    @param timeout : time limit (s); None for no limit
+    @type  timeout : float
+    """
+    previous = getattr(self._local, 'timeout', self._local)
+    self._local.timeout = timeout
+    try:
+      yield
+    finally:
+      if previous is self._local:
+        del self._local.timeout
+      else:
+        self._local.timeout = previous
+
+  @contextlib.contextmanager
+  def _watch(self, conn, query, params=None):
+    """
+    Registers a statement as running and cancels it at its time limit
+    """
+    timeout = getattr(self._local, 'timeout', self.timeout)
+    entry = {'query': query, 'params': params, 'start': time.time(),
+             'thread': threading.current_thread().name, 'timeout': timeout,
+             'cancelled': False}
+    with self._running_lock:
+      self._running[id(entry)] = entry
+    timer = None
+    if timeout is not None:
+      timer = threading.Timer(timeout, self._cancel, (conn, entry))
+      timer.daemon = True
+      timer.start()
+    try:
+      yield entry
+    except Exception:
+      if entry['cancelled']:
+        if self.statistics:
+          self.statistics.count('timeouts')
+        raise QueryTimeout("query cancelled after %.1f s: %s", timeout,
+                           QueryCache.normalize(query)[:200])
+      raise
+    finally:
+      with self._running_lock:
+        del self._running[id(entry)]
+        cancelling = self._cancelling.get(id(entry))
+      if timer:
+        timer.cancel()
+      if cancelling:
+        # the connection must not run another statement until it is done
+        cancelling.wait()
+
+  def _cancel(self, conn, entry):
+    """
+    Stops a statement which has run longer than its time limit
+
+    The statement's thread waits in _watch() until this returns, so the
+    connection is not given to another statement in the meantime.
+    """
+    done = threading.Event()
+    with self._running_lock:
+      if id(entry) not in self._running:
+        return
+      entry['cancelled'] = True
+      self._cancelling[id(entry)] = done
+    self.logger.warning("_cancel: %.1f s limit reached by %s",
+                        entry['timeout'], QueryCache.normalize(entry['query']))
+    try:
+      with self._side_lock:
+        try:
+          self.backend.cancel(conn, self._side_connection)
+        except Exception:
+          if self._side:
+            self._side.close()
+            self._side = None
+          raise
+    except Exception as details:
+      self.logger.error("_cancel: could not stop the query: %s", details)
+    finally:
+      with self._running_lock:
+        del self._cancelling[id(entry)]
+      done.set()
+
+  def _side_connection(self):
+    """
+    The connection on which queries are cancelled, opened when first needed
+
+    The caller holds BaseDB._side_lock.
+    """
+    if self._side is None:
+      self._side = self._pooled_connection()
+    return self._side
+
+  def in_flight(self):
+    """
+    The statements being executed, longest running first
+
+    @return: list of dicts with 'query', 'params', 'thread', 'elapsed',
+             'timeout' and 'cancelled'
+    """
+    now = time.time()
+    with self._running_lock:
+      running = [dict(entry) for entry in self._running.values()]
+    for entry in running:
+      entry['elapsed'] = now - entry.pop('start')
+    return sorted(running, key=lambda entry: -entry['elapsed'])
+    
+  def checkDB(self):
+    """
+    Reconnects to the database if the connection has been lost.
+    """
+    try:
+      self.db.commit()
+    except:
+      self.connect()
+      if self.statistics:
+        self.statistics.count('reconnects')
+    self.db.commit()
+
+  def cursor(self):
+    """
+    Creates a database cursor object; same as BaseDB.c but this
+    is better because it handles disconnected a database
+    """
+    self.checkDB()
+    return self.db.cursor()
+
+  def send_query(self,query):
+    """
+    Send a MySQL query
+
+    @param crsr : cursor object for a database
+
+    @param query : MySQL query
+    @type  query : str
+
+    @return: str with query response
+    """
+    query += ";"
+    response, descr = self._execute(query)
+    return response
+
+  def commit(self):
+    """
+    Commits the most recent database transaction
+
+    Pooled connections are in autocommit mode so there is nothing to do.
+    """
+    if self.db is None:
+      return
+    return self.db.commit()
+        
+  def insertRecord(self, table, rec):
+    """
+    Inserts a record into the database; handles a disconnected database
+
+    @param table : table name
+    @type  table : str
+
+    @param rec : a dictionary with column names as keys.
+
+    @return: record ID (int)
+    """
+    try:
+      with self._timed("INSERT INTO "+table) as timing:
+        with self.connection() as conn:
+          ID = insert_record(conn, table, rec)
+        timing['rows'] = 1
+      return ID
+    finally:
+      self.invalidate(table)
+
+  def updateRecord(self, table, fields, condition):
+    """
+    Updates the records selected by a condition; see update_record()
+
+    @param table : table name
+    @type  table : str
+
+    @param fields : dictionary with column names and the values to be updated
+
+    @param condition :  for the condition which selects the record(s)
+    @type  condition : (column name, value tuple)
+    """
+    try:
+      with self.connection() as conn:
+        return update_record(conn, table, fields, condition)
+    finally:
+      self.invalidate(table)
+
+  def insert_records(self, table, records, batch_size=1000):
+    """
+    Inserts many records into a table with multi-row INSERT statements
+
+    Records with the same set of columns are inserted together, with at most
+    'batch_size' rows in a statement.  Statements are also kept well under
+    the server's max_allowed_packet.  Each statement is committed when done.
+
+    The IDs are computed from the first auto-increment value of each
+    statement and the server's auto_increment_increment.  With
+    innodb_autoinc_lock_mode=2 (interleaved) the IDs of the rows of a
+    statement need not be consecutive, so then only the ID of the first row
+    of each statement is known and the others are None.
+
+    If a statement fails, the exception raised has a 'committed' attribute,
+    the indices in 'records' of the rows committed by earlier statements.
+
+    @param table : table name
+    @type  table : str
+
+    @param records : dicts with column names as keys
+    @type  records : list of dict
+
+    @param batch_size : maximum number of rows in a statement
+    @type  batch_size : int
+
+    @return: list of record IDs (int or None) in the order of the records
+    """
+    groups = collections.OrderedDict()
+    for index, rec in enumerate(records):
+      groups.setdefault(tuple(sorted(rec.keys())), []).append(index)
+    IDs = [None]*len(records)
+    max_length = self._max_statement_length()
+    step = self._id_step()
+    committed = []
+    with self.connection() as conn:
+      c = conn.cursor()
+      try:
+        for columns, indices in groups.items():
+          head = "INSERT INTO "+table+" (" \
+                 +", ".join(["`"+col+"`" for col in columns])+") VALUES "
+          row_fmt = "("+", ".join(["%s"]*len(columns))+")"
+          start = 0
+          while start < len(indices):
+            # add rows until the batch or the statement is full
+            stop = start
+            length = len(head)
+            while stop < len(indices) and stop - start < batch_size:
+              rec = records[indices[stop]]
+              # allow for separators
+              row_length = sum([literal_length(rec[col]) + 2
+                                for col in columns])
+              if stop > start and length + row_length > max_length:
+                break
+              length += row_length
+              stop += 1
+            batch = indices[start:stop]
+            with self._timed(head + row_fmt) as timing:
+              c.execute(head + ", ".join([row_fmt]*len(batch)),
+                        [records[index][col] for index in batch
+                                             for col in columns])
+              first_ID = c.lastrowid
+              conn.commit()
+              timing['rows'] = len(batch)
+              timing['bytes'] = length
+            if first_ID and step:
+              for count, index in enumerate(batch):
+                IDs[index] = first_ID + count*step
+            elif first_ID:
+              IDs[batch[0]] = first_ID
+            committed.extend(batch)
+            start = stop
+      except Exception as details:
+        details.committed = sorted(committed)
+        raise
+      finally:
+        c.close()
+        self.invalidate(table)
+    return IDs
+
+  def _max_statement_length(self):
+    """
+    Length allowed for a statement, half of the server's max_allowed_packet
+    """
+    if self._max_packet is None and not self.backend.max_packet_query:
+      self._max_packet = 1048576
+    elif self._max_packet is None:
+      try:
+        rows, descr = self._execute(self.backend.max_packet_query)
+        self._max_packet = int(rows[0][0])
+      except self.backend.Error as details:
+        self.logger.warning(
+                "_max_statement_length: assuming 1 MB max_allowed_packet: %s",
+                details)
+        self._max_packet = 1048576
+    return self._max_packet//2
+
+  def _id_step(self):
+    """
+    Difference between the IDs of consecutive rows of a multi-row INSERT
+
+    @return: int, or None if the IDs need not be evenly spaced
+    """
+    if self._id_step_value is None and not self.backend.autoinc_query:
+      self._id_step_value = 1
+    elif self._id_step_value is None:
+      try:
+        rows, descr = self._execute(self.backend.autoinc_query)
+        increment, lock_mode = [int(value) for value in rows[0]]
+      except self.backend.Error as details:
+        self.logger.warning("_id_step: assuming consecutive IDs: %s", details)
+        increment, lock_mode = 1, 1
+      if lock_mode == 2:
+        self.logger.warning("_id_step: interleaved auto-increment locks; "
+                            "insert_records only returns first IDs")
+        self._id_step_value = 0
+      else:
+        self._id_step_value = increment
+    return self._id_step_value or None
+
+  def getLastId(self, table):
+    """
+    ID of the last record
+    
+    @param table : the name of the table
+    @type  table : str
+
+    @return: ID (int)
+    """
+    #return get_last_id(self.db,table)
+    ID = table+"_id"
+    rows, descr = self._execute(
+              "SELECT "+ID+" FROM " + table + " ORDER BY "+ID+" DESC LIMIT 1;")
+    return int(rows[0][0])
+
+  
+  def getLastRecord(self,table):
+    """
+    Returns the last record as a dictionary
+    
+    @param table : name of the table (string)
+
+    @return: dict
+    """
+    rows, descr = self._execute(
+                         "SELECT * FROM " + table + " ORDER BY ID DESC LIMIT 1;")
+    # This returns the column names
+    descr = [x[0] for x in descr]
+    # This returns the row as a dictionary
+    return dict(list(zip(descr,rows[0])))
+  
+  def getRecordById(self,table,rec_id):
+    """
+    Get the record with the given ID
+    
+    @param table : table name
+    @type  table : str
+    
+    @param id : row ID
+    @type  id : int
+
+    @return: dict
+    """
+    rows, descr = self._execute("SELECT * FROM " + table + " WHERE ID = %s;",
+                                (rec_id,))
+    descr = [x[0] for x in descr]
+    return dict(list(zip(descr,rows[0])))
+    
+  def get(self,*args):
+    """
+    Executes a query of the database
+    
+    @param args : query to be executed
+    
+    @return: record (dict)
+    """
+    rows, descr = self._execute(*args)
+    result = np.array(rows)
+    return result
+    
+  def get_as_dict(self, *args, **kwargs):
+    """
+    Executes a query of the database and returns the result as a dict
+  
+    The columns are decoded by decode_rows() into typed numpy arrays according
+    to their MySQL field types.  Recognized keywords are::
+      asfloat    - numeric columns, and string columns holding only numbers,
+                   are float64, NULL being NaN (default True)
+      masked     - columns are numpy masked arrays, NULL being masked
+      structured - return a numpy structured array instead of a dict
+  
+    If the query returns multiple rows, each value associated with a keyword will
+    be an array. If nothing was found, an empty dictionary is returned.
+    
+    @param db : database connection object
+    
+    @param args: query to be executed
+    
+    @param kwargs : a dictionary with keyword arguments.
+    
+    @eturn: the record as a dictionary.
+    """
+    try:
+      asfloat = kwargs['asfloat']
+    except:
+      asfloat = True
+    rows, descr = self._execute(*args)
+    if kwargs.get('masked') or kwargs.get('structured'):
+      if len(rows) == 0:
+        return {}
+      return decode_rows(rows, descr, asfloat=asfloat,
+                         masked=kwargs.get('masked', False),
+                         structured=kwargs.get('structured', False))
+    return self._rows_to_dict(rows, descr, asfloat)
+
+  def iter_query(self, query, params=None, chunk_rows=10000, asfloat=True,
+                 masked=False):
+    """
+    Executes a query and yields the result in chunks of rows
+
+    This uses a server-side cursor (e.g. MySQLdb.cursors.SSCursor) so the rows are
+    not all held in memory at once.  Each chunk is a dict of numpy arrays
+    keyed on column name, like the result of get_as_dict().  For example::
+
+      total = 0.
+      count = 0
+      for chunk in db.iter_query("select TAmb from weather where year=%s",
+                                 (2019,)):
+        total += chunk['TAmb'].sum()
+        count += len(chunk['TAmb'])
+
+    The query runs on a connection of its own, a pooled one in pooled mode,
+    which is held until the iteration finishes or the generator is closed.
+
+    @param query : query to be executed
+    @type  query : str
+
+    @param params : query parameters
+
+    @param chunk_rows : maximum number of rows in a chunk
+    @type  chunk_rows : int
+
+    @param asfloat : convert to float the columns for which it is possible
+    @type  asfloat : bool
+
+    @param masked : return numpy masked arrays with NULL values masked
+    @type  masked : bool
+
+    @return: generator of dicts of numpy arrays
+    """
+    if self.pool:
+      context = self.pool.connection()
+    else:
+      context = contextlib.closing(self._open_connection())
+    with context as conn:
+      c = self.backend.server_cursor(conn)
+      try:
+        c.execute(query, params)
+        while True:
+          rows = c.fetchmany(chunk_rows)
+          if not rows:
+            break
+          yield self._rows_to_dict(rows, c.description, asfloat, masked)
+      finally:
+        c.close()
+
+  def _rows_to_dict(self, rows, descr, asfloat=True, masked=False):
+    """
+    Converts fetched rows to a dict of numpy arrays keyed on column name
+
+    @param rows : rows returned by a query
+    @type  rows : sequence of tuples
+
+    @param descr : cursor description for the rows
+
+    @param asfloat : convert to float the columns for which it is possible
+    @type  asfloat : bool
+
+    @param masked : return numpy masked arrays with NULL values masked
+    @type  masked : bool
+
+    @return: dict, empty if there are no rows
+    """
+    if len(rows) == 0:
+      return {}
+    return decode_rows(rows, descr, asfloat=asfloat, masked=masked)
+        
+  def updateValues(self, vald, table):
+    """
+    Add row with updated values
+    
+    Add a new row to table with same values as previous row,
+    except for keys in vald, which are updated with provided
+    values.  This is useful for keeping logs.
+
+    @param vald : updated values
+    @type  vald : dict
+
+    @param table : table name
+    @type  table : str
+    """
+    if self.writer:
+      self.writer.update(table, vald)
+      return
+    lastrec = _strip_auto_increment(self, table, self.getLastRecord(table))
+    lastrec.update(vald)
+    self.insertRecord(table, lastrec)
+
+  def write_behind(self, spool=None, **kwargs):
+    """
+    Makes updateValues() write through a LogWriter
+
+    updateValues() then returns without waiting for the database.  BaseDB
+    must be in pooled mode so that the writer's thread does not share
+    BaseDB.db with the caller.
+
+    @param spool : path of the LogWriter's spool file
+    @type  spool : str
+
+    @param kwargs : other LogWriter arguments
+
+    @return: LogWriter
+    """
+    if not self.pool:
+      raise MysqlException("write_behind: needs BaseDB in pooled mode")
+    self.writer = LogWriter(self, spool=spool, **kwargs)
+    return self.writer
+
+  def get_public_tables(self):
+    """
+    List the table names in the database.
+
+    @return: tuple of tuples of str
+    """
+    try:
+      result = tuple([(table,) for table in self.schema.tables()])
+    except self.backend.Error as e:
+      self.logger.error(
+                  "get_public_tables: MySQLdb error: Cannot connect to server")
+      self.logger.error("get_public_tables: error code:",e.args[0])
+      self.logger.error("get_public_tables: error message:",e.args[1])
+      result = None
+    return result
+
+  def get_columns(self, table):
+    """
+    Returns information about the columns of a table
+
+    The information comes from BaseDB.schema.
+    """
+    return self.schema.columns(table)
+  
+  def get_data_index(self):
+    """
+    Information about the columns of all the tables, keyed on table name
+    """
+    tableindex = {}
+    for table in self.schema.tables():
+      tableindex[table] = self.schema.columns(table)
+    return tableindex
+    
+  def report_table(self,table,columns):
+    """
+    Reports on the columns in a table
+    
+    Response has keys: Extra, Default, Field, Key, Null, Type
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of column names
+    @type  columns : list of str
+
+    @return: result of query
+    """
+    self.logger.info("report_table: showing name and type of columns for %s",
+                     table)
+    response = self.schema.columns(table)
+    self.logger.debug("report_table: response: %s", response)
+    report = []
+    for row in response:
+      name = row[0]
+      for column in columns:
+        if name == column:
+          report.append(row)
+    return report
+
+  def get_rows_by_date(self, table, columns, year, doy):
+    """
+    Gets data from a table
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @type year : int
+
+    @param doy : day of year
+    @type  doy : int
+
+    @return: dict of numpy arrays keyed on column name
+    """
+    columnstr = str(columns).lstrip('[').rstrip(']').replace("'","")
+    try:
+      response = self.get_as_dict("select " + columnstr
+                        + " from "+table+" where year=%s and doy=%s",
+                        (year,doy))
+    except self.backend.OperationalError as details:
+      print("MySQLdb OperationalError:",details)
+    else:
+      return response
+
+  def get_rows_by_time(self, table, columns, year, doy, utcs, tolerance=0,
+                       chunk_size=1000):
+    """
+    Queries a table for quantities in columns at designated times
+
+    The rows are fetched in a few queries and matched to the requested times
+    with a binary search.  With 'tolerance' zero, rows are selected with
+    IN-lists of at most 'chunk_size' times and the row with exactly the
+    requested time is used.  Otherwise all the rows in the range of the
+    requested times are selected with one query and the nearest row within
+    'tolerance' seconds is used.  When several rows have the same time, the
+    first one found is used.
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @type year : int
+
+    @param doy : day of year
+    @type  doy : int
+
+    @param utcs : times to be selected; first occurrence is used
+    @type  utcs : list of unixtimes (seconds since the epoch)
+
+    @param tolerance : maximum difference (s) for a nearest sample match
+    @type  tolerance : float
+
+    @param chunk_size : maximum number of times in one IN-list
+    @type  chunk_size : int
+
+    @return: dict of numpy arrays keyed on column name
+
+    @raise MysqlException: if a time has no matching row.  (Before the
+                           batched lookup a missing time raised IndexError
+                           from the per-time query.)
+    """
+    utcs = np.asarray(utcs, dtype=float)
+    if len(utcs) == 0:
+      return dict([(col, np.array([])) for col in columns])
+    selected = list(columns)
+    if 'utc' not in selected:
+      selected.append('utc')
+    columnstr = ", ".join(selected)
+    rows = []
+    descr = None
+    if tolerance:
+      fmt = "select "+columnstr+" from "+table \
+            +" where year=%s and doy=%s and utc between %s and %s order by utc;"
+      rows, descr = self._execute(fmt, (year, doy,
+                                        float(utcs.min()) - tolerance,
+                                        float(utcs.max()) + tolerance))
+    else:
+      wanted = np.unique(utcs)
+      rows = []
+      for start in range(0, len(wanted), chunk_size):
+        chunk = wanted[start:start+chunk_size].tolist()
+        fmt = "select "+columnstr+" from "+table \
+              +" where year=%s and doy=%s and utc in (" \
+              +", ".join(["%s"]*len(chunk))+") order by utc;"
+        result, descr = self._execute(fmt, tuple([year, doy] + chunk))
+        # the chunks are in ascending order so the rows stay sorted
+        rows.extend(result)
+    if len(rows) == 0:
+      raise MysqlException("get_rows_by_time: no rows in %s for %s/%s",
+                           table, year, doy)
+    data = self._rows_to_dict(rows, descr)
+    times = data['utc'].astype(float)
+    # a stable sort keeps the first occurrence of each time first
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    index = np.searchsorted(times, utcs)
+    if tolerance:
+      before = np.clip(index - 1, 0, len(times) - 1)
+      after = np.clip(index, 0, len(times) - 1)
+      use_before = np.abs(utcs - times[before]) <= np.abs(times[after] - utcs)
+      index = np.where(use_before, before, after)
+      missed = np.abs(times[index] - utcs) > tolerance
+    else:
+      index = np.clip(index, 0, len(times) - 1)
+      missed = times[index] != utcs
+    if missed.any():
+      raise MysqlException("get_rows_by_time: %d times not found in %s, e.g. %s",
+                           missed.sum(), table, utcs[missed][0])
+    index = order[index]
+    data = dict([(col, data[col][index]) for col in columns])
+    return data
+
+  def get_rows_by_range(self, table, columns, start, end, partition='day',
+                        max_concurrency=None, progress=None, asfloat=True):
+    """
+    Gets the rows of a table between two times
+
+    The range is split at UTC day or hour boundaries and the partitions are
+    fetched concurrently on the connections of the pool, at most
+    'max_concurrency' at a time.  Without a pool they are fetched one after
+    the other.  The table must have 'year', 'doy' and 'utc' columns.
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @param start : first time (UTC) of the range
+    @type  start : datetime, date or unixtime
+
+    @param end : time (UTC) at which the range ends, excluded
+    @type  end : datetime, date or unixtime
+
+    @param partition : 'day' or 'hour'
+    @type  partition : str
+
+    @param max_concurrency : maximum number of partitions fetched at once;
+                             default the size of the pool
+    @type  max_concurrency : int
+
+    @param progress : function called with the number of partitions fetched
+                      and the total after each partition
+    @type  progress : callable
+
+    @param asfloat : convert to float the columns for which it is possible
+    @type  asfloat : bool
+
+    @return: dict of numpy arrays keyed on column name, in time order
+    """
+    try:
+      step = {'day': 86400, 'hour': 3600}[partition]
+    except KeyError:
+      raise MysqlException("get_rows_by_range: unknown partition %s",
+                           partition)
+    start, end = unixtime(start), unixtime(end)
+    selected = columns if 'utc' in columns else columns + ['utc']
+    query = "SELECT " + ", ".join(selected) + " FROM " + table \
+            + " WHERE year=%s AND doy=%s AND utc >= %s AND utc < %s;"
+    partitions = []
+    first = start
+    while first < end:
+      last = min((first//step + 1)*step, end)
+      when = time.gmtime(first)
+      partitions.append((when.tm_year, when.tm_yday, first, last))
+      first = last
+    if self.pool:
+      workers = max_concurrency or self.pool.size
+    else:
+      workers = 1
+
+    def fetch(params):
+      rows, descr = self._execute(query, params)
+      return self._rows_to_dict(rows, descr, asfloat)
+
+    results = [None]*len(partitions)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = dict([(executor.submit(fetch, params), index)
+                      for index, params in enumerate(partitions)])
+      # progress as the partitions finish, in whatever order
+      for done, future in enumerate(concurrent.futures.as_completed(futures)):
+        results[futures[future]] = future.result()
+        if progress:
+          progress(done + 1, len(partitions))
+    chunks = [chunk for chunk in results if chunk]
+    if not chunks:
+      return {}
+    data = dict([(col, np.concatenate([chunk[col] for chunk in chunks]))
+                 for col in selected])
+    if np.any(np.diff(data['utc']) < 0):
+      order = np.argsort(data['utc'], kind='stable')
+      data = dict([(col, data[col][order]) for col in selected])
+    return dict([(col, data[col]) for col in columns])
+
+  def downsample(self, table, columns, start, end, buckets=1000):
+    """
+    Statistics of columns in equal time intervals between two times
+
+    The range is divided into 'buckets' intervals and the server returns the
+    minimum, maximum, mean and count of the non-NULL values of each column
+    for each interval, grouping on the interval number computed from 'utc'.
+    The table must have 'year', 'doy' and 'utc' columns; the rows are
+    selected on all three, as by get_rows_by_range(), so that the server can
+    use the index on the day.
+    This is meant for plots of long ranges, for which fetching every row
+    would be wasteful.  For example::
+
+      data = db.downsample('weather', ['TAmb'], start, end, buckets=500)
+      fill_between(data['utc'], data['TAmb']['min'], data['TAmb']['max'])
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of numeric columns
+    @type  columns : list of str
+
+    @param start : first time (UTC) of the range
+    @type  start : datetime, date or unixtime
+
+    @param end : time (UTC) at which the range ends, excluded
+    @type  end : datetime, date or unixtime
+
+    @param buckets : number of intervals
+    @type  buckets : int
+
+    @return: dict with the start times of the intervals under 'utc' and, for
+             each column, a structured array with fields 'min', 'max',
+             'mean' and 'count'; empty intervals have count 0 and NaNs
+    """
+    start, end = unixtime(start), unixtime(end)
+    width = (end - start)/buckets
+    if width <= 0:
+      raise MysqlException("downsample: empty range %s to %s", start, end)
+    bucket = self.backend.floor % ("(utc - %s)/%s")
+    aggregates = []
+    for col in columns:
+      aggregates += ["MIN(%s)" % col, "MAX(%s)" % col, "AVG(%s)" % col,
+                     "COUNT(%s)" % col]
+    days, day_params = day_range(start, end)
+    query = "SELECT " + bucket + " AS bucket, " + ", ".join(aggregates) \
+            + " FROM " + table + " WHERE " + days \
+            + " AND utc >= %s AND utc < %s GROUP BY bucket ORDER BY bucket;"
+    rows, descr = self._execute(query, (start, width) + day_params
+                                       + (start, end))
+    return bucket_statistics(rows, columns, start, width, buckets)
+
+  def primary_key(self, table):
+    """
+    Name of the first primary key column of a table, 'ID' if not known
+    """
+    try:
+      for column in self.schema.columns(table):
+        if column[3] == 'PRI':
+          return column[0]
+    except (MysqlException, self.backend.Error) as details:
+      self.logger.debug("primary_key: %s", details)
+    return 'ID'
+
+  def _last_key(self, table, key):
+    """
+    Largest value of a key column, 0 for an empty table
+    """
+    rows, descr = self._execute_query("SELECT MAX(" + key + ") FROM "
+                                      + table + ";")
+    return rows[0][0] if rows and rows[0][0] is not None else 0
+
+  def follow(self, table, columns, since_id=None, min_interval=0.5,
+             max_interval=30., chunk_rows=10000, asfloat=True, stop=None):
+    """
+    Yields the rows added to a table, as they arrive
+
+    Only the rows with a primary key larger than the last one seen are
+    selected, so each poll costs the same however long the table grows.  For
+    example, a live display could do::
+
+      for chunk in db.follow('weather', ['utc', 'TAmb']):
+        plot(chunk['utc'], chunk['TAmb'])
+
+    Each chunk is a dict of numpy arrays keyed on column name, like the
+    result of get_as_dict(), which includes the primary key column.  The
+    interval between polls follows the mean interval between arrivals,
+    within 'min_interval' and 'max_interval'.  It doubles after each poll
+    that finds nothing.  When a poll fills a chunk the next one is sent at
+    once.  The generator ends when 'stop' is set or when it is closed.
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @param since_id : primary key after which to start; None starts after
+                      the last row in the table
+    @type  since_id : int
+
+    @param min_interval : shortest time (s) between polls
+    @type  min_interval : float
+
+    @param max_interval : longest time (s) between polls
+    @type  max_interval : float
+
+    @param chunk_rows : maximum number of rows in a chunk
+    @type  chunk_rows : int
+
+    @param asfloat : convert to float the columns for which it is possible
+    @type  asfloat : bool
+
+    @param stop : event which ends the generator when set
+    @type  stop : threading.Event
+
+    @return: generator of dicts of numpy arrays
+    """
+    key = self.primary_key(table)
+    selected = [key] + [col for col in columns if col != key]
+    query = "SELECT " + ", ".join(selected) + " FROM " + table \
+            + " WHERE " + key + " > %s ORDER BY " + key + " LIMIT %s;"
+    if since_id is None:
+      since_id = self._last_key(table, key)
+    if stop is None:
+      stop = threading.Event()
+    interval = min_interval
+    last_arrival = time.time()
+    while not stop.is_set():
+      try:
+        rows, descr = self._execute_query(query, (since_id, chunk_rows))
+      except self.backend.OperationalError as details:
+        self.logger.warning("follow: %s: %s", table, details)
+        interval = max_interval
+        rows = ()
+      else:
+        if rows:
+          now = time.time()
+          interval = min(max((now - last_arrival)/len(rows), min_interval),
+                         max_interval)
+          last_arrival = now
+          since_id = rows[-1][0]
+          yield self._rows_to_dict(rows, descr, asfloat)
+          if len(rows) == chunk_rows:
+            continue
+        else:
+          interval = min(interval*2, max_interval)
+      stop.wait(interval)
+
+  def subscribe(self, table, columns, callback, **kwargs):
+    """
+    Calls a function with the rows added to a table, as they arrive
+
+    The rows are followed as by follow(), with the same keyword arguments, in
+    a daemon thread.  An exception raised by 'callback' is logged and ends
+    the subscription.  BaseDB must be in pooled mode so that the thread does
+    not share BaseDB.db with the caller.
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @param callback : function called with each chunk of rows
+    @type  callback : callable
+
+    @return: threading.Event which ends the subscription when set
+    """
+    if not self.pool:
+      raise MysqlException("subscribe: %s needs BaseDB in pooled mode", table)
+    stop = kwargs.setdefault('stop', threading.Event())
+    if kwargs.get('since_id') is None:
+      kwargs['since_id'] = self._last_key(table, self.primary_key(table))
+    def run():
+      try:
+        for chunk in self.follow(table, columns, **kwargs):
+          callback(chunk)
+      except Exception:
+        self.logger.exception("subscribe: %s", table)
+    thread = threading.Thread(target=run, name="follow-"+table)
+    thread.daemon = True
+    thread.start()
+    return stop
+
+class LogWriter(object):
+  """
+  Write-behind writer of log tables
+
+  LogWriter.update() does what BaseDB.updateValues() does, namely add a row
+  to a table with the values of the previous row except for those updated,
+  but without waiting for the database.  The last record of each table is
+  kept in memory and the new rows are inserted in batches by a background
+  thread.  If the database is unavailable the thread keeps trying.
+
+  At most 'max_queue' rows wait to be written; update() waits when there are
+  more.  If a spool file is given, each row is appended to it with a
+  sequence number before update() returns, and the sequence numbers of the
+  rows written are appended to '<spool>.ack'.  Rows left in the spool file
+  by a previous process and not acknowledged are written when the LogWriter
+  starts.  The spool file is rewritten with only the rows not yet written
+  whenever it holds more than twice as many rows as are waiting, so it stays
+  small under sustained load.  A row can still be written twice if the
+  process stopped between inserting it and acknowledging it.
+
+  Public attributes::
+    db         - BaseDB
+    spool      - path of the spool file or None
+    batch_size - maximum number of rows inserted at once
+  Methods::
+    update      - add a row with updated values
+    last_record - the last record of a table
+    flush       - wait until all the rows are written
+    close       - flush and stop the thread
+    stats       - counters
+  """
+  def __init__(self, db, spool=None, max_queue=10000, batch_size=500,
+               retry_interval=5., fsync=False):
+    """
+    @param db : database
+    @type  db : BaseDB
+
+    @param spool : path of the spool file
+    @type  spool : str
+
+    @param max_queue : maximum number of rows waiting to be written
+    @type  max_queue : int
+
+    @param batch_size : maximum number of rows inserted at once
+    @type  batch_size : int
+
+    @param retry_interval : seconds between attempts after an error
+    @type  retry_interval : float
+
+    @param fsync : force the spool file to disk after each row
+    @type  fsync : bool
+    """
+    self.logger = logging.getLogger(logger.name+".LogWriter")
+    self.db = db
+    self.spool = spool
+    self.max_queue = max_queue
+    self.batch_size = batch_size
+    self.retry_interval = retry_interval
+    self.fsync = fsync
+    self._last = {}                   # table -> last record
+    self._queue = collections.deque() # (sequence number, table, record)
+    self._seq = 0                     # sequence number of the next row
+    self._unwritten = 0               # rows queued or being inserted
+    self._spooled = 0                 # rows in the spool file
+    self._closing = False
+    self._abandoned = False           # stop even if rows are left
+    self._cond = threading.Condition()
+    self._stats = collections.Counter()
+    self._spool_file = None
+    self._ack_file = None
+    if spool:
+      self._replay()
+      self._compact()
+    self._thread = threading.Thread(target=self._write, name="LogWriter")
+    self._thread.daemon = True
+    self._thread.start()
+
+  @staticmethod
+  def _load(path):
+    """
+    Pickled objects in a file; the last one may be incomplete
+    """
+    items = []
+    if not os.path.exists(path):
+      return items
+    with open(path, "rb") as f:
+      while True:
+        try:
+          items.append(pickle.load(f))
+        except EOFError:
+          break
+        except Exception as details:
+          logger.warning("LogWriter: %s damaged: %s", path, details)
+          break
+    return items
+
+  def _replay(self):
+    """
+    Queues the rows left in the spool file and not acknowledged
+    """
+    acked = set()
+    for seqs in self._load(self.spool + ".ack"):
+      acked.update(seqs)
+    for seq, table, rec in self._load(self.spool):
+      self._last[table] = rec
+      self._seq = max(self._seq, seq + 1)
+      if seq not in acked:
+        self._queue.append((seq, table, rec))
+        self._unwritten += 1
+    self._stats['replayed'] = self._unwritten
+    if self._unwritten:
+      self.logger.info("_replay: %d rows from %s", self._unwritten, self.spool)
+
+  def _sync(self, f):
+    f.flush()
+    if self.fsync:
+      os.fsync(f.fileno())
+
+  def _compact(self):
+    """
+    Rewrites the spool file with the rows not written and empties the
+    acknowledgements; the caller must hold the lock or be the only thread
+    """
+    for f in (self._spool_file, self._ack_file):
+      if f:
+        f.close()
+    tmp_path = self.spool + ".tmp"
+    with open(tmp_path, "wb") as f:
+      for item in self._queue:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+      self._sync(f)
+    os.replace(tmp_path, self.spool)
+    self._spooled = len(self._queue)
+    self._spool_file = open(self.spool, "ab")
+    self._ack_file = open(self.spool + ".ack", "wb")
+    self._stats['compactions'] += 1
+
+  def last_record(self, table):
+    """
+    The last record of a table, without the auto-increment columns
+
+    @param table : table name
+    @type  table : str
+
+    @return: dict
+    """
+    try:
+      return dict(self._last[table])
+    except KeyError:
+      pass
+    rec = _strip_auto_increment(self.db, table, self.db.getLastRecord(table))
+    self._last[table] = rec
+    return dict(rec)
+
+  def update(self, table, vald):
+    """
+    Adds a row with updated values
+
+    @param table : table name
+    @type  table : str
+
+    @param vald : updated values
+    @type  vald : dict
+    """
+    rec = self.last_record(table)
+    rec.update(vald)
+    with self._cond:
+      if len(self._queue) >= self.max_queue:
+        self._stats['waits'] += 1
+      while not self._closing and len(self._queue) >= self.max_queue:
+        self._cond.wait()
+      if self._closing:
+        # close() may have given up on the rows queued; none will be taken
+        raise MysqlException("update: LogWriter is closed")
+      item = (self._seq, table, rec)
+      self._seq += 1
+      if self._spool_file:
+        pickle.dump(item, self._spool_file, pickle.HIGHEST_PROTOCOL)
+        self._sync(self._spool_file)
+        self._spooled += 1
+      self._last[table] = rec
+      self._queue.append(item)
+      self._unwritten += 1
+      self._stats['updates'] += 1
+      self._cond.notify_all()
+
+  def _write(self):
+    """
+    Inserts the queued rows; runs in a thread
+    """
+    while True:
+      with self._cond:
+        while not self._queue and not self._closing:
+          self._cond.wait()
+        if not self._queue or self._abandoned:
+          return
+        batch = [self._queue.popleft()
+                 for count in range(min(self.batch_size, len(self._queue)))]
+        self._cond.notify_all()
+      # keep the order of the rows of each table
+      tables = collections.OrderedDict()
+      for item in batch:
+        tables.setdefault(item[1], []).append(item)
+      written = []
+      failed = []
+      for table, items in tables.items():
+        if failed:
+          failed.extend(items)
+          continue
+        try:
+          self.db.insert_records(table, [item[2] for item in items])
+          written.extend(items)
+        except Exception as details:
+          # the statements committed before the error are not written again
+          committed = set(getattr(details, 'committed', []))
+          self.logger.error("_write: %d rows not written: %s",
+                            len(batch) - len(written) - len(committed), details)
+          self._stats['errors'] += 1
+          written.extend([item for index, item in enumerate(items)
+                          if index in committed])
+          failed.extend([item for index, item in enumerate(items)
+                         if index not in committed])
+      # rows not written go back to the front of the queue, in order
+      failed.sort()
+      with self._cond:
+        self._queue.extendleft(reversed(failed))
+        self._unwritten -= len(written)
+        self._stats['written'] += len(written)
+        self._stats['batches'] += 1
+        if self._ack_file and written:
+          pickle.dump([item[0] for item in written], self._ack_file,
+                      pickle.HIGHEST_PROTOCOL)
+          self._sync(self._ack_file)
+          if self._unwritten == 0 or \
+             self._spooled > 2*self._unwritten + self.batch_size:
+            self._compact()
+        self._cond.notify_all()
+      if failed:
+        with self._cond:
+          self._cond.wait_for(lambda: self._abandoned, self.retry_interval)
+
+  def flush(self, timeout=None):
+    """
+    Waits until all the rows are written
+
+    @param timeout : maximum wait (s); None waits as long as necessary
+    @type  timeout : float
+
+    @return: True if all the rows are written
+    """
+    with self._cond:
+      self._cond.notify_all()
+      return self._cond.wait_for(lambda: self._unwritten == 0, timeout)
+
+  def close(self, timeout=None):
+    """
+    Writes the remaining rows and stops the thread
+
+    If the rows are not all written within 'timeout', the thread stops
+    after its current attempt and the rows left are written from the spool
+    file by the next LogWriter, or lost if there is none.
+
+    @param timeout : maximum wait (s) for the rows to be written
+    @type  timeout : float
+
+    @return: True if all the rows were written
+    """
+    with self._cond:
+      self._closing = True
+      self._cond.notify_all()
+    self._thread.join(timeout)
+    with self._cond:
+      if self._thread.is_alive():
+        self._abandoned = True
+        self._cond.notify_all()
+        self.logger.warning("close: %d rows not written%s", self._unwritten,
+                            ", left in " + self.spool if self.spool else "")
+      for f in (self._spool_file, self._ack_file):
+        if f:
+          f.close()
+      self._spool_file = self._ack_file = None
+      return self._unwritten == 0
+
+  def stats(self):
+    """
+    Counters and the number of rows not yet written
+
+    @return: dict
+    """
+    with self._cond:
+      stats = dict(self._stats)
+      stats['queued'] = self._unwritten
+    return stats
+
+class DayMirror(object):
+  """
+  Local mirror of table data partitioned by day
+
+  DayMirror.get_rows_by_date() returns what BaseDB.get_rows_by_date() returns
+  but keeps the columns of each day in a numpy .npz file::
+    directory/table/year/doy.npz
+  The primary key of the table is always mirrored.  Until a day is complete
+  only the rows with a key larger than the last one mirrored are fetched, so
+  rows which arrive late with the same 'utc' are not lost.  A day is taken
+  to be complete 'settle' seconds after it ends; the number of rows mirrored
+  is then checked against the table and the day is fetched again if they
+  differ.  After that the day is read from its file.  If more columns are
+  requested than were mirrored, the day is fetched again with all of them.
+
+  Without a database the mirror works offline, serving only mirrored days.
+
+  Public attributes::
+    db        - BaseDB or None
+    directory - top directory of the mirror
+    settle    - seconds after the end of a day before it is complete
+  Methods::
+    get_rows_by_date - data for a day
+    prefetch         - mirror a range of days
+    path             - file for a day
+  """
+  complete_key = "__complete"
+
+  def __init__(self, db, directory, settle=3600.):
+    """
+    @param db : database or None to work offline
+    @type  db : BaseDB
+
+    @param directory : top directory of the mirror
+    @type  directory : str
+
+    @param settle : seconds after the end of a day for late rows to arrive
+    @type  settle : float
+    """
+    self.logger = logging.getLogger(logger.name+".DayMirror")
+    self.db = db
+    self.directory = directory
+    self.settle = settle
+
+  def path(self, table, year, doy):
+    """
+    File for a day
+    """
+    return os.path.join(self.directory, table, "%04d" % year,
+                        "%03d.npz" % doy)
+
+  def _settled(self, year, doy):
+    """
+    Is the day long enough past for no more rows to arrive?
+    """
+    day_end = calendar.timegm((year, 1, 1, 0, 0, 0)) + doy*86400
+    return time.time() >= day_end + self.settle
+
+  def _load(self, path):
+    """
+    Returns the columns in a file and whether the day is complete
+    """
+    # allow_pickle is needed for object columns; the files are our own
+    with np.load(path, allow_pickle=True) as npz:
+      data = dict([(key, npz[key]) for key in npz.files])
+    complete = bool(data.pop(self.complete_key))
+    return data, complete
+
+  def _save(self, path, data, complete):
+    """
+    Writes the columns for a day, replacing the file atomically
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+      os.makedirs(directory, mode=0o775)
+    temp_path = path + ".tmp.npz"
+    arrays = dict(data)
+    arrays[self.complete_key] = np.array(complete)
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+  def _fetch(self, table, columns, year, doy, key, after=None):
+    """
+    Gets the rows for a day, or those with a key after a value
+    """
+    query = "select "+", ".join(columns)+" from "+table \
+            +" where year=%s and doy=%s"
+    params = [year, doy]
+    if after is not None:
+      query += " and "+key+" > %s"
+      params.append(after)
+    data = self.db.get_as_dict(query+" order by utc, "+key+";",
+                               tuple(params))
+    if not data:
+      data = dict([(column, np.array([])) for column in columns])
+    return data
+
+  def _count(self, table, year, doy):
+    """
+    Number of rows in the table for a day
+    """
+    rows = self.db.get("select count(*) from "+table
+                       +" where year=%s and doy=%s;", (year, doy))
+    return int(rows[0][0])
+
+  def get_rows_by_date(self, table, columns, year, doy):
+    """
+    Gets data from a table, from the mirror when possible
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be selected
+    @type  columns : list of str
+
+    @type year : int
+
+    @param doy : day of year
+    @type  doy : int
+
+    @return: dict of numpy arrays keyed on column name
+    """
+    path = self.path(table, year, doy)
+    mirrored = list(columns)
+    if self.db is not None:
+      key = self.db.primary_key(table)
+      for column in ('utc', key):
+        if column not in mirrored:
+          mirrored.append(column)
+    complete = self._settled(year, doy)
+    data = None
+    if os.path.exists(path):
+      data, mirrored_complete = self._load(path)
+      if not set(columns) <= set(data.keys()) or \
+         (not mirrored_complete and self.db is not None
+          and not set(mirrored) <= set(data.keys())):
+        # get the day again with all the columns
+        mirrored = list(data.keys()) + \
+                   [column for column in mirrored if column not in data]
+        data = None
+      elif not mirrored_complete and self.db is not None:
+        last = data[key].max() if len(data[key]) else None
+        new = self._fetch(table, list(data.keys()), year, doy, key,
+                          after=last)
+        if len(new[key]):
+          data = dict([(column, np.concatenate((data[column], new[column])))
+                       for column in data])
+          order = np.argsort(data['utc'], kind='stable')
+          data = dict([(column, data[column][order]) for column in data])
+        if complete and self._count(table, year, doy) != len(data[key]):
+          self.logger.info("get_rows_by_date: %s for %d/%03d changed;"
+                           " fetching it again", table, year, doy)
+          mirrored = list(data.keys())
+          data = None
+        else:
+          self._save(path, data, complete)
+    if data is None:
+      if self.db is None:
+        raise MysqlException("get_rows_by_date: %s for %s/%s is not mirrored",
+                             table, year, doy)
+      data = self._fetch(table, mirrored, year, doy, key)
+      self._save(path, data, complete)
+    if len(data['utc']) == 0:
+      return {}
+    return dict([(column, data[column]) for column in columns])
+
+  def prefetch(self, table, columns, start, end):
+    """
+    Mirrors the data for a range of days
+
+    @param table : table name
+    @type  table : str
+
+    @param columns : list of columns to be mirrored
+    @type  columns : list of str
+
+    @param start : first day
+    @type  start : datetime.date
+
+    @param end : last day
+    @type  end : datetime.date
+
+    @return: number of days mirrored
+    """
+    day = start
+    count = 0
+    while day <= end:
+      doy = day.timetuple().tm_yday
+      self.get_rows_by_date(table, columns, day.year, doy)
+      self.logger.debug("prefetch: %s for %d/%03d", table, day.year, doy)
+      day += timedelta(days=1)
+      count += 1
+    return count
+
+class Rollup(object):
+  """
+  Hourly and daily statistics of table columns, kept up to date
+
+  For a table with a 'utc' column, the minimum, maximum, sum and count of
+  each column are kept for each hour in table_hour and for each day in
+  table_day, with columns::
+    utc, year, doy, col_min, col_max, col_sum, col_count, ...
+  where 'utc' is the start of the hour or day.  The table must also have
+  'year' and 'doy' columns, which are used to select the rows.  The primary
+  key of the last row included is kept in the table 'rollup_watermarks', so
+  update() only looks at rows added since.  Only the hours with new rows are
+  computed again from the table, and the days they are in from the hours,
+  so a late row costs one hour and one day and an update which is
+  interrupted can simply be repeated.
+
+  get() uses the coarsest statistics finer than the requested resolution,
+  those of the rows themselves below an hour, e.g.::
+    rollup = Rollup(db, 'weather', ['TAmb', 'pressure'])
+    rollup.create()
+    rollup.update()
+    data = rollup.get(start, end, resolution=6*3600)
+
+  Public attributes::
+    db      - BaseDB
+    table   - name of the table summarized
+    columns - names of the columns summarized
+    key     - primary key of the table
+  Methods::
+    create    - create the rollup tables if they do not exist
+    watermark - primary key of the last row included
+    update    - include the rows added to the table
+    get       - statistics at a given resolution
+  """
+  periods = (('hour', 3600), ('day', 86400))
+  watermark_table = "rollup_watermarks"
+  fields = ('min', 'max', 'sum', 'count')
+
+  def __init__(self, db, table, columns, chunk_rows=100000):
+    """
+    @param db : database
+    @type  db : BaseDB
+
+    @param table : table with a 'utc' column
+    @type  table : str
+
+    @param columns : numeric columns to be summarized
+    @type  columns : list of str
+
+    @param chunk_rows : maximum number of new rows included at a time
+    @type  chunk_rows : int
+    """
+    self.logger = logging.getLogger(logger.name+".Rollup")
+    self.db = db
+    self.table = table
+    self.columns = columns
+    self.chunk_rows = chunk_rows
+    self.key = db.primary_key(table)
+
+  def rollup_table(self, period):
+    """
+    Name of the table for 'hour' or 'day'
+    """
+    return self.table + "_" + period
+
+  def create(self):
+    """
+    Creates the rollup and watermark tables if they do not exist
+    """
+    stats = ", ".join(["%s_%s %s" % (col, field,
+                                     "INT" if field == 'count' else "DOUBLE")
+                       for col in self.columns for field in self.fields])
+    for period, seconds in self.periods:
+      self.db.get("CREATE TABLE IF NOT EXISTS " + self.rollup_table(period)
+                  + " (utc DOUBLE NOT NULL PRIMARY KEY, year INT, doy INT, "
+                  + stats + ");")
+    self.db.get("CREATE TABLE IF NOT EXISTS " + self.watermark_table
+                + " (name VARCHAR(64) NOT NULL PRIMARY KEY, last_id BIGINT);")
+    self.db.commit()
+    self.db.schema.invalidate()
+
+  def watermark(self):
+    """
+    Primary key of the last row included, 0 if none
+    """
+    rows = self.db.get("SELECT last_id FROM " + self.watermark_table
+                       + " WHERE name=%s;", (self.table,))
+    if len(rows):
+      return int(rows[0][0])
+    return 0
+
+  def update(self):
+    """
+    Includes the rows added to the table since the last update
+
+    @return: number of rows included
+    """
+    floor = self.db.backend.floor
+    total = 0
+    while True:
+      last_id = self.watermark()
+      with self.db.connection() as conn:
+        c = conn.cursor()
+        try:
+          c.execute("SELECT period, MAX(" + self.key + "), COUNT(*) FROM"
+                    + " (SELECT " + self.key + ", " + floor % "utc/%s"
+                    + " AS period FROM " + self.table + " WHERE " + self.key
+                    + " > %s ORDER BY " + self.key + " LIMIT %s) AS new"
+                    + " GROUP BY period;", (3600, last_id, self.chunk_rows))
+          touched = c.fetchall()
+          if touched:
+            self._summarize(c, sorted([int(row[0]) for row in touched]),
+                            max([row[1] for row in touched]))
+        finally:
+          c.close()
+      if not touched:
+        return total
+      self.db.commit()
+      for period, seconds in self.periods:
+        self.db.invalidate(self.rollup_table(period))
+      self.db.invalidate(self.watermark_table)
+      count = sum([int(row[2]) for row in touched])
+      total += count
+      self.logger.debug("update: %s: %d rows in %d hours", self.table, total,
+                        len(touched))
+      if count < self.chunk_rows:
+        return total
+
+  def _summarize(self, c, hours, new_id):
+    """
+    Computes again the given hours and the days they are in
+
+    The rows are selected on 'year' and 'doy' as well as 'utc', a day and a
+    run of consecutive hours at a time.
+
+    @param c : cursor
+    @param hours : sorted hour numbers (utc/3600) with new rows
+    @param new_id : primary key of the last row included
+    """
+    floor = self.db.backend.floor
+    hour, day = 3600, 86400
+    runs = []
+    for number in hours:
+      if runs and number == runs[-1][1] + 1 and (number*hour) % day:
+        runs[-1][1] = number
+      else:
+        runs.append([number, number])
+    aggregates = []
+    for col in self.columns:
+      aggregates += ["MIN(%s)" % col, "MAX(%s)" % col, "SUM(%s)" % col,
+                     "COUNT(%s)" % col]
+    hour_records = []
+    for first, last in runs:
+      when = time.gmtime(first*hour)
+      c.execute("SELECT " + floor % "utc/%s" + " AS period, "
+                + ", ".join(aggregates) + " FROM " + self.table
+                + " WHERE year=%s AND doy=%s AND utc >= %s AND utc < %s"
+                + " GROUP BY period;", (hour, when.tm_year, when.tm_yday,
+                                        first*hour, (last + 1)*hour))
+      hour_records += [self._record(row, hour) for row in c.fetchall()]
+    aggregates = []
+    for col in self.columns:
+      aggregates += ["MIN(%s_min)" % col, "MAX(%s_max)" % col,
+                     "SUM(%s_sum)" % col, "SUM(%s_count)" % col]
+    stats = ["%s_%s" % (col, field)
+             for col in self.columns for field in self.fields]
+    replace = " (utc, year, doy, " + ", ".join(stats) + ") VALUES (" \
+              + ", ".join(["%s"]*(len(stats) + 3)) + ");"
+    c.executemany("REPLACE INTO " + self.rollup_table('hour') + replace,
+                  hour_records)
+    day_records = []
+    for number in sorted(set([(first*hour)//day for first, last in runs])):
+      when = time.gmtime(number*day)
+      c.execute("SELECT " + floor % "utc/%s" + " AS period, "
+                + ", ".join(aggregates) + " FROM " + self.rollup_table('hour')
+                + " WHERE year=%s AND doy=%s GROUP BY period;",
+                (day, when.tm_year, when.tm_yday))
+      day_records += [self._record(row, day) for row in c.fetchall()]
+    c.executemany("REPLACE INTO " + self.rollup_table('day') + replace,
+                  day_records)
+    c.execute("REPLACE INTO " + self.watermark_table
+              + " (name, last_id) VALUES (%s, %s);", (self.table, new_id))
+
+  def _record(self, row, seconds):
+    """
+    Values of a rollup row from a period number and statistics
+    """
+    utc = float(row[0])*seconds
+    when = time.gmtime(utc)
+    return (utc, when.tm_year, when.tm_yday) + tuple(row[1:])
+
+  def get(self, start, end, resolution):
+    """
+    Statistics of the columns in intervals of about 'resolution' seconds
+
+    From an hour, the intervals are whole numbers of hours or days which
+    start at 'start' rounded down to the hour or day.  The result is that of
+    BaseDB.downsample().
+
+    @param start : first time (UTC) of the range
+    @type  start : datetime, date or unixtime
+
+    @param end : time (UTC) at which the range ends, excluded
+    @type  end : datetime, date or unixtime
+
+    @param resolution : requested length (s) of an interval
+    @type  resolution : float
+
+    @return: dict of 'utc' and a structured array for each column
     """
-    Add row with updated values
-    
-    Add a new row to table with same values as previous row,
-    except for keys in vald, which are updated with provided
-    values.  This is useful for keeping logs.
+    start, end = unixtime(start), unixtime(end)
+    source = None
+    for period, seconds in self.periods:
+      if resolution >= seconds:
+        source, width = period, seconds
+    if source is None:
+      buckets = int(np.ceil((end - start)/resolution))
+      return self.db.downsample(self.table, self.columns, start, end,
+                                buckets=buckets)
+    width *= int(resolution//width)
+    start = (start//width)*width
+    buckets = int(np.ceil((end - start)/width))
+    aggregates = []
+    for col in self.columns:
+      aggregates += ["MIN(%s_min)" % col, "MAX(%s_max)" % col,
+                     "SUM(%s_sum)/SUM(%s_count)" % (col, col),
+                     "SUM(%s_count)" % col]
+    days, day_params = day_range(start, end)
+    rows = self.db.get(
+                "SELECT " + self.db.backend.floor % "(utc - %s)/%s"
+                + " AS bucket, " + ", ".join(aggregates) + " FROM "
+                + self.rollup_table(source) + " WHERE " + days
+                + " AND utc >= %s AND utc < %s GROUP BY bucket ORDER BY bucket;",
+                (start, width) + day_params + (start, end))
+    return bucket_statistics(rows, self.columns, start, width, buckets)
 
-    @param vald : updated values
-    @type  vald : dict
+class AsyncBaseDB(object):
+  """
+  An asyncio interface to a database
 
-    @param table : table name
-    @type  table : str
+  The queries run on a pooled BaseDB in a thread pool of the same size as the
+  connection pool, so many of them can run concurrently from one event loop
+  without blocking it.  For example::
+
+    db = AsyncBaseDB(host, user, pw, "dss28_eac", pool_size=8)
+    weather, tipper = await asyncio.gather(
+                  db.get_rows_by_date("weather", ["utc", "TAmb"], 2019, 120),
+                  db.get_rows_by_date("tipper", ["utc", "tau"], 2019, 120))
+
+  Public attributes::
+    db       - the pooled BaseDB
+    executor - the thread pool
+  Methods::
+    get, get_as_dict, insertRecord, insert_records, getLastRecord,
+    get_rows_by_date, get_rows_by_time - coroutines for the BaseDB methods
+    run        - coroutine which runs any BaseDB method
+    pool_stats - connection pool statistics
+    close      - shut down the thread pool and the connections
+  """
+  def __init__(self, host=None, user=None , pw=None, name=None, port=3306,
+               pool_size=8, **kwargs):
     """
-    lastrec = self.getLastRecord(table)
-    lastrec.update(vald)
-    self.insertRecord(table, lastrec)
+    The arguments are those of BaseDB.
 
-  def get_public_tables(self):
+    @param pool_size : number of connections and threads
+    @type  pool_size : int
     """
-    List the table names in the database.
+    self.logger = logging.getLogger(logger.name+".AsyncBaseDB")
+    self.db = BaseDB(host, user, pw, name, port, pool_size=pool_size, **kwargs)
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=pool_size, thread_name_prefix="AsyncBaseDB")
 
-    @return: tuple of tuples of str
+  async def run(self, method, *args, **kwargs):
     """
-    try:
-      self.c.execute("""SHOW TABLES;""")
-      result = self.c.fetchall()
-    except MySQLdb.Error as e:
-      self.logger.error(
-                  "get_public_tables: MySQLdb error: Cannot connect to server")
-      self.logger.error("get_public_tables: error code:",e.args[0])
-      self.logger.error("get_public_tables: error message:",e.args[1])
-      result = None
-    return result
+    Runs a BaseDB method in the thread pool
 
-  def get_columns(self, table):
+    @param method : name of the method
+    @type  method : str
+
+    @return: what the method returns
     """
-    Returns information about the columns of a table
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor,
+             functools.partial(getattr(self.db, method), *args, **kwargs))
+
+  async def get(self, *args):
     """
-    self.c.execute("show columns from "+table+";")
-    return self.c.fetchall()
-  
-  def get_data_index(self):
+    See BaseDB.get
     """
+    return await self.run("get", *args)
+
+  async def get_as_dict(self, *args, **kwargs):
     """
-    tables = self.get_public_tables()
-    tableindex = {}
-    for table in tables:
-      tb = table[0]
-      tableindex[tb] = self.get_columns(tb)
-    return tableindex
-    
-  def report_table(self,table,columns):
+    See BaseDB.get_as_dict
     """
-    Reports on the columns in a table
-    
-    Response has keys: Extra, Default, Field, Key, Null, Type
+    return await self.run("get_as_dict", *args, **kwargs)
 
-    @param table : table name
-    @type  table : str
+  async def insertRecord(self, table, rec):
+    """
+    See BaseDB.insertRecord
+    """
+    return await self.run("insertRecord", table, rec)
 
-    @param columns : list of column names
-    @type  columns : list of str
+  async def insert_records(self, table, records, **kwargs):
+    """
+    See BaseDB.insert_records
+    """
+    return await self.run("insert_records", table, records, **kwargs)
 
-    @return: result of query
+  async def getLastRecord(self, table):
     """
-    self.logger.info("report_table: showing name and type of columns for %s",
-                     table)
-    response = self.get("show columns from "+table+";")
-    self.logger.debug("report_table: response: %s", response)
-    report = []
-    for row in response:
-      name = row[0]
-      for column in columns:
-        if name == column:
-          report.append(row)
-    return report
+    See BaseDB.getLastRecord
+    """
+    return await self.run("getLastRecord", table)
 
-  def get_rows_by_date(self, table, columns, year, doy):
+  async def get_rows_by_date(self, table, columns, year, doy):
     """
-    Gets data from a table
+    See BaseDB.get_rows_by_date
+    """
+    return await self.run("get_rows_by_date", table, columns, year, doy)
 
-    @param table : table name
-    @type  table : str
+  async def get_rows_by_time(self, table, columns, year, doy, utcs, **kwargs):
+    """
+    See BaseDB.get_rows_by_time
+    """
+    return await self.run("get_rows_by_time", table, columns, year, doy, utcs,
+                          **kwargs)
 
-    @param columns : list of columns to be selected
-    @type  columns : list of str
+  async def downsample(self, table, columns, start, end, **kwargs):
+    """
+    See BaseDB.downsample
+    """
+    return await self.run("downsample", table, columns, start, end, **kwargs)
 
-    @type year : int
+  async def get_rows_by_range(self, table, columns, start, end, **kwargs):
+    """
+    See BaseDB.get_rows_by_range
+    """
+    return await self.run("get_rows_by_range", table, columns, start, end,
+                          **kwargs)
 
-    @param doy : day of year
-    @type  doy : int
+  def pool_stats(self):
+    """
+    Connection pool statistics
 
-    @return: dict of numpy arrays keyed on column name
+    @return: dict
     """
-    columnstr = str(columns).lstrip('[').rstrip(']').replace("'","")
-    try:
-      response = self.get_as_dict("select " + columnstr
-                        + " from "+table+" where year=%s and doy=%s",
-                        (year,doy))
-    except Mysql.MySQLdb.OperationalError as details:
-      print("MySQLdb OperationalError:",details)
-    else:
-      return response
+    return self.db.pool_stats()
 
-  def get_rows_by_time(self,table,columns,year,doy,utcs):
+  def close(self):
     """
-    Queries a table for quantities in columns at designated times
+    Waits for the queries in progress and closes the connections
+    """
+    self.executor.shutdown(wait=True)
+    self.db.close()
 
-    This loops over a list of UTs.  For each, it takes the first row it finds 
-    matching the date and time.  So it has an effective resolution of one second.
+############################ Global Functions ##########################
 
-    @param table : table name
-    @type  table : str
+def unixtime(when):
+  """
+  Seconds since the epoch of a UTC datetime or date
 
-    @param columns : list of columns to be selected
-    @type  columns : list of str
+  @param when : time, or seconds since the epoch which are returned as is
+  @type  when : datetime, date or float
 
-    @type year : int
+  @return: float
+  """
+  if isinstance(when, datetime):
+    return calendar.timegm(when.utctimetuple()) + when.microsecond/1e6
+  if isinstance(when, date):
+    return float(calendar.timegm(when.timetuple()))
+  return float(when)
 
-    @param doy : day of year
-    @type  doy : int
+def day_range(start, end):
+  """
+  Condition on 'year' and 'doy' for the days between two times
 
-    @param utcs : times to be selected; first occurrence is used
-    @type  utcs : list of unixtimes (seconds since the epoch)
+  Adding it to a condition on 'utc' lets the server use an index on the
+  year and day of year.
 
-    @return: dict of numpy arrays keyed on column name
-    """
-    data = {}
-    for col in columns:
-      data[col] = []
-    columnstr = str(columns).lstrip('[').rstrip(']').replace("'","")
-    for utc in utcs:
-      fmt = "select "+columnstr+" from "+table+" where year=%s and doy=%s and utc=%s;"
-      result = self.get_as_dict(fmt,(year,doy,utc))
-      for col in columns:
-        data[col].append(result[col][0])
-    for col in columns:
-      data[col] = np.array(data[col])
+  @param start : first time (UTC) of the range
+  @type  start : float
+
+  @param end : time (UTC) at which the range ends, excluded
+  @type  end : float
+
+  @return: (SQL condition, tuple of parameters)
+  """
+  first = time.gmtime(start)
+  last = time.gmtime(max(start, end - 1e-6))
+  if first.tm_year == last.tm_year:
+    return ("year = %s AND doy BETWEEN %s AND %s",
+            (first.tm_year, first.tm_yday, last.tm_yday))
+  return ("(year = %s AND doy >= %s OR year > %s AND year < %s"
+          " OR year = %s AND doy <= %s)",
+          (first.tm_year, first.tm_yday, first.tm_year, last.tm_year,
+           last.tm_year, last.tm_yday))
+
+bucket_dtype = np.dtype([('min', np.float64), ('max', np.float64),
+                         ('mean', np.float64), ('count', np.int64)])
+
+def bucket_statistics(rows, columns, start, width, buckets):
+  """
+  Arrays of statistics in equal time intervals from grouped rows
+
+  @param rows : rows of interval number followed by the minimum, maximum,
+                mean and count of each column
+  @type  rows : sequence of tuples
+
+  @param columns : column names
+  @type  columns : list of str
+
+  @param start : time of the first interval
+  @type  start : float
+
+  @param width : length (s) of an interval
+  @type  width : float
+
+  @param buckets : number of intervals
+  @type  buckets : int
+
+  @return: dict with the start times of the intervals under 'utc' and, for
+           each column, an array of dtype 'bucket_dtype'; empty intervals
+           have count 0 and NaNs
+  """
+  data = {'utc': start + width*np.arange(buckets)}
+  for col in columns:
+    data[col] = np.zeros(buckets, dtype=bucket_dtype)
+    for field in ('min', 'max', 'mean'):
+      data[col][field] = np.nan
+  if not len(rows):
     return data
+  index = np.clip(np.array([row[0] for row in rows], dtype=np.int64),
+                  0, buckets - 1)
+  values = np.array([row[1:] for row in rows], dtype=np.float64)
+  for number, col in enumerate(columns):
+    for offset, field in enumerate(bucket_dtype.names):
+      data[col][field][index] = values[:, 4*number + offset]
+  return data
 
-############################ Global Functions ##########################
+def result_size(rows):
+  """
+  Estimated size in bytes of the rows returned by a query
+
+  This is extrapolated from the first row.
+  """
+  if rows:
+    return sys.getsizeof(rows) + len(rows)*(sys.getsizeof(rows[0])
+                          + sum([sys.getsizeof(value) for value in rows[0]]))
+  return sys.getsizeof(rows)
+
+# characters which the driver escapes with a backslash in a string literal
+_escaped = ("\\", "'", '"', "\0", "\n", "\r", "\x1a")
+
+def literal_length(value):
+  """
+  Length in bytes of a value as a literal in an SQL statement
+
+  Strings are counted in UTF-8, with their quotes and escape characters.
+  """
+  if value is None:
+    return 4
+  if isinstance(value, str):
+    quotes = 2
+    value = value.encode("utf-8")
+  elif isinstance(value, (bytes, bytearray)):
+    quotes = 9    # _binary'...'
+  else:
+    return len(str(value)) + 2
+  return len(value) + sum([value.count(char.encode()) for char in _escaped]) \
+         + quotes
+
+# schema caches for plain connections
+_schemas = weakref.WeakKeyDictionary()
+
+def open_db(database, host, user, passwd, port=3306):
+  """
+  Opens a connection to a database
+
+  @param database : database name; "" for none
+  @type  database : str
+
+  @param host : host.domain or IP address
+  @type  host : str
+
+  @param user : user login name
+  @type  user : str
+
+  @param passwd : password
+  @type  passwd : str
+
+  @return: connection object
+  """
+  return MySQLdb.connect(host=host, port=port, user=user, passwd=passwd,
+                         db=database, compress=True)
+
+def ask_db(db_conn, query, params=None):
+  """
+  Executes a query with a database connection and returns the rows
+
+  @param db_conn : database connection object
+
+  @param query : MySQL query
+  @type  query : str
+
+  @return: tuple of tuples
+  """
+  rows, descr = _execute_on(db_conn, query, params)
+  return rows
+
+def _execute_on(db_conn, query, params=None):
+  """
+  Executes a query with a database connection
+
+  @return: (rows, cursor description)
+  """
+  c = db_conn.cursor()
+  try:
+    c.execute(query, params)
+    return c.fetchall(), c.description
+  finally:
+    c.close()
+
+def get_schema(db, ttl=300.):
+  """
+  Column information cache for a BaseDB or a database connection
+
+  A connection's cache is for its current database and is kept for as long
+  as the connection exists.
+
+  @param db : BaseDB or database connection object
+
+  @param ttl : seconds for which a new cache uses its information
+  @type  ttl : float
+
+  @return: SchemaCache
+  """
+  if isinstance(db, BaseDB):
+    return db.schema
+  try:
+    return _schemas[db]
+  except KeyError:
+    # the cache must not keep the connection alive
+    ref = weakref.ref(db)
+    schema = SchemaCache(lambda *args: _execute_on(ref(), *args), ttl=ttl)
+    _schemas[db] = schema
+    return schema
+
+def _value_kind(value):
+  """
+  Kind of data of one value
+  """
+  if isinstance(value, (bool, int, np.integer)):
+    return 'int'
+  elif isinstance(value, (float, Decimal, np.floating)):
+    return 'float'
+  elif isinstance(value, datetime):
+    return 'datetime'
+  elif isinstance(value, date):
+    return 'date'
+  elif isinstance(value, timedelta):
+    return 'timedelta'
+  elif isinstance(value, str):
+    return 'str'
+  elif isinstance(value, bytes):
+    return 'bytes'
+  return 'object'
+
+def _column_kind(type_code, values):
+  """
+  Kind of data in a column, from its field type or else from its values
+
+  All the values are looked at.  A column of integers and floats is 'float';
+  any other mixture of kinds is 'object', so that nothing is truncated.
+  """
+  try:
+    return field_kinds[type_code]
+  except KeyError:
+    pass
+  kinds = set([_value_kind(value) for value in values if value is not None])
+  if not kinds:
+    return 'float'
+  if len(kinds) == 1:
+    return kinds.pop()
+  if kinds == set(['int', 'float']):
+    return 'float'
+  return 'object'
+
+def decode_column(values, type_code=None, asfloat=True):
+  """
+  Converts the values of a result column to a typed numpy array
+
+  The kind of data is taken from the MySQL field type in the cursor
+  description, or from the values if the field type is unknown.  Numbers
+  become float64 or int64, DATE, DATETIME and TIMESTAMP become datetime64,
+  TIME becomes timedelta64 and strings become fixed width unicode or bytes.
+  With 'asfloat', a string column whose values are all numbers becomes
+  float64, as it did before columns were typed.  NULL is replaced by NaN,
+  NaT, 0 or an empty string.
+
+  @param values : values of one column
+  @type  values : sequence
+
+  @param type_code : field type (MySQLdb.constants.FIELD_TYPE)
+  @type  type_code : int
+
+  @param asfloat : integer and numeric string columns are also float64
+  @type  asfloat : bool
+
+  @return: (numpy array, NULL mask or None if there are no NULLs)
+  """
+  count = len(values)
+  kind = _column_kind(type_code, values)
+  if kind == 'int' and asfloat:
+    kind = 'float'
+  elif kind == 'str' and asfloat and count:
+    try:
+      column = np.fromiter((np.nan if value is None else float(value)
+                            for value in values), np.float64, count)
+    except ValueError:
+      pass
+    else:
+      if None in values:
+        return column, np.fromiter((value is None for value in values), bool,
+                                   count)
+      return column, None
+  dtype, fill = kind_dtypes[kind]
+  if None in values:
+    mask = np.fromiter((value is None for value in values), bool, count)
+    if fill is not None:
+      values = [fill if value is None else value for value in values]
+  else:
+    mask = None
+  if kind in ('float', 'int'):
+    column = np.fromiter(values, dtype, count)
+  elif kind in ('str', 'bytes'):
+    width = max([len(value) for value in values if value is not None] + [1])
+    column = np.empty(count, dtype=dtype+str(width))
+    column[:] = values
+  else:
+    column = np.empty(count, dtype=dtype)
+    column[:] = values
+  return column, mask
+
+def decode_rows(rows, descr, asfloat=True, masked=False, structured=False):
+  """
+  Converts the rows returned by a query to typed numpy arrays
+
+  Each column is converted by decode_column().
+
+  @param rows : rows returned by a query
+  @type  rows : sequence of tuples
+
+  @param descr : cursor description for the rows
+
+  @param asfloat : integer and numeric string columns are also float64
+  @type  asfloat : bool
+
+  @param masked : return numpy masked arrays with NULL values masked
+  @type  masked : bool
+
+  @param structured : return a numpy structured array
+  @type  structured : bool
+
+  @return: dict of numpy arrays keyed on column name, or structured array
+  """
+  names = [x[0] for x in descr]
+  if rows:
+    columns = list(zip(*rows))
+  else:
+    columns = [()]*len(names)
+  result = {}
+  masks = {}
+  for index, name in enumerate(names):
+    result[name], masks[name] = decode_column(columns[index],
+                                              descr[index][1], asfloat)
+  # release the transposed rows before any structured array is built
+  del columns
+  if structured:
+    array = np.empty(len(rows),
+                     dtype=[(name, result[name].dtype) for name in names])
+    for name in names:
+      array[name] = result[name]
+    if masked:
+      array = np.ma.array(array)
+      for name in names:
+        if masks[name] is not None:
+          array[name][masks[name]] = np.ma.masked
+    return array
+  if masked:
+    for name in names:
+      result[name] = np.ma.array(result[name],
+                          mask=np.ma.nomask if masks[name] is None else masks[name])
+  return result
 
 def get_databases(host, user, pw):
   """
@@ -457,7 +3792,99 @@ def get_databases(host, user, pw):
   conn.close()
   return response
 
-def show_databases(host, user, passwd):
+TableCount = collections.namedtuple("TableCount",
+                                    ["database", "table", "rows", "exact",
+                                     "error"])
+TableCount.__doc__ = """
+Number of rows in a table
+
+'exact' is False when 'rows' is the server's estimate, and 'error' is the
+reason when an exact count failed.
+"""
+
+system_databases = ['information_schema', 'mysql', 'performance_schema', 'sys']
+
+def table_census(host, user, passwd, databases=None, exact=False, workers=4,
+                 timeout=60., port=3306, backend="MySQLdb",
+                 name="information_schema"):
+  """
+  Numbers of rows in the tables of the databases on a host
+
+  The tables and the estimated numbers of rows are obtained with one query of
+  information_schema.TABLES.  The estimates are exact for MyISAM tables but
+  only approximate for InnoDB tables.  With 'exact', the rows are counted
+  with 'SELECT COUNT(*)' on up to 'workers' pooled connections at once.  A
+  count which takes longer than 'timeout' seconds is cancelled as by
+  BaseDB.time_limit(), which works with any server version; the estimate is
+  then kept and the error is reported.
+
+  @param host : host name
+  @type  host : str
+
+  @param user : user name
+  @type  user : str
+
+  @param passwd : user's password
+  @type  passwd : str
+
+  @param databases : databases to report; default all but the system ones
+  @type  databases : list of str
+
+  @param exact : count the rows
+  @type  exact : bool
+
+  @param workers : number of concurrent counts
+  @type  workers : int
+
+  @param timeout : maximum time (s) for counting the rows of a table
+  @type  timeout : float
+
+  @param backend : name of the DB-API backend, see 'backends'
+  @type  backend : str
+
+  @param name : database to connect to (the file for sqlite)
+  @type  name : str
+
+  @return: list of TableCount
+  """
+  db = BaseDB(host, user, passwd, name, port, pool_size=workers,
+              backend=backend)
+  try:
+    with db.connection() as conn:
+      c = conn.cursor()
+      try:
+        c.execute(db.backend.tables_query)
+        rows = c.fetchall()
+      finally:
+        c.close()
+    census = []
+    for database, table, count in rows:
+      if databases is None:
+        if database in system_databases:
+          continue
+      elif database not in databases:
+        continue
+      census.append(TableCount(database, table,
+                               None if count is None else int(count),
+                               False, None))
+    if not exact:
+      return census
+    def count_rows(entry):
+      query = "SELECT COUNT(*) FROM `%s`.`%s`;" % (entry.database, entry.table)
+      try:
+        with db.time_limit(timeout):
+          result = db.get(query)
+      except (MysqlException, db.backend.Error) as details:
+        logger.warning("table_census: counting %s.%s failed: %s",
+                       entry.database, entry.table, details)
+        return entry._replace(error=str(details))
+      return entry._replace(rows=int(result[0][0]), exact=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      return list(executor.map(count_rows, census))
+  finally:
+    db.close()
+
+def show_databases(host, user, passwd, exact=True):
   """
   Prints report on all the databases
 
@@ -470,28 +3897,28 @@ def show_databases(host, user, passwd):
   @param passwd : user's password
   @type  passwd : str
 
+  @param exact : count the rows instead of using the server's estimates
+  @type  exact : bool
+
   @return: printed report all the tables in each database.
   """
   dbs = get_databases(host, user, passwd)
   print(("Databases on %s" % host))
   for db in dbs:
     print("  ",db[0])
-  for line in dbs:
-    if line[0] != 'information_schema' and line[0] != 'mysql' and \
-      not re.search('wiki',line[0]):
-      print("Tables in",line[0])
-      db = open_db(line[0],host,user,passwd)
-      tbs = get_public_tables(db)
-      logging.debug(str(tbs))
-      for tb in tbs:
-        try:
-          reserved_index = reserved.index(tb[0].upper())
-          query = "SELECT COUNT(*) FROM `"+tb[0]+"`;"
-        except ValueError as details:
-          query = "SELECT COUNT(*) FROM "+tb[0]+";"
-        result = ask_db(db,query)
-        print("  ",tb[0],"has",result[0][0],"rows")
-      db.close()
+  reported = [line[0] for line in dbs
+              if line[0] not in system_databases
+                 and not re.search('wiki',line[0])]
+  database = None
+  for entry in table_census(host, user, passwd, databases=reported,
+                            exact=exact):
+    if entry.database != database:
+      database = entry.database
+      print("Tables in",database)
+    if entry.error:
+      print("  ",entry.table,"has about",entry.rows,"rows;",entry.error)
+    else:
+      print("  ",entry.table,"has",entry.rows,"rows")
   logging.info("Disconnected from server on %s",host)
 
 def check_database(host, user, passwd, database):
@@ -591,16 +4018,59 @@ def check_table(db_conn, table): ## convert to BaseDB method
 
   @return: True or False
   """
-  q = ask_db(db_conn,"SHOW TABLES LIKE '"+table+"';")
-  if len(q) == 1:
-    return True
-  elif len(q) == 0:
-    return False
-  else:
-    print("check_table: did not understand response")
-    print(q)
-    return False
+  return get_schema(db_conn).has_table(table)
     
+def _strip_auto_increment(db, table, rec):
+  """
+  Removes the auto-increment columns from a record
+
+  The database assigns these when the record is inserted again.
+
+  @param db : database
+  @type  db : BaseDB
+
+  @param table : table name
+  @type  table : str
+
+  @param rec : a dictionary with column names as keys.
+
+  @return: rec
+  """
+  try:
+    for column in db.schema.columns(table):
+      if 'auto_increment' in (column[5] or ''):
+        rec.pop(column[0], None)
+  except Exception:
+    # no column information
+    rec.pop('ID', None)
+  return rec
+
+def insert_record(db, table, rec):
+  """
+  Inserts a record into 'table' of data base 'db'
+
+  @param db : database connection object returned from a MySQLdb connect()
+
+  @param table : table name
+  @type  table : str
+
+  @param rec : a dictionary with column names as keys.
+
+  @return: record ID (int)
+  """
+  columns = list(rec.keys())
+  query = "INSERT INTO "+table+" (" \
+          +", ".join(["`"+col+"`" for col in columns])+") VALUES (" \
+          +", ".join(["%s"]*len(columns))+");"
+  c = db.cursor()
+  try:
+    c.execute(query, [rec[col] for col in columns])
+    ID = c.lastrowid
+  finally:
+    c.close()
+  db.commit()
+  return ID
+
 def update_record(db, table, fields, condition): # not allowed in DSS28db
   """
   Updates a record in 'table' of data base 'db'
@@ -689,6 +4159,7 @@ def create_table(database,name,keys):
     print("create_table:",create_string)
   try:
     cursor.execute(create_string)
+    get_schema(database).invalidate()
     return tbname
   except Exception as detail:
     print("create_table: execution failed")
@@ -763,5 +4234,4 @@ def get_table_columns(db_conn,table):
       default value              e.g. 'None'
       extra information (string)
   """
-  q = sql.ask_db(db_conn,"SHOW COLUMNS FROM "+table+";")
-  return q
+  return get_schema(db_conn).columns(table)
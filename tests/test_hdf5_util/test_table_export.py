@@ -0,0 +1,83 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+
+from support.mysql import BaseDB
+from support.hdf5_util import TableExporter
+
+class TestTableExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.db = BaseDB(name=":memory:", backend="sqlite")
+        self.db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY "
+                    "AUTOINCREMENT, year INT, doy INT, utc DOUBLE, "
+                    "TAmb DOUBLE, name TEXT)")
+        self.insert(97, 25)
+        self.insert(98, 10)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.base_dir)
+
+    def insert(self, doy, count):
+        utc = 1586131200. + (doy - 97)*86400
+        self.db.insert_records("weather", [
+            {"year": 2020, "doy": doy, "utc": utc + second,
+             "TAmb": 20. + second, "name": "wx"} for second in range(count)])
+
+    def test_export(self):
+        exporter = TableExporter(self.db, "weather", self.base_dir,
+                                 chunk_rows=10)
+        self.assertEqual(exporter.export(), 35)
+        path = exporter.file_path(2020, 97)
+        self.assertEqual(path, os.path.join(self.base_dir, "2020", "097",
+                                            "weather.hdf5"))
+        with h5py.File(path, "r") as f_obj:
+            self.assertEqual(f_obj["TAmb"].shape, (25,))
+            self.assertEqual(f_obj["ID"][-1], 25)
+            self.assertEqual(f_obj["name"][0], b"wx")
+            self.assertEqual(f_obj.attrs["last_id"], 25)
+        self.assertEqual(exporter.last_exported_id(), 35)
+
+    def test_resume(self):
+        exporter = TableExporter(self.db, "weather", self.base_dir,
+                                 columns=["utc"], chunk_rows=10)
+        exporter.export()
+        self.insert(98, 5)
+        # as if the last export stopped before the state was saved
+        exporter._save_state(30)
+        self.assertEqual(TableExporter(self.db, "weather", self.base_dir,
+                                       columns=["utc"]).export(), 5)
+        with h5py.File(exporter.file_path(2020, 98), "r") as f_obj:
+            self.assertEqual(f_obj["ID"][...].tolist(), list(range(26, 41)))
+            self.assertEqual(sorted(f_obj.keys()), ["ID", "utc"])
+
+    def test_nulls(self):
+        exporter = TableExporter(self.db, "weather", self.base_dir,
+                                 chunk_rows=10)
+        exporter.export()
+        self.db.insert_records("weather", [
+            {"year": 2020, "doy": 97, "utc": 1586131300., "TAmb": None,
+             "name": "wx"},
+            {"year": 2020, "doy": 97, "utc": 1586131301., "TAmb": 21.,
+             "name": None}])
+        self.insert(97, 1)
+        self.assertEqual(exporter.export(), 3)
+        with h5py.File(exporter.file_path(2020, 97), "r") as f_obj:
+            self.assertEqual(sorted(f_obj["mask"].keys()), ["TAmb", "name"])
+            self.assertEqual(f_obj["mask/TAmb"].shape, (28,))
+            self.assertEqual(np.flatnonzero(f_obj["mask/TAmb"][...]).tolist(),
+                             [25])
+            self.assertEqual(np.flatnonzero(f_obj["mask/name"][...]).tolist(),
+                             [26])
+            self.assertTrue(np.isnan(f_obj["TAmb"][25]))
+        with h5py.File(exporter.file_path(2020, 98), "r") as f_obj:
+            self.assertFalse("mask" in f_obj)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,460 @@
+import unittest
+import datetime
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import Pyro4
+
+from support.messagebus.messagebus import (BoundedQueue, DeliveryWorker,
+                                           Handover, Message, MessageBus,
+                                           MessageRing, MemoryStorage,
+                                           QueueLimit, SqliteStorage)
+
+def make_message(data):
+    return Message(uuid.uuid1(), datetime.datetime.now(), data)
+
+class TestMessageRing(unittest.TestCase):
+
+    def test_grow_keeps_views(self):
+        ring = MessageRing(capacity=4)
+        for count in range(3):
+            ring.append(count)
+        pending = ring.pending()
+        for count in range(3, 10):
+            ring.append(count)
+        self.assertEqual(list(pending), [0, 1, 2])
+        self.assertEqual(list(ring.pending()), list(range(10)))
+
+    def test_acknowledge(self):
+        ring = MessageRing(capacity=4)
+        for count in range(4):
+            ring.append(count)
+        ring.acknowledge(3)
+        ring.append(4)
+        ring.append(5)
+        pending = ring.pending()
+        self.assertEqual(list(pending), [3, 4, 5])
+        self.assertEqual(pending[-1], 5)
+        self.assertEqual(pending.start_seq, 3)
+        ring.acknowledge(100)
+        self.assertEqual(len(ring), 0)
+
+    def test_detach(self):
+        ring = MessageRing(capacity=4)
+        for count in range(4):
+            ring.append(count)
+        taken = ring.detach(3)
+        # the messages left are moved, so new ones do not overwrite the view
+        for count in range(4, 7):
+            ring.append(count)
+        self.assertEqual(list(taken), [0, 1, 2])
+        self.assertEqual(list(ring.pending()), [3, 4, 5, 6])
+        # fewer taken than left are copied
+        self.assertEqual(ring.detach(1), [3])
+        self.assertEqual(list(ring.detach()), [4, 5, 6])
+        self.assertEqual(len(ring), 0)
+
+class TestBoundedQueue(unittest.TestCase):
+
+    def fill(self, limit, values):
+        bounded = BoundedQueue(limit)
+        for value in values:
+            bounded.put("weather", make_message(value))
+        return bounded
+
+    def data(self, bounded):
+        return [message.data for message in bounded.pending()]
+
+    def test_drop(self):
+        bounded = self.fill(QueueLimit(max_messages=3), range(5))
+        self.assertEqual(self.data(bounded), [2, 3, 4])
+        self.assertEqual(bounded.counters["dropped_oldest"], 2)
+        bounded = self.fill(QueueLimit(max_messages=3, policy="drop_newest"), range(5))
+        self.assertEqual(self.data(bounded), [0, 1, 2])
+        self.assertEqual(bounded.counters["dropped_newest"], 2)
+        size = QueueLimit(max_bytes=1).size(make_message(0))
+        bounded = self.fill(QueueLimit(max_bytes=2*size), range(5))
+        self.assertEqual(self.data(bounded), [3, 4])
+        self.assertEqual(bounded.nbytes, 2*size)
+
+    def test_latest(self):
+        limit = QueueLimit(max_messages=2, policy="latest", key="sensor")
+        bounded = BoundedQueue(limit)
+        for sensor, value in [("a", 1), ("b", 2), ("a", 3), ("c", 4), ("b", 5)]:
+            bounded.put("weather", make_message({"sensor": sensor, "value": value}))
+        # a replaced message keeps its place
+        self.assertEqual(self.data(bounded), [{"sensor": "b", "value": 5},
+                                              {"sensor": "c", "value": 4}])
+        self.assertEqual(bounded.counters["replaced"], 2)
+        self.assertEqual(bounded.counters["dropped_oldest"], 1)
+
+    def test_spill(self):
+        bounded = self.fill(QueueLimit(max_messages=3, policy="spill"), range(10))
+        self.assertEqual(len(bounded), 10)
+        self.assertEqual(bounded.stats()["on_disk"], 7)
+        received = []
+        while len(bounded):
+            topic, messages, queued = bounded.take()
+            received.extend(message.data for message in messages)
+            bounded.done()
+        self.assertEqual(received, list(range(10)))
+        self.assertEqual(bounded.counters["unspilled"], 7)
+
+    def test_acknowledge(self):
+        bounded = self.fill(QueueLimit(max_messages=2, policy="spill"), range(5))
+        pending = bounded.pending()
+        bounded.acknowledge(pending.last_seq + 1)
+        self.assertEqual(self.data(bounded), [2, 3])
+        bounded.set_limit(QueueLimit(max_messages=2, policy="drop_newest"))
+        self.assertEqual(self.data(bounded), [2, 3])
+        self.assertEqual(len(bounded), 2)
+
+class TestMemoryStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.storage.create_topic("weather")
+
+    def test_remove_pending(self):
+        for count in range(5):
+            self.storage.add_message("weather", make_message(count))
+        pending = self.storage.all_pending_messages()
+        self.storage.add_message("weather", make_message(5))
+        self.storage.remove_messages(pending)
+        remaining = self.storage.all_pending_messages()["weather"]
+        self.assertEqual([message.data for message in remaining], [5])
+        self.assertEqual(self.storage.stats(), (1, 0, 1, 6))
+
+    def test_limit(self):
+        self.storage.set_limit("weather", QueueLimit(max_messages=2))
+        for count in range(2, 5):
+            self.storage.add_message("weather", make_message(count))
+        pending = self.storage.all_pending_messages()
+        self.assertEqual([message.data for message in pending["weather"]], [3, 4])
+        self.storage.remove_messages(pending)
+        self.assertFalse(self.storage.has_pending_messages("weather"))
+        self.assertEqual(self.storage.queue_stats()["weather"]["dropped_oldest"], 1)
+
+    def test_remove_list(self):
+        messages = [make_message(count) for count in range(3)]
+        for message in messages:
+            self.storage.add_message("weather", message)
+        self.storage.remove_messages({"weather": messages[:2]})
+        self.assertTrue(self.storage.has_pending_messages("weather"))
+        self.storage.acknowledge("weather", 3)
+        self.assertFalse(self.storage.has_pending_messages("weather"))
+        self.assertEqual(self.storage.all_pending_messages(), {})
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "messages.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_messages(self):
+        storage = SqliteStorage(self.path)
+        storage.create_topic("weather")
+        self.assertTrue(storage.add_message("weather", make_message(0)) is None)
+        storage.add_subscriber("weather", Pyro4.Proxy("PYRO:sub@localhost:9"))
+        self.assertTrue(storage.has_subscribers("weather"))
+        committed = [storage.add_message("weather", make_message(count))
+                     for count in range(1, 4)]
+        for future in committed:
+            future.result()
+        with self.assertRaises(KeyError):
+            storage.add_message("tipper", make_message(0))
+        pending = storage.all_pending_messages()
+        self.assertEqual([message.data for message in pending["weather"]],
+                         [1, 2, 3])
+        storage.add_message("weather", make_message(4)).result()
+        storage.remove_messages(pending)
+        # a new storage, as after a restart, has what was not delivered
+        storage = SqliteStorage(self.path)
+        pending = storage.all_pending_messages()["weather"]
+        self.assertEqual([message.data for message in pending], [4])
+        self.assertEqual(storage.stats()[:3], (1, 1, 1))
+
+    def test_take(self):
+        storage = SqliteStorage(self.path)
+        storage.create_topic("weather")
+        storage.add_subscriber("weather", Pyro4.Proxy("PYRO:sub@localhost:9"))
+        for count in range(3):
+            storage.add_message("weather", make_message(count)).result()
+        first = storage.pending_messages(["weather"])
+        storage.take(first)
+        self.assertEqual(storage.pending_messages(["weather"]), {})
+        storage.add_message("weather", make_message(3)).result()
+        second = storage.pending_messages(["weather"])
+        storage.take(second)
+        self.assertEqual([message.data for message in second["weather"]], [3])
+        # only the delivered messages are removed, whatever the order
+        storage.remove_messages(second)
+        storage = SqliteStorage(self.path)
+        pending = storage.all_pending_messages()["weather"]
+        self.assertEqual([message.data for message in pending], [0, 1, 2])
+
+    def test_migrate(self):
+        message = make_message("old")
+        whole = Message(uuid.uuid1(), datetime.datetime(2020, 4, 6, 12), "whole")
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE Topic (id INTEGER PRIMARY KEY, "
+                     "topic NVARCHAR(500) UNIQUE NOT NULL)")
+        conn.execute("CREATE TABLE Message (id CHAR(36) PRIMARY KEY, "
+                     "created DATETIME NOT NULL, topic INTEGER NOT NULL, "
+                     "msgdata BLOB NOT NULL)")
+        conn.execute("INSERT INTO Topic(topic) VALUES ('weather')")
+        conn.execute("INSERT INTO Message VALUES (?, ?, 1, ?)",
+                     [str(message.msgid), str(message.created),
+                      pickle.dumps(message.data)])
+        # an older legacy row, without microseconds, stored after it
+        conn.execute("INSERT INTO Message VALUES (?, ?, 1, ?)",
+                     [str(whole.msgid), str(whole.created),
+                      pickle.dumps(whole.data)])
+        conn.commit()
+        conn.close()
+        pending = SqliteStorage(self.path).all_pending_messages()["weather"]
+        self.assertEqual([message.data for message in pending], ["whole", "old"])
+        self.assertEqual(pending[0].created, whole.created)
+        self.assertEqual(pending[1].created, message.created)
+
+class Receiver(object):
+
+    def __init__(self, delay=0., fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.received = []
+        self.done = threading.Event()
+
+    def incoming_message(self, topic, message):
+        self.incoming_messages(topic, [message])
+
+    def incoming_messages(self, topic, messages):
+        if self.fail:
+            raise IOError("subscriber is gone")
+        time.sleep(self.delay)
+        self.received.extend(message.data for message in messages)
+        self.done.set()
+
+class ProxyReceiver(Receiver):
+    """
+    A Receiver which SqliteStorage takes for a Pyro proxy
+    """
+    def __init__(self, name, **kwargs):
+        super(ProxyReceiver, self).__init__(**kwargs)
+        self._pyroUri = Pyro4.URI("PYRO:%s@localhost:9" % name)
+
+    def _pyroRelease(self):
+        pass
+
+class TestDeliveryWorker(unittest.TestCase):
+
+    def test_order_and_limit(self):
+        receiver = Receiver(delay=0.05)
+        worker = DeliveryWorker(receiver, None, max_in_flight=4)
+        worker.put("weather", [make_message(0)])
+        while not worker.idle():
+            time.sleep(0.01)
+        for count in range(1, 4):
+            worker.put("weather", [make_message(2*count - 1),
+                                   make_message(2*count)])
+        while not worker.idle():
+            time.sleep(0.01)
+        stats = worker.stats()
+        self.assertEqual(receiver.received, [0, 3, 4, 5, 6])
+        self.assertEqual(stats["dropped"], 2)
+        self.assertEqual(stats["delivered"], 5)
+        self.assertGreater(stats["latency_max"], 0.)
+        worker.stop()
+
+    def test_handover(self):
+        receiver = Receiver(delay=0.05)
+        worker = DeliveryWorker(receiver, None,
+                                limit=QueueLimit(max_messages=2,
+                                                 policy="drop_newest"))
+        done = []
+        batch = [make_message(count) for count in range(3)]
+        handover = Handover("weather", batch, 3, lambda topic, messages:
+                            done.append((topic, list(receiver.received))))
+        worker.put("weather", batch, handover)
+        while not worker.idle():
+            time.sleep(0.01)
+        # the third message was dropped, the others delivered first
+        self.assertEqual(done, [("weather", [0, 1])])
+        worker.stop()
+
+class TestMessageBus(unittest.TestCase):
+
+    def test_slow_subscriber(self):
+        bus = MessageBus()
+        slow, fast, broken = Receiver(delay=1.), Receiver(), Receiver(fail=True)
+        for subscriber in (slow, fast, broken):
+            bus.subscribe("weather", subscriber)
+        bus.send("weather", 1)
+        self.assertTrue(fast.done.wait(0.5))
+        self.assertEqual(slow.received, [])
+        for count in range(50):
+            if not bus.storage.subscribers["weather"] - set([slow, fast]):
+                break
+            time.sleep(0.01)
+        self.assertEqual(bus.storage.subscribers["weather"],
+                         set([slow, fast]))
+        stats = bus.delivery_stats()
+        self.assertEqual(stats[str(fast)]["delivered"], 1)
+
+    def test_dirty_topics(self):
+        storage = CountingStorage()
+        bus = MessageBus(storage=storage)
+        receiver = Receiver()
+        for count in range(100):
+            bus.subscribe("topic%d" % count, Receiver())
+        bus.subscribe("weather", receiver)
+        bus.send("weather", 1)
+        self.assertTrue(receiver.done.wait(1.))
+        self.assertEqual(set().union(*storage.read), set(["weather"]))
+        bus.unsubscribe("weather", receiver)
+        self.assertEqual(bus.subscriptions["weather"], set())
+        receiver.done.clear()
+        bus.send("weather", 2)
+        self.assertFalse(receiver.done.wait(0.2))
+        self.assertEqual(receiver.received, [1])
+
+    def test_durable(self):
+        directory = tempfile.mkdtemp()
+        storage = SqliteStorage(os.path.join(directory, "messages.sqlite"))
+        bus = MessageBus(storage=storage)
+        slow = ProxyReceiver("slow", delay=0.3)
+        bus.subscribe("weather", slow)
+        bus.send("weather", 1)
+        time.sleep(0.1)
+        # kept while it is being delivered
+        self.assertEqual(slow.received, [])
+        self.assertEqual(storage.stats()[2], 1)
+        self.assertTrue(slow.done.wait(1.))
+        for count in range(100):
+            if not storage.stats()[2]:
+                break
+            time.sleep(0.02)
+        self.assertEqual(storage.stats()[2], 0)
+        self.assertEqual(slow.received, [1])
+        shutil.rmtree(directory)
+
+    def test_durable_limits(self):
+        directory = tempfile.mkdtemp()
+        storage = SqliteStorage(os.path.join(directory, "messages.sqlite"))
+        bus = MessageBus(storage=storage)
+        slow = ProxyReceiver("slow", delay=0.001)
+        bus.subscribe("weather", slow)
+        def send():
+            for count in range(200):
+                bus.send("weather", count)
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+        # dropping messages reports them to the sender's Handovers meanwhile
+        changer = threading.Thread(target=lambda: [
+            bus.set_subscriber_limit(slow, max_messages=1 + count % 2,
+                                     policy="drop_newest")
+            for count in range(50)])
+        changer.daemon = True
+        changer.start()
+        sender.join(10.)
+        changer.join(10.)
+        self.assertFalse(sender.is_alive() or changer.is_alive())
+        shutil.rmtree(directory)
+
+    def test_block(self):
+        bus = MessageBus()
+        slow = Receiver(delay=0.05)
+        bus.subscribe("weather", slow)
+        bus.set_topic_limit("weather", max_messages=2, policy="block")
+        bus.set_subscriber_limit(slow, max_messages=2, policy="block")
+        start = time.time()
+        for count in range(10):
+            bus.send("weather", count)
+        # the publisher waited for the subscriber
+        self.assertGreater(time.time() - start, 0.1)
+        for count in range(100):
+            if len(slow.received) == 10:
+                break
+            time.sleep(0.02)
+        self.assertEqual(slow.received, list(range(10)))
+        stats = bus.queue_stats()
+        self.assertGreater(stats["topics"]["weather"]["blocked"], 0)
+        self.assertEqual(bus.delivery_stats()[str(slow)]["dropped"], 0)
+
+    def test_block_bound(self):
+        bus = MessageBus()
+        slow = Receiver(delay=0.01)
+        bus.subscribe("weather", slow)
+        bus.set_subscriber_limit(slow, max_messages=10, policy="block")
+        for count in range(200):
+            bus.send("weather", count)
+        waiting = []
+        for count in range(500):
+            stats = bus.delivery_stats().get(str(slow))
+            if stats:
+                waiting.append(stats["queued"] + stats["in_flight"])
+            if len(slow.received) == 200:
+                break
+            time.sleep(0.01)
+        self.assertEqual(slow.received, list(range(200)))
+        self.assertLessEqual(max(waiting), 10)
+
+    def test_blocked_subscriber_dies(self):
+        bus = MessageBus()
+        fast, dying = Receiver(), DyingReceiver(delay=0.2)
+        bus.subscribe("weather", fast)
+        bus.subscribe("weather", dying)
+        bus.set_subscriber_limit(dying, max_messages=1, policy="block")
+        for count in range(3):
+            bus.send("weather", count)
+        # the topic is held back for the dying subscriber, then released
+        for count in range(100):
+            if len(fast.received) == 3:
+                break
+            time.sleep(0.02)
+        self.assertEqual(fast.received, [0, 1, 2])
+        self.assertEqual(bus.subscriptions["weather"], set([fast]))
+        self.assertEqual(bus.held_topics, set())
+
+    def test_topic_limit_unsupported(self):
+        # a file-less storage, so the sender thread that outlives the
+        # test never opens a database in a removed directory
+        storage = MemoryStorage()
+        storage.topic_limits = False
+        bus = MessageBus(storage=storage)
+        with self.assertRaises(TypeError):
+            bus.set_topic_limit("weather", max_messages=10)
+        self.assertEqual(bus.topics(), set())
+
+class DyingReceiver(Receiver):
+    """
+    A Receiver which fails after its delay
+    """
+    def incoming_messages(self, topic, messages):
+        time.sleep(self.delay)
+        raise IOError("subscriber is gone")
+
+class CountingStorage(MemoryStorage):
+    """
+    Records the topics the sender reads
+    """
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.read = []
+
+    def pending_messages(self, topics, counts=None):
+        self.read.append(set(topics))
+        return super(CountingStorage, self).pending_messages(topics, counts)
+
+if __name__ == "__main__":
+    unittest.main()
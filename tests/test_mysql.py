@@ -0,0 +1,897 @@
+import unittest
+import asyncio
+import datetime
+import os
+import pickle
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from MySQLdb.constants import FIELD_TYPE
+
+from support.mysql import (AsyncBaseDB, BaseDB, ConnectionPool, DayMirror,
+                           LogWriter,
+                           MysqlException, QueryCache, QueryStats,
+                           QueryTimeout, Rollup,
+                           SchemaCache, SingleFlight, SQLiteBackend,
+                           SQLiteCursor, day_range, decode_column,
+                           decode_rows, table_census)
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise Exception("connection lost")
+
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection, size=2)
+        with pool.connection() as conn1:
+            pass
+        with pool.connection() as conn2:
+            pass
+        self.assertTrue(conn1 is conn2)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_bounded(self):
+        pool = ConnectionPool(FakeConnection, size=2)
+        conns = [pool.checkout(), pool.checkout()]
+        with self.assertRaises(MysqlException):
+            pool.checkout(timeout=0.05)
+        pool.checkin(conns.pop())
+        self.assertTrue(pool.checkout(timeout=0.05) is not None)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_concurrent(self):
+        pool = ConnectionPool(FakeConnection, size=3)
+        def worker():
+            for i in range(100):
+                with pool.connection():
+                    pass
+        threads = [threading.Thread(target=worker) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertLessEqual(stats['created'], 3)
+        self.assertEqual(stats['checkouts'], 600)
+        self.assertEqual(stats['checkins'], 600)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_idle_check(self):
+        pool = ConnectionPool(FakeConnection, size=1, idle_check=0.)
+        conn = pool.checkout()
+        conn.alive = False
+        pool.checkin(conn)
+        new_conn = pool.checkout(timeout=1)
+        self.assertFalse(new_conn is conn)
+        self.assertTrue(conn.closed)
+        stats = pool.stats()
+        self.assertEqual(stats['ping_failures'], 1)
+        self.assertEqual(stats['background_reconnects'], 1)
+
+    def test_slow_ping(self):
+        gate = threading.Event()
+        pool = ConnectionPool(FakeConnection, size=2, idle_check=0.,
+                              ping=lambda conn: gate.wait())
+        pool.checkin(pool.checkout())
+        thread = threading.Thread(target=pool.checkout)
+        thread.start()
+        time.sleep(0.05)
+        # the pool is not locked while the idle connection is pinged
+        self.assertEqual(pool.stats()['pings'], 1)
+        self.assertTrue(pool.checkout(timeout=0.5) is not None)
+        gate.set()
+        thread.join(1.)
+        self.assertEqual(pool.stats()['checkouts'], 3)
+
+class TestDecodeRows(unittest.TestCase):
+
+    descr = [("ID", FIELD_TYPE.LONG), ("TAmb", FIELD_TYPE.DOUBLE),
+             ("name", FIELD_TYPE.VAR_STRING), ("date", FIELD_TYPE.DATETIME)]
+    rows = [(1, 20.5, "a", datetime.datetime(2020, 1, 1)),
+            (2, None, "bcd", None)]
+
+    def test_types(self):
+        result = decode_rows(self.rows, self.descr, asfloat=False)
+        self.assertEqual(result["ID"].dtype, np.int64)
+        self.assertEqual(result["TAmb"].dtype, np.float64)
+        self.assertEqual(result["name"].dtype, np.dtype("U3"))
+        self.assertEqual(result["date"].dtype, np.dtype("datetime64[us]"))
+        self.assertTrue(np.isnan(result["TAmb"][1]))
+        self.assertTrue(np.isnat(result["date"][1]))
+
+    def test_asfloat(self):
+        result = decode_rows(self.rows, self.descr)
+        self.assertEqual(result["ID"].dtype, np.float64)
+
+    def test_numeric_strings(self):
+        column, mask = decode_column(("1.5", None, "3"), FIELD_TYPE.VAR_STRING)
+        self.assertEqual(column.dtype, np.float64)
+        self.assertEqual(column[[0, 2]].tolist(), [1.5, 3.])
+        self.assertEqual(mask.tolist(), [False, True, False])
+        column, mask = decode_column(("1.5", "3"), FIELD_TYPE.VAR_STRING,
+                                     asfloat=False)
+        self.assertEqual(column.dtype, np.dtype("U3"))
+        # other strings stay strings
+        result = decode_rows(self.rows, self.descr)
+        self.assertEqual(result["name"].dtype, np.dtype("U3"))
+
+    def test_masked(self):
+        result = decode_rows(self.rows, self.descr, masked=True)
+        self.assertEqual(result["TAmb"].mask.tolist(), [False, True])
+        self.assertFalse(result["ID"].mask.any())
+
+    def test_structured(self):
+        result = decode_rows(self.rows, self.descr, structured=True)
+        self.assertEqual(result.dtype.names, ("ID", "TAmb", "name", "date"))
+        self.assertEqual(result["name"][1], "bcd")
+
+    def test_mixed_values(self):
+        # without a field type the kind comes from all the values
+        column, mask = decode_column((1, 2.5), None, asfloat=False)
+        self.assertEqual(column.tolist(), [1., 2.5])
+        column, mask = decode_column((None, 1, "a"), None)
+        self.assertEqual(column.dtype, object)
+        self.assertEqual(column.tolist(), [None, 1, "a"])
+        self.assertEqual(mask.tolist(), [True, False, False])
+
+class TestSchemaCache(unittest.TestCase):
+
+    rows = (("weather", "ID", "int(11)", "NO", "PRI", None, "auto_increment"),
+            ("weather", "TAmb", "float", "YES", "", None, ""),
+            ("tipper", "tau", "float", "YES", "", None, ""))
+
+    def setUp(self):
+        self.queries = []
+        self.schema = SchemaCache(self.execute, database="dss28_eac")
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        return self.rows, None
+
+    def test_lookups(self):
+        self.assertEqual(self.schema.tables(), ["tipper", "weather"])
+        self.assertEqual(self.schema.column_names("weather"), ["ID", "TAmb"])
+        self.assertEqual(self.schema.column("tipper", "tau")[1], "float")
+        self.assertTrue(self.schema.has_table("tipper"))
+        self.assertFalse(self.schema.has_table("nothing"))
+        with self.assertRaises(MysqlException):
+            self.schema.columns("nothing")
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(self.queries[0][1], ("dss28_eac",))
+
+    def test_invalidate(self):
+        self.schema.tables()
+        self.schema.invalidate()
+        self.schema.tables()
+        self.assertEqual(len(self.queries), 2)
+
+    def test_ttl(self):
+        self.schema.ttl = 0.
+        self.schema.tables()
+        time.sleep(0.01)
+        self.schema.tables()
+        self.assertEqual(len(self.queries), 2)
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache(max_bytes=10000, ttl=60.)
+
+    def test_key(self):
+        key = self.cache.key("select TAmb\n  from weather where ID=%s;", [1])
+        self.assertEqual(key, self.cache.key("select TAmb from weather "
+                                             "where ID=%s", (1,)))
+        self.assertTrue(self.cache.key("insert into weather values (1)") is None)
+
+    def test_hit_and_invalidate(self):
+        key = self.cache.key("select TAmb from weather")
+        with self.assertRaises(KeyError):
+            self.cache.get(key)
+        self.cache.put(key, (((20.5,),), None))
+        self.assertEqual(self.cache.get(key)[0], ((20.5,),))
+        self.cache.invalidate("tipper")
+        self.cache.get(key)
+        self.cache.invalidate("weather")
+        with self.assertRaises(KeyError):
+            self.cache.get(key)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["invalidations"], 1)
+
+    def test_tables(self):
+        self.assertEqual(self.cache.tables(
+            "select * from db.weather w, `tipper` t join wind on w.ID=wind.ID,"
+            " (select x from a, b) s where w.ID in (1, 2)"),
+            set(["weather", "tipper", "wind", "a", "b"]))
+        key = self.cache.key("select * from weather, tipper")
+        self.cache.put(key, (((20.5,),), None))
+        self.cache.invalidate("tipper")
+        with self.assertRaises(KeyError):
+            self.cache.get(key)
+
+    def test_stale_put(self):
+        key = self.cache.key("select TAmb from weather")
+        generation = self.cache.generation
+        self.cache.invalidate("weather")
+        self.cache.put(key, (((20.5,),), None), generation)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_eviction(self):
+        rows = tuple([(float(i),) for i in range(20)])
+        for ID in range(100):
+            key = self.cache.key("select TAmb from weather where ID=%s", (ID,))
+            self.cache.put(key, (rows, None))
+        stats = self.cache.stats()
+        self.assertLessEqual(stats["bytes"], 10000)
+        self.assertEqual(stats["entries"] + stats["evictions"], 100)
+
+    def test_expiry(self):
+        self.cache.ttl = 0.
+        key = self.cache.key("select TAmb from weather")
+        self.cache.put(key, (((20.5,),), None))
+        time.sleep(0.01)
+        with self.assertRaises(KeyError):
+            self.cache.get(key)
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_template(self):
+        stats = QueryStats()
+        self.assertEqual(
+            stats.template("select TAmb from  weather\nwhere ID=12 and "
+                           "name='x' and utc in (%s, %s, %s);"),
+            "select TAmb from weather where ID=? and name=? and utc in (...)")
+
+    def test_record(self):
+        stats = QueryStats()
+        stats.record("select TAmb from weather where ID=%s", (1,), 0.003, 1, 40)
+        stats.record("select TAmb from weather where ID=%s", (2,), 0.5, 1, 40)
+        stats.record("select TAmb from weather where ID=%s", (3,), 0.1,
+                     error=True)
+        stats.count("reconnects")
+        result = stats.stats()
+        entry = result["templates"]["select TAmb from weather where ID=?"]
+        self.assertEqual(entry["calls"], 3)
+        self.assertEqual(entry["errors"], 1)
+        self.assertEqual(entry["rows"], 2)
+        self.assertEqual(entry["max_time"], 0.5)
+        self.assertEqual(sum(entry["histogram"]), 3)
+        self.assertEqual(result["counters"], {"reconnects": 1})
+
+    def test_slow_query(self):
+        stats = QueryStats(slow_query=0.1)
+        with self.assertLogs(stats.logger, "WARNING"):
+            stats.record("select TAmb from weather", None, 0.2)
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = 0
+
+    def slow(self):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        return self.runs
+
+    def run_concurrently(self, count):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       self.flights.do("query", self.slow)))
+                   for index in range(count)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.flights.stats()["calls"] < count:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_shared(self):
+        self.assertEqual(self.run_concurrently(5), [1]*5)
+        stats = self.flights.stats()
+        self.assertEqual(stats["deduplicated"], 4)
+        self.assertEqual(stats["executions"], 1)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_error(self):
+        def fail():
+            raise MysqlException("lost connection")
+        with self.assertRaises(MysqlException):
+            self.flights.do("query", fail)
+        self.assertEqual(self.flights.do("query", lambda: 2), 2)
+
+    def test_invalidate(self):
+        thread = threading.Thread(target=self.flights.do,
+                                  args=("query", self.slow))
+        thread.start()
+        self.started.wait(5)
+        self.flights.invalidate()
+        self.assertEqual(self.flights.do("query", lambda: "new"), "new")
+        self.release.set()
+        thread.join()
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.rows = {"status": [{"ID": 1, "mode": "idle", "temp": 20.}]}
+        self.schema = SchemaCache(self.execute)
+        self.fail = False
+        self.commit_rows = None   # rows committed before failing
+        self.gate = None          # event which inserts wait for
+
+    def execute(self, query, params=None):
+        return (("status", "ID", "int(11)", "NO", "PRI", None,
+                 "auto_increment"),), None
+
+    def getLastRecord(self, table):
+        return dict(self.rows[table][-1])
+
+    def insert_records(self, table, records):
+        if self.gate:
+            self.gate.wait()
+        if self.commit_rows is not None:
+            self.rows[table].extend(records[:self.commit_rows])
+            error = MysqlException("connection lost")
+            error.committed = list(range(min(self.commit_rows, len(records))))
+            self.commit_rows = None
+            raise error
+        if self.fail:
+            raise MysqlException("database unavailable")
+        self.rows[table].extend(records)
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.spool = os.path.join(tempfile.mkdtemp(), "spool.p")
+
+    def tearDown(self):
+        directory = os.path.dirname(self.spool)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_update(self):
+        writer = LogWriter(self.db, batch_size=10)
+        for count in range(25):
+            writer.update("status", {"temp": float(count)})
+        writer.update("status", {"mode": "busy"})
+        self.assertTrue(writer.flush(timeout=5))
+        rows = self.db.rows["status"]
+        self.assertEqual(len(rows), 27)
+        self.assertEqual(rows[-1], {"mode": "busy", "temp": 24.})
+        writer.close()
+
+    def test_retry(self):
+        self.db.fail = True
+        writer = LogWriter(self.db, retry_interval=0.01)
+        writer.update("status", {"temp": 30.})
+        self.assertFalse(writer.flush(timeout=0.1))
+        self.db.fail = False
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(self.db.rows["status"][-1]["temp"], 30.)
+        writer.close()
+
+    def test_spool(self):
+        self.db.fail = True
+        writer = LogWriter(self.db, spool=self.spool, retry_interval=0.01)
+        writer.update("status", {"temp": 30.})
+        self.assertGreater(os.path.getsize(self.spool), 0)
+        # the writer gives up, as when the process stops
+        self.assertFalse(writer.close(timeout=0.05))
+        self.assertEqual(len(self.db.rows["status"]), 1)
+        # a new writer writes what was spooled
+        self.db.fail = False
+        new_writer = LogWriter(self.db, spool=self.spool)
+        self.assertTrue(new_writer.flush(timeout=5))
+        self.assertEqual(len(self.db.rows["status"]), 2)
+        self.assertEqual(self.db.rows["status"][-1]["temp"], 30.)
+        self.assertEqual(os.path.getsize(self.spool), 0)
+        new_writer.close()
+
+    def test_closed_while_full(self):
+        self.db.gate = threading.Event()
+        writer = LogWriter(self.db, max_queue=1)
+        # one row being inserted and one queued
+        writer.update("status", {"temp": 30.})
+        time.sleep(0.05)
+        writer.update("status", {"temp": 31.})
+        errors = []
+        def update():
+            try:
+                writer.update("status", {"temp": 32.})
+            except MysqlException as details:
+                errors.append(details)
+        thread = threading.Thread(target=update)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(writer.close(timeout=0.05))
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.db.gate.set()
+
+    def test_write_behind(self):
+        db = BaseDB(name=":memory:", backend="sqlite")
+        with self.assertRaises(MysqlException):
+            db.write_behind()
+        db.close()
+
+    def test_acknowledged(self):
+        rec = {"mode": "idle", "temp": 20.}
+        with open(self.spool, "wb") as f:
+            for seq in range(3):
+                pickle.dump((seq, "status", dict(rec, temp=float(seq))), f)
+        with open(self.spool + ".ack", "wb") as f:
+            pickle.dump([0, 1], f)
+        # only the row not acknowledged is written again
+        writer = LogWriter(self.db, spool=self.spool)
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual([row["temp"] for row in self.db.rows["status"]],
+                         [20., 2.])
+        writer.update("status", {"mode": "busy"})
+        self.assertTrue(writer.close(timeout=5))
+        self.assertEqual(self.db.rows["status"][-1], {"mode": "busy",
+                                                      "temp": 2.})
+
+    def test_partial_failure(self):
+        self.db.commit_rows = 2
+        writer = LogWriter(self.db, spool=self.spool, batch_size=10,
+                           retry_interval=0.01)
+        for count in range(5):
+            writer.update("status", {"temp": float(count)})
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual([row["temp"] for row in self.db.rows["status"]],
+                         [20., 0., 1., 2., 3., 4.])
+        writer.close()
+
+    def test_compact(self):
+        writer = LogWriter(self.db, spool=self.spool, batch_size=2)
+        for count in range(50):
+            writer.update("status", {"temp": float(count)})
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(writer.stats()["written"], 50)
+        self.assertGreater(writer.stats()["compactions"], 1)
+        self.assertEqual(os.path.getsize(self.spool), 0)
+        writer.close()
+
+class TestSQLiteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.db = BaseDB(name=":memory:", backend="sqlite")
+        self.db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY "
+                    "AUTOINCREMENT, year INT, doy INT, utc DOUBLE, "
+                    "TAmb DOUBLE)")
+        self.utcs = [1586131200. + second for second in range(10)]
+        self.IDs = self.db.insert_records(
+            "weather", [{"year": 2020, "doy": 97, "utc": utc, "TAmb": 20.}
+                        for utc in self.utcs])
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_translate(self):
+        self.assertEqual(
+            SQLiteCursor.translate("select '%s' from t where a=%s and "
+                                   "b=%(b)s and c like 'x%%'", ()),
+            "select '%s' from t where a=? and b=:b and c like 'x%%'")
+
+    def test_insert_records(self):
+        self.assertEqual(self.IDs, list(range(1, 11)))
+        self.assertEqual(self.db.getLastRecord("weather")["utc"],
+                         self.utcs[-1])
+        self.assertEqual(self.db.schema.column_names("weather"),
+                         ["ID", "year", "doy", "utc", "TAmb"])
+
+    def test_lastrowid(self):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO weather (year, doy) VALUES "
+                           "(%s, %s), (%s, %s)", (2020, 98, 2020, 98))
+            self.assertEqual(cursor.lastrowid, 11)
+            cursor.execute("UPDATE weather SET TAmb=%s WHERE doy=%s",
+                           (21., 97))
+            self.assertEqual(cursor.rowcount, 10)
+            self.assertEqual(cursor.lastrowid, 12)
+            cursor.close()
+
+    def test_update_values(self):
+        self.db.updateValues({"TAmb": 21.}, "weather")
+        rec = self.db.getLastRecord("weather")
+        self.assertEqual(rec["ID"], 11)
+        self.assertEqual((rec["utc"], rec["TAmb"]), (self.utcs[-1], 21.))
+
+    def test_insert_ids(self):
+        # as a server with interleaved auto-increment locks
+        backend = SQLiteBackend()
+        backend.autoinc_query = "SELECT 1, 2"
+        db = BaseDB(name=":memory:", backend=backend)
+        db.get("CREATE TABLE t (ID INTEGER PRIMARY KEY, x INT, y INT)")
+        IDs = db.insert_records("t", [{"x": 1}, {"x": 2}, {"y": 3}])
+        self.assertEqual(IDs, [1, None, 3])
+        db.close()
+
+    def test_get_rows(self):
+        rows = self.db.get_rows_by_date("weather", ["utc", "TAmb"], 2020, 97)
+        self.assertEqual(rows["utc"].tolist(), self.utcs)
+        rows = self.db.get_rows_by_time("weather", ["TAmb"], 2020, 97,
+                                        [self.utcs[3] + 0.2], tolerance=0.5)
+        self.assertEqual(rows["TAmb"].tolist(), [20.])
+
+    def test_get_rows_by_time(self):
+        self.db.insertRecord("weather", {"year": 2020, "doy": 97,
+                                         "utc": self.utcs[3], "TAmb": 25.})
+        wanted = [self.utcs[5], self.utcs[3], self.utcs[5]]
+        rows = self.db.get_rows_by_time("weather", ["utc", "TAmb"], 2020, 97,
+                                        wanted, chunk_size=1)
+        self.assertEqual(rows["utc"].tolist(), wanted)
+        # the first row with a time is used
+        self.assertEqual(rows["TAmb"].tolist(), [20., 20., 20.])
+        with self.assertRaises(MysqlException):
+            self.db.get_rows_by_time("weather", ["TAmb"], 2020, 97,
+                                     [self.utcs[3] + 0.5])
+
+    def test_iter_query(self):
+        chunks = list(self.db.iter_query("SELECT utc FROM weather ORDER BY ID",
+                                         chunk_rows=4))
+        self.assertEqual([len(chunk["utc"]) for chunk in chunks], [4, 4, 2])
+        self.assertEqual(np.concatenate([chunk["utc"] for chunk in chunks])
+                           .tolist(), self.utcs)
+        db = BaseDB(name=":memory:", backend="sqlite", pool_size=1)
+        db.get("CREATE TABLE t (ID INTEGER PRIMARY KEY, x INT)")
+        db.insert_records("t", [{"x": count} for count in range(10)])
+        rows = db.iter_query("SELECT x FROM t", chunk_rows=3)
+        self.assertEqual(next(rows)["x"].tolist(), [0, 1, 2])
+        self.assertEqual(db.pool_stats()["in_use"], 1)
+        # leaving early gives the connection back
+        rows.close()
+        self.assertEqual(db.pool_stats()["in_use"], 0)
+        self.assertEqual(len(db.get("SELECT * FROM t")), 10)
+        db.close()
+
+    def test_get_rows_by_range(self):
+        db = BaseDB(name=":memory:", backend="sqlite", pool_size=3)
+        db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY, "
+               "year INT, doy INT, utc DOUBLE, TAmb DOUBLE)")
+        utcs = np.arange(1586131200., 1586131200. + 3*86400, 1800.)
+        records = [dict(zip(("year", "doy", "utc", "TAmb"),
+                            (2020, 97 + int((utc - utcs[0])//86400), utc, 1.)))
+                   for utc in utcs[::-1]]
+        db.insert_records("weather", records)
+        calls = []
+        rows = db.get_rows_by_range(
+            "weather", ["TAmb", "utc"], datetime.datetime(2020, 4, 6, 12),
+            datetime.date(2020, 4, 9), partition="hour",
+            progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(rows["utc"].tolist(), utcs[24:].tolist())
+        self.assertEqual(calls[-1], (60, 60))
+        rows = db.get_rows_by_range("weather", ["TAmb"], utcs[0], utcs[-1])
+        self.assertEqual(len(rows["TAmb"]), len(utcs) - 1)
+        db.close()
+
+    def test_range_progress(self):
+        db = BaseDB(name=":memory:", backend="sqlite", pool_size=2)
+        db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY, "
+               "year INT, doy INT, utc DOUBLE, TAmb DOUBLE)")
+        utcs = [1586131200., 1586131200. + 86400]
+        db.insert_records("weather", [{"year": 2020, "doy": 97 + day,
+                                       "utc": utc, "TAmb": 1.}
+                                      for day, utc in enumerate(utcs)])
+        execute = db._execute
+        reported = threading.Event()
+        waited = []
+        def execute_first_late(query, params):
+            # the first partition finishes after the second is reported
+            if params[1] == 97:
+                waited.append(reported.wait(1.))
+            return execute(query, params)
+        db._execute = execute_first_late
+        calls = []
+        def progress(done, total):
+            calls.append((done, total))
+            reported.set()
+        rows = db.get_rows_by_range("weather", ["utc"], utcs[0],
+                                    utcs[1] + 86400, progress=progress)
+        self.assertEqual(waited, [True])
+        self.assertEqual(calls, [(1, 2), (2, 2)])
+        self.assertEqual(rows["utc"].tolist(), utcs)
+        db.close()
+
+    def test_downsample(self):
+        data = self.db.downsample("weather", ["TAmb"], self.utcs[0],
+                                  self.utcs[0] + 20, buckets=4)
+        self.assertEqual(data["utc"].tolist(), [self.utcs[0] + 5*count
+                                                for count in range(4)])
+        self.assertEqual(data["TAmb"]["count"].tolist(), [5, 5, 0, 0])
+        self.assertEqual(data["TAmb"]["mean"][0], 20.)
+        self.assertTrue(np.isnan(data["TAmb"]["max"][3]))
+
+    def test_day_range(self):
+        new_year = 1577836800.          # 2020-01-01 00:00:00
+        self.assertEqual(day_range(new_year - 10, new_year),
+                         ("year = %s AND doy BETWEEN %s AND %s",
+                          (2019, 365, 365)))
+        condition, params = day_range(new_year - 10, new_year + 86400 + 1)
+        self.assertEqual(params, (2019, 365, 2019, 2020, 2020, 2))
+        # the day is checked as well as the time
+        self.db.insertRecord("weather", {"year": 2020, "doy": 96,
+                                         "utc": self.utcs[0] + 1,
+                                         "TAmb": 50.})
+        data = self.db.downsample("weather", ["TAmb"], self.utcs[0],
+                                  self.utcs[0] + 20, buckets=4)
+        self.assertEqual(data["TAmb"]["max"][0], 20.)
+
+    def test_follow(self):
+        rows = self.db.follow("weather", ["utc"], since_id=0,
+                              min_interval=0.01, max_interval=0.05)
+        chunk = next(rows)
+        self.assertEqual(chunk["utc"].tolist(), self.utcs)
+        self.assertEqual(chunk["ID"].tolist(), self.IDs)
+        self.db.insertRecord("weather", {"year": 2020, "doy": 97,
+                                         "utc": 1586131210., "TAmb": 21.})
+        self.assertEqual(next(rows)["utc"].tolist(), [1586131210.])
+        rows.close()
+
+    def test_subscribe(self):
+        chunks = []
+        with self.assertRaises(MysqlException):
+            self.db.subscribe("weather", ["TAmb"], chunks.append)
+        self.db.close()
+        self.db = BaseDB(name=":memory:", backend="sqlite", pool_size=2)
+        self.db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY, "
+                    "year INT, doy INT, utc DOUBLE, TAmb DOUBLE)")
+        stop = self.db.subscribe("weather", ["TAmb"], chunks.append,
+                                 min_interval=0.01, max_interval=0.05)
+        self.db.insertRecord("weather", {"year": 2020, "doy": 97,
+                                         "utc": 1586131210., "TAmb": 21.})
+        for count in range(100):
+            if chunks:
+                break
+            time.sleep(0.01)
+        stop.set()
+        self.assertEqual(chunks[0]["TAmb"].tolist(), [21.])
+
+    def test_timeout(self):
+        endless = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL "
+                   "SELECT x + 1 FROM c) SELECT COUNT(*) FROM c")
+        running = []
+        timer = threading.Timer(0.05, lambda: running.extend(
+                                    self.db.in_flight()))
+        timer.start()
+        with self.db.time_limit(0.2):
+            with self.assertRaises(QueryTimeout):
+                self.db.get(endless)
+        timer.join()
+        self.assertEqual(running[0]["query"], endless)
+        self.assertEqual(running[0]["timeout"], 0.2)
+        self.assertEqual(self.db.in_flight(), [])
+        self.assertEqual(len(self.db.get("SELECT * FROM weather")), 10)
+
+    def test_late_cancel(self):
+        # a cancel which is still running when the statement ends
+        class SlowCancel(SQLiteBackend):
+            def __init__(self):
+                SQLiteBackend.__init__(self)
+                self.sides = []
+                self.done = threading.Event()
+            def cancel(self, conn, side):
+                self.sides.append(side())
+                time.sleep(0.1)
+                self.done.set()
+        backend = SlowCancel()
+        db = BaseDB(name=":memory:", backend=backend, pool_size=1)
+        for count in range(2):
+            backend.done.clear()
+            with db.connection() as conn:
+                with db.time_limit(0.01):
+                    with db._watch(conn, "SELECT 1"):
+                        time.sleep(0.05)
+                # the connection is held until the cancel is done
+                self.assertTrue(backend.done.is_set())
+        self.assertEqual(len(backend.sides), 2)
+        self.assertTrue(backend.sides[0] is backend.sides[1])
+        db.close()
+
+    def test_rollup(self):
+        rollup = Rollup(self.db, "weather", ["TAmb"], chunk_rows=4)
+        rollup.create()
+        self.assertEqual(rollup.update(), 10)
+        self.assertEqual(rollup.watermark(), 10)
+        self.db.insert_records("weather", [
+            {"year": 2020, "doy": 97, "utc": self.utcs[0] + 3600, "TAmb": 30.},
+            {"year": 2020, "doy": 98, "utc": self.utcs[0] + 86400,
+             "TAmb": 10.}])
+        self.assertEqual(rollup.update(), 2)
+        self.assertEqual(rollup.update(), 0)
+        day = rollup.get(self.utcs[0], self.utcs[0] + 2*86400, 86400)
+        self.assertEqual(day["TAmb"]["count"].tolist(), [11, 1])
+        self.assertEqual(day["TAmb"]["max"].tolist(), [30., 10.])
+        hours = rollup.get(self.utcs[0], self.utcs[0] + 86400, 2*3600)
+        self.assertEqual(hours["TAmb"]["count"][:2].tolist(), [11, 0])
+        self.assertAlmostEqual(hours["TAmb"]["mean"][0], 230./11)
+        raw = rollup.get(self.utcs[0], self.utcs[0] + 20, 10)
+        self.assertEqual(raw["TAmb"]["count"].tolist(), [10, 0])
+
+    def test_rollup_late(self):
+        rollup = Rollup(self.db, "weather", ["TAmb"])
+        rollup.create()
+        rollup.update()
+        self.db.get("UPDATE weather_hour SET TAmb_max=99 WHERE utc=%s",
+                    (self.utcs[0],))
+        # a late row is only summarized with the rows of its own hour
+        self.db.insert_records("weather", [
+            {"year": 2020, "doy": 97, "utc": self.utcs[0] + 5*3600 + 10,
+             "TAmb": 50.},
+            {"year": 2020, "doy": 97, "utc": self.utcs[0] + 5*3600,
+             "TAmb": 40.}])
+        self.assertEqual(rollup.update(), 2)
+        hours = self.db.get("SELECT utc, TAmb_max, TAmb_count FROM "
+                            "weather_hour ORDER BY utc")
+        self.assertEqual(hours.tolist(), [[self.utcs[0], 99., 10],
+                                          [self.utcs[0] + 5*3600, 50., 2]])
+        day = rollup.get(self.utcs[0], self.utcs[0] + 86400, 86400)
+        self.assertEqual(day["TAmb"]["count"].tolist(), [12])
+        self.assertEqual(day["TAmb"]["max"].tolist(), [99.])
+
+    def test_pool(self):
+        db = BaseDB(name=":memory:", backend="sqlite", pool_size=2)
+        db.get("CREATE TABLE t (ID INTEGER PRIMARY KEY, x INT)")
+        db.insert_records("t", [{"x": count} for count in range(5)])
+        self.assertEqual(len(db.get("SELECT * FROM t")), 5)
+        db.close()
+
+class TestTableCensus(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "census.db")
+        db = BaseDB(name=self.path, backend="sqlite")
+        for table, rows in (("tipper", 3), ("weather", 5)):
+            db.get("CREATE TABLE " + table + " (ID INTEGER PRIMARY KEY, x INT)")
+            db.insert_records(table, [{"x": count} for count in range(rows)])
+        db.close()
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    def test_estimates(self):
+        census = table_census(None, None, None, backend="sqlite",
+                              name=self.path)
+        self.assertEqual([(entry.table, entry.rows, entry.exact)
+                          for entry in census],
+                         [("tipper", None, False), ("weather", None, False)])
+
+    def test_exact(self):
+        census = table_census(None, None, None, exact=True, workers=2,
+                              timeout=10., backend="sqlite", name=self.path)
+        self.assertEqual([(entry.database, entry.table, entry.rows,
+                           entry.exact, entry.error) for entry in census],
+                         [("main", "tipper", 3, True, None),
+                          ("main", "weather", 5, True, None)])
+        self.assertEqual(table_census(None, None, None, databases=["other"],
+                                      backend="sqlite", name=self.path), [])
+
+class TestDayMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "weather.db")
+        self.db = BaseDB(name=self.path, backend="sqlite")
+        self.db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY,"
+                    " utc TEXT, year INT, doy INT, TAmb REAL)")
+        self.add(10, "2019-05-01 00:00:00", 1.)
+        self.add(11, "2019-05-01 00:01:00", 2.)
+        self.add(12, "2019-05-02 00:00:00", 3.)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def add(self, ID, utc, TAmb):
+        day = datetime.datetime.strptime(utc, "%Y-%m-%d %H:%M:%S")
+        self.db.insert_records("weather", [{"ID": ID, "utc": utc,
+                                            "year": day.year,
+                                            "doy": day.timetuple().tm_yday,
+                                            "TAmb": TAmb}])
+
+    def test_late_rows(self):
+        mirror = DayMirror(self.db, self.directory, settle=1e12)
+        data = mirror.get_rows_by_date("weather", ["utc", "TAmb"], 2019, 121)
+        self.assertEqual(list(data["TAmb"]), [1., 2.])
+        # a late row with the same time as the last one mirrored
+        self.add(13, "2019-05-01 00:01:00", 4.)
+        self.add(14, "2019-05-01 00:00:30", 5.)
+        data = mirror.get_rows_by_date("weather", ["utc", "TAmb"], 2019, 121)
+        self.assertEqual(list(data["TAmb"]), [1., 5., 2., 4.])
+
+    def test_complete(self):
+        mirror = DayMirror(self.db, self.directory, settle=1e12)
+        mirror.get_rows_by_date("weather", ["TAmb"], 2019, 121)
+        # a late row with a smaller key is found by counting the rows
+        self.add(5, "2019-05-01 00:02:00", 6.)
+        mirror = DayMirror(self.db, self.directory, settle=0.)
+        data = mirror.get_rows_by_date("weather", ["TAmb"], 2019, 121)
+        self.assertEqual(list(data["TAmb"]), [1., 2., 6.])
+        self.add(6, "2019-05-01 00:03:00", 7.)
+        offline = DayMirror(None, self.directory)
+        self.assertEqual(
+          list(offline.get_rows_by_date("weather", ["TAmb"], 2019, 121)["TAmb"]),
+          [1., 2., 6.])
+        with self.assertRaises(MysqlException):
+            offline.get_rows_by_date("weather", ["TAmb"], 2019, 122)
+
+    def test_prefetch_command(self):
+        path = os.path.join(os.path.dirname(os.path.dirname(
+                                           os.path.abspath(__file__))),
+                            "apps", "mysql_mirror.py")
+        main = runpy.run_path(path)["main"]
+        self.db.close()
+        count = main(["--backend", "sqlite", "--database", self.path,
+                      "--table", "weather", "--columns", "utc,TAmb",
+                      "--start", "2019-121", "--end", "2019-122",
+                      "--directory", self.directory])
+        self.assertEqual(count, 2)
+        offline = DayMirror(None, self.directory)
+        self.assertEqual(
+          list(offline.get_rows_by_date("weather", ["TAmb"], 2019, 122)["TAmb"]),
+          [3.])
+
+class TestAsyncBaseDB(unittest.TestCase):
+
+    def setUp(self):
+        self.db = AsyncBaseDB(name=":memory:", backend="sqlite", pool_size=3)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.db.close()
+
+    def test_concurrent(self):
+        async def fill_and_read():
+            await self.db.get("CREATE TABLE weather (ID INTEGER PRIMARY KEY, "
+                              "year INT, doy INT, utc DOUBLE, TAmb DOUBLE)")
+            IDs = await self.db.insert_records("weather", [
+                {"year": 2020, "doy": doy, "utc": 86400.*doy, "TAmb": 1.*doy}
+                for doy in range(1, 4)])
+            days = await asyncio.gather(*[
+                self.db.get_rows_by_date("weather", ["TAmb"], 2020, doy)
+                for doy in range(1, 4)])
+            last = await self.db.getLastRecord("weather")
+            return IDs, days, last
+        IDs, days, last = self.loop.run_until_complete(fill_and_read())
+        self.assertEqual(IDs, [1, 2, 3])
+        self.assertEqual([day["TAmb"].tolist() for day in days],
+                         [[1.], [2.], [3.]])
+        self.assertEqual(last["TAmb"], 3.)
+        self.assertGreater(self.db.pool_stats()["checkouts"], 0)
+
+    def test_error(self):
+        with self.assertRaises(self.db.db.backend.Error):
+            self.loop.run_until_complete(self.db.get("SELECT * FROM missing"))
+
+if __name__ == "__main__":
+    unittest.main()